@@ -19,13 +19,20 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import argparse
+import logging
+from pathlib import Path
 import sys
-from typing import Callable
+from typing import Callable, Optional
 
 import uvicorn
 
+from beaver.builders.worker import pipeline_from_config
+import beaver.db.db
+from beaver.db.packages import import_packages
 import beaver.version
 import beaver.utils.env
+from beaver.utils.nixpkgs import read_packages_json, write_index
+from beaver.utils.package_requests import read_package_request_file
 
 _KIT_USAGE: str = "kit -v | -h | [-g GROUP] image-name [command …] "
 
@@ -96,8 +103,56 @@ def beaver_web_main(debug: bool = False) -> None:
 def beaver_build_main(_: bool = False) -> None:
     """The main function for the beaver builder"""
 
-    print("Beaver Build")
-    ...
+    logging.basicConfig(level=logging.INFO)
+    beaver.db.db.create_connectors_from_config(beaver.utils.env.Env.database)
+
+    # all of this comes from the configuration
+    pipeline = pipeline_from_config(beaver.utils.env.Env.builder)
+
+    print(f"Beaver Build: {len(pipeline.workers)} workers")
+    try:
+        pipeline.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def beaver_import_nixpkgs_main(packages_json: Optional[str]) -> None:
+    """The main function for importing nixpkgs for package search"""
+
+    search = beaver.utils.env.Env.package_search
+    if search is None or packages_json is None:
+        print("usage: beaver import-nixpkgs packages.json "
+              "(with package_search.index in the config)")
+        sys.exit(1)
+
+    count = write_index(read_packages_json(Path(packages_json)), search.index_path)
+    print(f"Imported {count} packages to {search.index_path}")
+
+
+def beaver_import_packages_main(request_file: Optional[str]) -> None:
+    """The main function for importing a Package Request File"""
+
+    if request_file is None:
+        print("usage: beaver import-packages (packages.json | requirements.txt)")
+        sys.exit(1)
+
+    try:
+        packages = read_package_request_file(Path(request_file))
+    except ValueError as err:
+        print(f"Can't import {request_file}: {err}")
+        sys.exit(1)
+
+    beaver.db.db.create_connectors_from_config(beaver.utils.env.Env.database)
+    database = next(beaver.db.db.get_db())
+    try:
+        result = import_packages(database, packages)
+    finally:
+        database.close()
+
+    for package in result.packages:
+        print(f"{package.type.value}\t{package.name}\t{package.version or '-'}\t"
+              f"{package.package_id}{' (added)' if package.created else ''}")
+    print(f"Imported {len(result.packages)} packages, {result.created} of them new")
 
 
 def beaver_main() -> None:
@@ -107,14 +162,19 @@ def beaver_main() -> None:
     parser.add_argument("--debug", "-debug",
                         help="run in debug mode", action="store_true")
     parser.add_argument("module", choices=[
-                        "web", "build"], help="which module would you like to run")
+                        "web", "build", "import-nixpkgs", "import-packages"],
+                        help="which module would you like to run")
+    parser.add_argument("file", nargs="?",
+                        help="the file to import, for import-nixpkgs and import-packages")
     args: argparse.Namespace = parser.parse_args()
 
-    modules_to_funcs: dict[str, Callable[[bool], None]] = {
-        "web": beaver_web_main,
-        "build": beaver_build_main
+    modules_to_funcs: dict[str, Callable[[], None]] = {
+        "web": lambda: beaver_web_main(args.debug),
+        "build": lambda: beaver_build_main(args.debug),
+        "import-nixpkgs": lambda: beaver_import_nixpkgs_main(args.file),
+        "import-packages": lambda: beaver_import_packages_main(args.file)
     }
 
     beaver.utils.env.load_config_from_file("beaver_config.yml")
 
-    modules_to_funcs[args.module](args.debug)
+    modules_to_funcs[args.module]()
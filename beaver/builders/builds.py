@@ -1,33 +1,98 @@
-"""OK, so here's a general overview"""
+"""OK, so here's a general overview
+
+The definition and image builders, and the repository,
+all come from the configuration.
+
+"""
+
+from typing import Iterable, Optional
 
 from beaver.builders.definition import Definition
 from beaver.builders.definition.core import DefinitionBuilder
-from beaver.builders.definition.tmp import TempBuilder
+from beaver.builders.image import Image
 from beaver.builders.image.core import ImageBuilder
-from beaver.builders.image.tmp import TempImageBuilder
 from beaver.db.packages import Package
 from beaver.utils.repository.core import Repository
-from beaver.utils.repository.tmp import TempRepository
-
-# all of this comes from the configuration
-def_builder: DefinitionBuilder = TempBuilder()
-img_builder: ImageBuilder = TempImageBuilder()
-repo: Repository = TempRepository()
-
-# First, we pass a load of packages to the definition builder
-packages = {Package(), Package(), Package()}
-definition: Definition = def_builder.build(packages)
-
-# Then we'll add the definition to the repo
-for obj in definition.to_repo():
-    repo.add(obj)
-
-# THEN IN A SECOND PROCESS
-# Then we can pull it from the repo
-# (this'll use i guess the name of the image from the job)
-definition: Definition = def_builder.definition_type.from_repo(
-    repo.get("image_name"))
-img = img_builder.build(definition)
-
-# Note - this would be a different repo
-repo.add(img)
+
+
+def build_definition(
+    image_name: str,
+    packages: Iterable[Package],
+    def_builder: DefinitionBuilder,
+    repo: Repository,
+    key: Optional[str] = None
+) -> Definition:
+    """pass the packages to the definition builder, and
+        add the definition it makes to the repo, under `image_name`
+
+    `key` identifies the packages (not the image), and the definition
+    is built and kept under it, so if the repo already has one for the
+    same packages, from any image, that's tagged with `image_name` instead
+    """
+
+    if key is not None:
+        try:
+            repo.tag(f"definition-{key}", image_name)
+            return def_builder.definition_type.from_repo(repo.get(image_name))
+        except KeyError:
+            pass
+
+    definition: Definition = def_builder.build(
+        set(packages), image_name if key is None else f"beaver-{key}")
+    for obj in definition.to_repo():
+        repo.add(obj, image_name, *([] if key is None else [f"definition-{key}"]))
+
+    return definition
+
+
+def tag_image(
+    image_name: str,
+    img_builder: ImageBuilder,
+    repo: Repository,
+    key: str
+) -> Image:
+    """tag the image the repo has for the packages `key` identifies
+        with `image_name` and the image's suffix (e.g. `.tar`)
+
+    Raises:
+        KeyError: if the repo hasn't got one
+    """
+
+    img = img_builder.image_type(repo.get(f"image-{key}"))
+    repo.tag(f"image-{key}", f"{image_name}{img.suffix}")
+    return img
+
+
+def build_image(
+    image_name: str,
+    def_builder: DefinitionBuilder,
+    img_builder: ImageBuilder,
+    repo: Repository,
+    key: Optional[str] = None
+) -> Image:
+    """pull the definition for `image_name` from the repo,
+        build the image from it, and add that to the repo,
+        under `image_name` with the image's suffix (e.g. `.tar`)
+
+    (this could well be on a different machine to
+    where the definition was built)
+
+    if the repo already has an image for the packages
+    `key` identifies, that's tagged and used instead
+    """
+
+    if key is not None:
+        try:
+            return tag_image(image_name, img_builder, repo, key)
+        except KeyError:
+            pass
+
+    definition: Definition = def_builder.definition_type.from_repo(
+        repo.get(image_name))
+    img = img_builder.build(definition)
+
+    # Note - this would be a different repo
+    repo.add(img, f"{image_name}{img.suffix}",
+             *([] if key is None else [f"image-{key}"]))
+
+    return img
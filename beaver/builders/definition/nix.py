@@ -0,0 +1,219 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+import re
+from typing import Iterable, List, Optional, Set
+
+from beaver.builders.definition import Definition
+from beaver.builders.definition.core import DefinitionBuilder
+from beaver.db.packages import Package
+from beaver.models.packages import PackageType
+from beaver.utils.repository import RepositorableObject
+
+# every image gets these
+DEFAULT_PACKAGES = ("bash", "coreutils", "vim", "less", "nano", "git", "curl", "cacert", "openssl")
+
+# docker and the registries cope with up to about 125 layers in an
+# image, which we split between the base, common and image layers
+DEFAULT_MAX_LAYERS = 40
+
+_NIX_ATTRIBUTE = re.compile(r"^[A-Za-z_][A-Za-z0-9_'-]*$")
+_IMAGE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+_HEADER = """# This Nix file is automatically generated by Beaver.
+#
+# It MUST NOT be manually modified, renamed or deleted without ensuring
+# corresponding changes are made to the Beaver database too.
+#
+# It is HIGHLY RECOMMENDED that a new definition is created using Beaver
+# instead of modifying this.
+#
+# Image Name: {image_name}
+
+{{
+  pkgs ? import <nixpkgs> {{ }},
+  pkgsLinux ? import <nixpkgs> {{ system = "x86_64-linux"; }}
+}}:
+"""
+
+
+def _attribute(name: str) -> str:
+    """check `name` can go straight into a Nix file"""
+    if not _NIX_ATTRIBUTE.match(name):
+        raise ValueError(f"{name!r} isn't a valid Nix package name")
+    return name
+
+
+def _list(items: Iterable[str], indent: int) -> str:
+    return "\n".join(" " * indent + x if x else "" for x in items)
+
+
+class NixDefinition(Definition):
+    """a Nix file that builds the image, named after the image"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+
+    @property
+    def image_name(self) -> str:
+        """the name of the image this builds"""
+        return self.path.stem
+
+    def to_repo(self) -> Set[RepositorableObject]:
+        return {RepositorableObject(self.path)}
+
+    @staticmethod
+    def from_repo(obj: RepositorableObject) -> NixDefinition:
+        # a repository that doesn't keep anything gives back an empty path
+        if Path(obj) == Path():
+            raise ValueError("no definition in the repository")
+        return NixDefinition(Path(obj))
+
+
+class NixLayeredDefinitionBuilder(DefinitionBuilder):
+    """writes Nix files that build images in layers, so images
+        share as many layers as possible
+
+    the default packages go in a base image, which is the same
+    for every image. the commonly used packages go in a layered
+    image on top of that, and everything else on top of that. as
+    each package gets its own layers (up to `max_layers`), an
+    image's base and commonly used layers are the same as every
+    other image's, so registries and `kit` only move the rest.
+    """
+
+    definition_type = NixDefinition
+
+    def __init__(
+        self,
+        output_dir: Path,
+        derivations_dir: Optional[Path] = None,
+        default_packages: Iterable[str] = DEFAULT_PACKAGES,
+        max_layers: int = DEFAULT_MAX_LAYERS
+    ) -> None:
+        self.output_dir = Path(output_dir)
+        self.derivations_dir = Path(derivations_dir) if derivations_dir else None
+        self.default_packages = [_attribute(x) for x in default_packages]
+        self.max_layers = max_layers
+
+    def _derivation(self, package: Package) -> str:
+        """the text of one of our own derivations"""
+        if self.derivations_dir is None:
+            raise ValueError(f"no derivations directory for {package.github_filename}")
+        return (self.derivations_dir / str(package.github_filename)).read_text(
+            encoding="utf-8").strip()
+
+    def render(self, packages: Set[Package], image_name: str) -> str:
+        """the Nix file building `image_name` from `packages`"""
+
+        if not _IMAGE_NAME.match(image_name):
+            raise ValueError(f"{image_name!r} isn't a valid image name")
+
+        derivations: List[str] = []
+        common: List[str] = []
+        rest: List[str] = []
+        r_packages: List[str] = []
+        py_packages: List[str] = []
+
+        for package in sorted(packages, key=lambda x: str(x.package_name)):
+            name = _attribute(str(package.package_name))
+            if name in self.default_packages:
+                continue
+
+            if package.package_type == PackageType.R:
+                r_packages.append(name)
+                continue
+            if package.package_type == PackageType.py:
+                py_packages.append(name)
+                continue
+
+            if package.github_filename:
+                derivations.append(self._derivation(package))
+            else:
+                name = f"pkgs.{name}"
+            (common if package.commonly_used else rest).append(name)
+
+        if r_packages:
+            derivations.append(
+                "r-with-packages = pkgs.rWrapper.override {\n"
+                "  packages = with pkgs.rPackages; [\n"
+                f"{_list(r_packages, 4)}\n"
+                "  ];\n"
+                "};")
+            rest.append("r-with-packages")
+        if py_packages:
+            derivations.append(
+                "python-with-packages = pkgs.python3.withPackages (ps: with ps; [\n"
+                f"{_list(py_packages, 2)}\n"
+                "]);")
+            rest.append("python-with-packages")
+
+        layers = [
+            # the same for every image
+            "base = pkgs.dockerTools.buildLayeredImage {\n"
+            '  name = "beaver-base";\n'
+            "  contents = [\n"
+            f"{_list((f'pkgs.{x}' for x in self.default_packages), 4)}\n"
+            "  ];\n"
+            f"  maxLayers = {self.max_layers};\n"
+            "  extraCommands = ''\n"
+            "    mkdir -p etc\n"
+            "    touch etc/passwd etc/group\n"
+            "  '';\n"
+            "};"
+        ]
+        top = "base"
+        if common:
+            layers.append(
+                "common = pkgs.dockerTools.buildLayeredImage {\n"
+                '  name = "beaver-common";\n'
+                "  fromImage = base;\n"
+                "  contents = [\n"
+                f"{_list(common, 4)}\n"
+                "  ];\n"
+                f"  maxLayers = {self.max_layers};\n"
+                "};")
+            top = "common"
+
+        bindings = "\n\n".join(derivations + layers)
+        return (
+            _HEADER.format(image_name=image_name) + "\n"
+            "let\n"
+            f"{_list(bindings.splitlines(), 2)}\n"
+            "in\n"
+            "pkgs.dockerTools.streamLayeredImage {\n"
+            f'  name = "{image_name}";\n'
+            '  tag = "latest";\n'
+            f"  fromImage = {top};\n"
+            "  contents = [\n"
+            f"{_list(rest, 4)}\n"
+            "  ];\n"
+            f"  maxLayers = {self.max_layers};\n"
+            "}\n"
+        )
+
+    def build(self, packages: Set[Package], image_name: str = "image") -> NixDefinition:
+        path = self.output_dir / f"{image_name}.nix"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.render(packages, image_name), encoding="utf-8")
+        return NixDefinition(path)
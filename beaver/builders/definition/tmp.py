@@ -20,5 +20,5 @@ class TmpDefinition(Definition):
 class TempBuilder(DefinitionBuilder):
     definition_type = TmpDefinition
 
-    def build(self, _: Set[Package]) -> TmpDefinition:
+    def build(self, _: Set[Package], image_name: str = "image") -> TmpDefinition:
         return TmpDefinition()
@@ -1,10 +1,14 @@
 import abc
+from typing import Type
 
 from beaver.builders.definition import Definition
 from beaver.builders.image import Image
 
 
 class ImageBuilder(abc.ABC):
+
+    image_type: Type[Image]
+
     @abc.abstractmethod
     def build(self, definition: Definition) -> Image:
         ...
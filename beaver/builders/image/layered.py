@@ -0,0 +1,84 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from pathlib import Path
+import subprocess
+from typing import Callable, Sequence
+
+from beaver.builders.definition import Definition
+from beaver.builders.definition.nix import NixDefinition
+from beaver.builders.image import Image
+from beaver.builders.image.core import ImageBuilder
+
+logger = logging.getLogger(__name__)
+
+
+class LayeredImage(Image):
+    """a docker image archive, built in layers"""
+
+
+def _run(args: Sequence[str], stdout=None) -> None:
+    """run a command, logging what it writes to stderr as it goes
+        (which is where nix-build puts the build log)
+    """
+
+    with subprocess.Popen(args, stdout=stdout, stderr=subprocess.PIPE) as process:
+        for line in process.stderr or ():
+            logger.info("%s", line.decode(errors="replace").rstrip())
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+
+class LayeredImageBuilder(ImageBuilder):
+    """builds the images `NixLayeredDefinitionBuilder` defines
+
+    `nix-build` makes a script that streams the image, layer by
+    layer, which we write to an archive in `output_dir`. nothing
+    is put in the Nix store except the layers, which are shared
+    between images, so rebuilding a similar image is quick.
+    """
+
+    image_type = LayeredImage
+
+    def __init__(
+        self,
+        output_dir: Path,
+        nix_build: str = "nix-build",
+        run: Callable[..., None] = _run
+    ) -> None:
+        self.output_dir = Path(output_dir)
+        self.nix_build = nix_build
+        self._run = run
+
+    def build(self, definition: Definition) -> LayeredImage:
+        if not isinstance(definition, NixDefinition):
+            raise TypeError
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        stream = self.output_dir / f"{definition.image_name}-stream"
+        archive = self.output_dir / f"{definition.image_name}.tar"
+
+        self._run([self.nix_build, str(definition.path), "--out-link", str(stream)])
+        with open(archive, "wb") as archive_file:
+            self._run([str(stream)], stdout=archive_file)
+
+        return LayeredImage(archive)
@@ -9,6 +9,8 @@ class TmpImage(Image):
 
 
 class TempImageBuilder(ImageBuilder):
+    image_type = TmpImage
+
     def build(self, definition: Definition) -> TmpImage:
         if not isinstance(definition, TmpDefinition):
             raise TypeError
@@ -0,0 +1,376 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import math
+import os
+import socket
+import threading
+from typing import Any, Callable, Dict, List, Optional
+import uuid
+
+from sqlalchemy.orm import Session
+
+from beaver.builders.builds import build_definition, build_image, tag_image
+from beaver.builders.definition.core import DefinitionBuilder
+from beaver.builders.definition.nix import NixLayeredDefinitionBuilder
+from beaver.builders.definition.tmp import TempBuilder
+from beaver.builders.image.core import ImageBuilder
+from beaver.builders.image.layered import LayeredImageBuilder
+from beaver.builders.image.tmp import TempImageBuilder
+import beaver.db.db
+from beaver.db.job_events import JobEventBroker
+from beaver.db.job_queue import (claim_job, reconcile_followers, renew_lease,
+                                 set_leased_job_status)
+from beaver.db.jobs import Job
+from beaver.db.package_dependencies import get_packages_with_dependencies
+from beaver.db.packages import get_packages_for_image
+from beaver.models.jobs import BuildStage, JobStatus
+from beaver.utils.repository.core import Repository
+from beaver.utils.repository.fs import FileSystemRepository
+from beaver.utils.repository.tmp import TempRepository
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    """the builder's lease on a job ran out, so
+        someone else might be building it now
+    """
+
+
+class _JobLogHandler(logging.Handler):
+    """passes on what the builders log while building a job,
+        on the thread building it, as the job's build log
+    """
+
+    def __init__(self, events: JobEventBroker, job_id: str) -> None:
+        super().__init__(logging.INFO)
+        self.events = events
+        self.job_id = job_id
+        self.thread = threading.get_ident()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.thread == self.thread:
+            self.events.publish_log(self.job_id, self.format(record))
+
+
+class BuildWorker:  # pylint: disable=too-many-instance-attributes
+    """claims jobs from the database and builds one stage
+        of them, one job at a time
+
+    any number of these can run, on any number of machines. each job
+    is leased to the worker building it, and the lease is renewed
+    in the background every `heartbeat_interval` seconds. if a worker
+    dies, its lease runs out and the job is claimed by another.
+
+    if there's an `events` broker, the job's status changes and
+    whatever the builders log are published to it as they happen.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        stage: BuildStage,
+        def_builder: DefinitionBuilder,
+        img_builder: ImageBuilder,
+        repo: Repository,
+        *,
+        worker_id: Optional[str] = None,
+        lease: float = 60,
+        heartbeat_interval: Optional[float] = None,
+        poll_interval: float = 5,
+        session_factory: Optional[Callable[[], Session]] = None,
+        events: Optional[JobEventBroker] = None
+    ) -> None:
+        self.stage = stage
+        self.def_builder = def_builder
+        self.img_builder = img_builder
+        self.repo = repo
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}-{os.getpid()}-{stage.value}-{uuid.uuid4().hex[:8]}")
+        self.lease = lease
+        self.heartbeat_interval = heartbeat_interval or lease / 3
+        self.poll_interval = poll_interval
+        self._session_factory = session_factory
+        self.events = events
+
+    def _session(self) -> Session:
+        if self._session_factory is not None:
+            return self._session_factory()
+        return beaver.db.db.session()
+
+    def _heartbeat(self, job_id: str, done: threading.Event, lost: threading.Event) -> None:
+        """renew the lease on `job_id` until `done` is set, setting
+            `lost` if it can't be
+        """
+
+        database = self._session()
+        try:
+            while not done.wait(self.heartbeat_interval):
+                try:
+                    renewed = renew_lease(database, job_id, self.worker_id, self.lease)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("failed to renew lease on job %s", job_id)
+                    database.rollback()
+                    continue
+
+                if not renewed:
+                    lost.set()
+                    return
+        finally:
+            database.close()
+
+    def _set_status(
+        self,
+        database: Session,
+        job_id: str,
+        status: JobStatus,
+        detail: Optional[str] = None
+    ) -> None:
+        if not set_leased_job_status(database, job_id, self.worker_id, status, detail):
+            raise LeaseLost(job_id)
+        if self.events is not None:
+            self.events.publish_status(job_id, status, detail)
+
+    def _build(self, database: Session, job: Job) -> JobStatus:
+        """build our stage of `job`
+
+        Returns: JobStatus - what the job's status should be now
+
+        """
+
+        image_name = str(job.image.image_name)
+
+        # what we build only depends on the packages, so the repo can
+        # give us back anything it's already got for any image
+        key: Optional[str] = None
+        if job.image.content_hash is not None:
+            key = str(job.image.content_hash)
+
+        if self.stage == BuildStage.definition:
+            # the image gets everything the packages depend on, too
+            packages = get_packages_with_dependencies(database, [
+                int(x.package_id) for x in get_packages_for_image(database, int(job.image_id))])
+            build_definition(image_name, packages, self.def_builder, self.repo, key)
+            return JobStatus.DefinitionMade
+
+        build_image(image_name, self.def_builder, self.img_builder, self.repo, key)
+        return JobStatus.Succeeded
+
+    def _publish(self, follower: Job, status: JobStatus) -> None:
+        """give `follower`, which is waiting on another job's build,
+            what the build has made, under its own image name
+
+        Raises:
+            KeyError: if the build isn't in the repo
+        """
+
+        image_name = str(follower.image.image_name)
+        key = str(follower.image.content_hash)
+        self.repo.tag(f"definition-{key}", image_name)
+        if status == JobStatus.Succeeded:
+            tag_image(image_name, self.img_builder, self.repo, key)
+
+    def run_once(self) -> bool:
+        """claim a job, and build our stage of it
+
+        Returns: bool - whether there was a job to build
+
+        """
+
+        database = self._session()
+        try:
+            reconcile_followers(database, self._publish)
+            job = claim_job(database, self.worker_id, self.stage, self.lease)
+            if job is None:
+                return False
+
+            job_id = str(job.job_id)
+            logger.info("%s claimed job %s", self.worker_id, job_id)
+            if self.events is not None:
+                self.events.publish_status(job_id, JobStatus(job.status))
+
+            done, lost = threading.Event(), threading.Event()
+            heartbeat = threading.Thread(
+                target=self._heartbeat, args=(job_id, done, lost),
+                name=f"beaver-lease-{job_id}", daemon=True)
+            heartbeat.start()
+
+            log_handler: Optional[logging.Handler] = None
+            if self.events is not None:
+                log_handler = _JobLogHandler(self.events, job_id)
+                logging.getLogger("beaver.builders").addHandler(log_handler)
+
+            try:
+                status = self._build(database, job)
+                if lost.is_set():
+                    raise LeaseLost(job_id)
+                self._set_status(database, job_id, status)
+
+            except LeaseLost:
+                database.rollback()
+                logger.warning("%s lost the lease on job %s", self.worker_id, job_id)
+
+            except Exception as err:  # pylint: disable=broad-except
+                database.rollback()
+                logger.exception("job %s failed", job_id)
+                try:
+                    self._set_status(database, job_id, JobStatus.Failed, str(err))
+                except LeaseLost:
+                    pass
+
+            finally:
+                if log_handler is not None:
+                    logging.getLogger("beaver.builders").removeHandler(log_handler)
+                done.set()
+                heartbeat.join()
+
+            return True
+
+        finally:
+            database.close()
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        """build jobs until `stop` is set, waiting `poll_interval`
+            seconds whenever there's nothing to do
+        """
+
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("%s failed to claim a job", self.worker_id)
+            stop.wait(self.poll_interval)
+
+
+def image_workers_within_budget(
+    image_workers: int,
+    cpu_budget: Optional[float] = None,
+    cpus_per_image: float = 1,
+    disk_budget: Optional[float] = None,
+    disk_per_image: Optional[float] = None
+) -> int:
+    """how many image builds we can run at once, without going over
+        the CPUs and disk (in whatever unit, so long as it's the same)
+        we've been given
+
+    Returns: int - `image_workers`, or fewer if that's over budget
+
+    """
+
+    limits = [image_workers]
+    if cpu_budget is not None:
+        limits.append(math.floor(cpu_budget / cpus_per_image))
+    if disk_budget is not None and disk_per_image:
+        limits.append(math.floor(disk_budget / disk_per_image))
+
+    return max(min(limits), 0)
+
+
+class BuildPipeline:
+    """runs separate pools of workers for each stage of the build
+
+    definitions are quick to make, and images slow, so the stages
+    get their own workers and a definition never waits for an image
+    build to finish. either pool can be empty, so a machine can
+    run just one stage.
+
+    the image pool is capped so the image builds running at once
+    fit in `cpu_budget` and `disk_budget`. `worker_options`
+    (`lease`, `heartbeat_interval`, ...) go to every `BuildWorker`.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        def_builder: DefinitionBuilder,
+        img_builder: ImageBuilder,
+        repo: Repository,
+        *,
+        definition_workers: int = 4,
+        image_workers: int = 1,
+        cpu_budget: Optional[float] = None,
+        cpus_per_image: float = 1,
+        disk_budget: Optional[float] = None,
+        disk_per_image: Optional[float] = None,
+        **worker_options
+    ) -> None:
+        pool_sizes = {
+            BuildStage.definition: definition_workers,
+            BuildStage.image: image_workers_within_budget(
+                image_workers, cpu_budget, cpus_per_image, disk_budget, disk_per_image)
+        }
+
+        self.workers: List[BuildWorker] = [
+            BuildWorker(stage, def_builder, img_builder, repo, **worker_options)
+            for stage, size in pool_sizes.items()
+            for _ in range(size)
+        ]
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        """run all the workers until `stop` is set"""
+
+        stop = stop or threading.Event()
+        threads = [threading.Thread(
+            target=x.run, args=(stop,), name=f"beaver-{x.worker_id}", daemon=True
+        ) for x in self.workers]
+
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            stop.set()
+
+
+def pipeline_from_config(
+    options: Dict[str, Any],
+    events: Optional[JobEventBroker] = None
+) -> BuildPipeline:
+    """make the build pipeline from the `builder` section of
+        the config, publishing progress to `events` if given
+
+    Raises:
+        ValueError: if the Nix builders are configured without a
+            repository to pass definitions and images between them,
+            or an image is given no CPUs or disk
+    """
+
+    options = dict(options)
+    definitions, images = options.pop("definitions", None), options.pop("images", None)
+    repository = options.pop("repository", None)
+    options.pop("in_web", None)
+
+    if (definitions or images) and not repository:
+        raise ValueError("the Nix builders need a `repository` in the builder config")
+    for option in ("cpus_per_image", "disk_per_image"):
+        if options.get(option) is not None and options[option] <= 0:
+            raise ValueError(f"`{option}` in the builder config has to be more than 0")
+
+    return BuildPipeline(
+        NixLayeredDefinitionBuilder(**definitions) if definitions else TempBuilder(),
+        LayeredImageBuilder(**images) if images else TempImageBuilder(),
+        FileSystemRepository(**repository) if repository else TempRepository(),
+        events=events,
+        **options
+    )
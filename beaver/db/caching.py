@@ -0,0 +1,114 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from typing import Dict, Generic, Hashable, Optional, Sequence, Tuple, TypeVar
+
+from sqlalchemy import Column, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+T = TypeVar("T")
+
+
+class TableWatcher:
+    """the base of things kept in memory from the database, that
+        are out of date when rows are added to or deleted from the
+        tables of `ids`, or they're asked for from another database
+
+    the number and highest of each of `ids` are compared at most
+    every `check_interval` seconds, to notice rows added by other
+    processes. `_lock` is shared with subclasses, but mustn't be
+    held when calling `_changed`
+    """
+
+    def __init__(self, ids: Sequence[Column], check_interval: float = 5) -> None:
+        self.check_interval = check_interval
+        self._ids = tuple(ids)
+
+        self._lock = threading.Lock()
+        self._engine: Optional[Engine] = None
+        self._fingerprint: Optional[Tuple] = None
+        self._checked_at: Optional[float] = None
+
+    def _recheck(self) -> None:
+        # with the lock held
+        self._checked_at = None
+
+    def _forget(self) -> None:
+        # with the lock held - the next look finds a change
+        self._engine = self._fingerprint = self._checked_at = None
+
+    def _changed(self, database: Session, fresh: bool = False) -> bool:
+        """whether the tables, or the database, have changed since we
+            last looked, which is only done again after `check_interval`
+            seconds, unless `fresh`
+        """
+
+        engine = database.get_bind()
+        now = time.monotonic()
+        with self._lock:
+            if not fresh and engine is self._engine and self._checked_at is not None \
+                    and now < self._checked_at + self.check_interval:
+                return False
+
+        fingerprint = tuple(x for column in self._ids for x in database.execute(
+            select(func.count(column), func.max(column))).one())
+
+        with self._lock:
+            changed = engine is not self._engine or fingerprint != self._fingerprint
+            self._engine, self._fingerprint = engine, fingerprint
+            self._checked_at = now
+        return changed
+
+
+class ExpiringCache(Generic[T]):
+    """values from the database kept for a while, for each
+        database and whatever else they depend on
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[Engine, Hashable], Tuple[float, T]] = {}
+
+    def get(self, database: Session, key: Hashable = None) -> Optional[T]:
+        """the value for `key` from `database`, if there's one that isn't stale"""
+
+        with self._lock:
+            cached = self._values.get((database.get_bind(), key))
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def put(self, database: Session, value: T, ttl: float, key: Hashable = None) -> None:
+        """keep `value` for `key` from `database` for `ttl` seconds"""
+
+        now = time.monotonic()
+        with self._lock:
+            # so values from databases we're done with don't pile up
+            for stale in [k for k, (expiry, _) in self._values.items() if expiry <= now]:
+                del self._values[stale]
+            self._values[(database.get_bind(), key)] = (now + ttl, value)
+
+    def clear(self) -> None:
+        """forget all the values"""
+        with self._lock:
+            self._values.clear()
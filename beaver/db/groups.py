@@ -18,7 +18,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, Index, String, Integer
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
 
@@ -31,8 +31,14 @@ class Group(Base):
     group_id = Column(Integer, primary_key=True, autoincrement=True)
     group_name = Column(String)
 
+    __table_args__ = (Index("groups_group_name", "group_name"),)
+
     @staticmethod
-    def get_or_make_group_id_for_group_name(group_name: str, database: Session) -> int:
+    def get_or_make_group_id_for_group_name(
+        group_name: str,
+        database: Session,
+        commit: bool = True
+    ) -> int:
         """get the group id for a given group name, or add
         them to the database if they don't exist
 
@@ -40,6 +46,8 @@ class Group(Base):
             - group_name: str - the name of the group to search
                 for or add if not in the database
             - database: Session - the database session to use
+            - commit: bool - whether to commit a new group, or just
+                flush it as part of a bigger transaction
 
         Returns: int - the found or newly created group ID
 
@@ -52,8 +60,11 @@ class Group(Base):
         except NoResultFound:
             new_group = Group(group_name=group_name)
             database.add(new_group)
-            database.commit()
-            database.refresh(new_group)
+            if commit:
+                database.commit()
+                database.refresh(new_group)
+            else:
+                database.flush()
             group_id = int(new_group.group_id)
 
         return group_id
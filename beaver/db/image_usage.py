@@ -21,17 +21,24 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
 from datetime import datetime
-from typing import List
+from typing import Iterable, Optional, Tuple
 
-from sqlalchemy import Column, ForeignKey, Integer, DateTime
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy import Column, ForeignKey, Index, Integer, DateTime, insert
+from sqlalchemy.orm import Query, relationship, selectinload, Session
 from sqlalchemy.orm.relationships import RelationshipProperty
 
 from beaver.db.db import Base
 from beaver.db.groups import Group
 from beaver.db.images import Image, ImageContents
+from beaver.db.package_dependencies import dependency_graph
+from beaver.db.pagination import Page, paginate
+from beaver.db.usage_rollups import add_usage_to_rollups, clear_rollups
 from beaver.db.users import User
 from beaver.models.image_usage import ImageUsageBase
+from beaver.models.pagination import PageRequest
+
+# the most rows we'll put in one INSERT statement
+INSERT_BATCH_SIZE = 1000
 
 
 class ImageUsage(Base):
@@ -42,44 +49,173 @@ class ImageUsage(Base):
     image_id = Column(Integer, ForeignKey("images.image_id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
     group_id = Column(Integer, ForeignKey("groups.group_id"), nullable=False)
-    datetime = Column(DateTime, nullable=False, default=datetime.now())
+    datetime = Column(DateTime, nullable=False, default=datetime.now)
 
     user: RelationshipProperty[User] = relationship("User")
     group: RelationshipProperty[Group] = relationship("Group")
     image: RelationshipProperty[Image] = relationship("Image")
 
-
-def get_image_usage_for_user(database: Session, user: int) -> List[ImageUsage]:
-    """get image usage for the particular user"""
-    return database.query(ImageUsage).filter(ImageUsage.user_id == user).all()
-
-
-def get_image_usage_for_group(database: Session, group: int) -> List[ImageUsage]:
-    """get image usage for the group"""
-    return database.query(ImageUsage).filter(ImageUsage.group_id == group).all()
-
-
-def get_image_usage_by_image(database: Session, image: int) -> List[ImageUsage]:
-    """get image usage for the image"""
-    return database.query(ImageUsage).filter(ImageUsage.image_id == image).all()
-
-
-def get_image_usage_by_package(database: Session, package: int) -> List[ImageUsage]:
-    """get image usage based on a particular package"""
+    # usage is always looked up for one of these, newest or oldest first
+    __table_args__ = (
+        Index("image_usage_user_id_datetime", "user_id", "datetime"),
+        Index("image_usage_group_id_datetime", "group_id", "datetime"),
+        Index("image_usage_image_id_datetime", "image_id", "datetime")
+    )
+
+
+def _usage_page(
+    query: Query,
+    page: Optional[PageRequest],
+    since: Optional[datetime],
+    until: Optional[datetime]
+) -> Page[ImageUsage]:
+    """filter image usage to between `since` and `until`, and
+        get a page of it sorted by `datetime` or `image_usage_id`
+    """
+
+    if since is not None:
+        query = query.filter(ImageUsage.datetime >= since)
+    if until is not None:
+        query = query.filter(ImageUsage.datetime < until)
+
+    # everything each usage row is serialised with is loaded
+    # up front, rather than lazily as each row is serialised
+    query = query.options(
+        selectinload(ImageUsage.user),
+        selectinload(ImageUsage.group),
+        selectinload(ImageUsage.image).selectinload(Image.user),
+        selectinload(ImageUsage.image).selectinload(Image.group)
+    )
+
+    return paginate(query, page or PageRequest(), {
+        "datetime": ImageUsage.datetime,
+        "image_usage_id": ImageUsage.image_usage_id
+    }, ImageUsage.image_usage_id)
+
+
+def get_image_usage_for_user(
+    database: Session,
+    user: int,
+    page: Optional[PageRequest] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Page[ImageUsage]:
+    """get a page of image usage for the particular user"""
+    return _usage_page(database.query(ImageUsage).filter(
+        ImageUsage.user_id == user), page, since, until)
+
+
+def get_image_usage_for_group(
+    database: Session,
+    group: int,
+    page: Optional[PageRequest] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Page[ImageUsage]:
+    """get a page of image usage for the group"""
+    return _usage_page(database.query(ImageUsage).filter(
+        ImageUsage.group_id == group), page, since, until)
+
+
+def get_image_usage_by_image(
+    database: Session,
+    image: int,
+    page: Optional[PageRequest] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Page[ImageUsage]:
+    """get a page of image usage for the image"""
+    return _usage_page(database.query(ImageUsage).filter(
+        ImageUsage.image_id == image), page, since, until)
+
+
+def get_image_usage_by_package(
+    database: Session,
+    package: int,
+    page: Optional[PageRequest] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Page[ImageUsage]:
+    """get a page of image usage based on a particular package,
+        including images with packages that depend on it
+    """
     images_for_package = database.query(ImageContents).filter(
-        ImageContents.package_id == package
+        ImageContents.package_id.in_(dependency_graph.get(database).dependents([package]))
     ).with_entities(ImageContents.image_id).subquery()
 
-    return database.query(ImageUsage).filter(
-        ImageUsage.image_id.in_(images_for_package)).all()
+    return _usage_page(database.query(ImageUsage).filter(
+        ImageUsage.image_id.in_(images_for_package)), page, since, until)
 
 
 def record_image_usage(database: Session, image_usage: ImageUsageBase) -> ImageUsage:
     """record usage of an image in the database"""
 
-    db_image_usage = ImageUsage(**image_usage.dict())
+    db_image_usage = ImageUsage(**image_usage.dict(), datetime=datetime.now())
     database.add(db_image_usage)
+    add_usage_to_rollups(database, [{**image_usage.dict(), "datetime": db_image_usage.datetime}])
     database.commit()
     database.refresh(db_image_usage)
 
     return db_image_usage
+
+
+def record_image_usages(
+    database: Session,
+    image_usages: Iterable[Tuple[ImageUsageBase, datetime]]
+) -> int:
+    """record many usages of images, each with the time it happened,
+        using multi-row inserts and a single commit, which also
+        counts them into the rollup tables
+
+    Args:
+        - database: Session - the database session to use
+        - image_usages: Iterable[Tuple[ImageUsageBase, datetime]] - the
+            usages, along with when they happened
+
+    Returns: int - the number of usages recorded
+
+    """
+
+    rows = [{**usage.dict(), "datetime": when} for usage, when in image_usages]
+
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        database.execute(insert(ImageUsage).values(rows[i:i + INSERT_BATCH_SIZE]))
+    add_usage_to_rollups(database, rows)
+    database.commit()
+
+    return len(rows)
+
+
+def rebuild_usage_rollups(database: Session) -> int:
+    """recount all the recorded image usage into the rollup tables,
+        for when they're first created or have gone wrong
+
+    Returns: int - the number of usages counted
+
+    """
+
+    clear_rollups(database)
+
+    total = 0
+    last_id = 0
+    while True:
+        # walking the ids, rather than streaming, so
+        # we can write as we go on the same connection
+        usages = database.query(ImageUsage).filter(
+            ImageUsage.image_usage_id > last_id
+        ).order_by(ImageUsage.image_usage_id).limit(INSERT_BATCH_SIZE).all()
+        if not usages:
+            break
+
+        add_usage_to_rollups(database, [{
+            "image_id": x.image_id,
+            "user_id": x.user_id,
+            "group_id": x.group_id,
+            "datetime": x.datetime
+        } for x in usages])
+        total += len(usages)
+        last_id = usages[-1].image_usage_id
+
+    database.commit()
+
+    return total
@@ -20,16 +20,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 
-from typing import List
+from typing import Iterable, List, Optional
 
-from sqlalchemy import Column, ForeignKey, String, Integer
+from sqlalchemy import Column, ForeignKey, Index, String, Integer, or_, select
 import sqlalchemy.exc
-from sqlalchemy.orm import Session, relationship
+from sqlalchemy.orm import Session, contains_eager, relationship
 from sqlalchemy.orm.relationships import RelationshipProperty
 
 from beaver.db.db import Base
 from beaver.db.groups import Group
+from beaver.db.pagination import Page, paginate
 from beaver.db.users import User
+from beaver.models.pagination import PageRequest
 
 
 class Image(Base):
@@ -41,9 +43,19 @@ class Image(Base):
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
     group_id = Column(Integer, ForeignKey("groups.group_id"), nullable=False)
 
+    # a hash of the packages in the image, see `package_set_hash`
+    content_hash = Column(String)
+
     user: RelationshipProperty[User] = relationship("User")
     group: RelationshipProperty[Group] = relationship("Group")
 
+    __table_args__ = (
+        Index("images_image_name", "image_name", unique=True),
+        Index("images_user_id", "user_id"),
+        Index("images_group_id", "group_id"),
+        Index("images_content_hash", "content_hash")
+    )
+
 
 class ImageContents(Base):
     """shows the contents of images"""
@@ -54,6 +66,13 @@ class ImageContents(Base):
     package_id = Column(Integer, ForeignKey(
         "packages.package_id"), nullable=False)
 
+    __table_args__ = (
+        Index("image_contents_image_id", "image_id"),
+        # includes the image, so finding the images with
+        # a package never needs to read the table
+        Index("image_contents_package_id_image_id", "package_id", "image_id")
+    )
+
 
 def get_images_for_user(database: Session, user: str) -> List[Image]:
     """gets images available for the specific user"""
@@ -73,3 +92,44 @@ def get_images_for_group_name(database: Session, group_name: str) -> List[Image]
 
     return database.query(Image).filter(
         Image.group_id == group_id).all()
+
+
+def get_images_visible_to_user(
+    database: Session,
+    user: str,
+    groups: Iterable[str],
+    page: Optional[PageRequest] = None
+) -> Page[Image]:
+    """gets a page of the images made by the user or by any of `groups`,
+        sorted by `image_id` or `image_name`
+
+    this is a single query, joining the users and groups so
+    the image's `user` and `group` are loaded with it, and
+    each image is only returned once
+
+    Args:
+        - database: Session - the database session to use
+        - user: str - the username
+        - groups: Iterable[str] - the names of the groups the user is in
+        - page: Optional[PageRequest] - which page (default: the first)
+
+    Returns: Page[Image] - the images and the cursor for the next page
+
+    """
+
+    # filtering on the image's own columns, rather than the joined
+    # names, lets each side of the OR use an index on images
+    _groups = list(groups)
+    visible = Image.user_id.in_(select(User.user_id).where(User.user_name == user))
+    if _groups:
+        visible = or_(visible, Image.group_id.in_(
+            select(Group.group_id).where(Group.group_name.in_(_groups))))
+
+    return paginate(database.query(Image).join(Image.user).join(Image.group).filter(
+        visible
+    ).options(
+        contains_eager(Image.user), contains_eager(Image.group)
+    ), page or PageRequest(), {
+        "image_id": Image.image_id,
+        "image_name": Image.image_name
+    }, Image.image_id)
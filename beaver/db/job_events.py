@@ -0,0 +1,275 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from datetime import datetime
+import logging
+import threading
+import time
+from typing import Callable, Deque, Dict, Optional, Set
+
+from sqlalchemy.orm import Session
+
+import beaver.db.db
+from beaver.db.jobs import FINISHED_STATUSES, get_job_statuses
+from beaver.models.jobs import JobEvent, JobEventType, JobStatus
+
+logger = logging.getLogger(__name__)
+
+
+class JobSubscription:
+    """the events for one job, for one watcher
+
+    events can be put from any thread, and are taken in the event
+    loop the subscription was made in. if the watcher falls more
+    than `max_queue` events behind, the oldest are dropped
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        loop: asyncio.AbstractEventLoop,
+        max_queue: int
+    ) -> None:
+        self.job_id = job_id
+        self.dropped = 0
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+
+    def _put(self, event: JobEvent) -> None:
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(event)
+
+    def put(self, event: JobEvent) -> None:
+        """queue `event` for the watcher"""
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the loop's gone, and the watcher with it
+            pass
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[JobEvent]:
+        """wait for the next event, or None after `timeout` seconds"""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class JobEventBroker:  # pylint: disable=too-many-instance-attributes
+    """passes job status changes and build log lines
+        to whoever is watching those jobs
+
+    builders in this process publish to it directly. for builders
+    in other processes, a background thread looks up the jobs being
+    watched every `poll_interval` seconds, all in one query, so
+    watchers don't each have to poll the database
+
+    the last `history` events of the last `max_jobs` jobs are kept,
+    so anyone who starts watching part way through a build still
+    gets the log so far, along with the job's latest status
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        session_factory: Optional[Callable[[], Session]] = None,
+        poll_interval: float = 1,
+        history: int = 200,
+        max_jobs: int = 100,
+        max_queue: int = 1000
+    ) -> None:
+        self._session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.history = history
+        self.max_jobs = max_jobs
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[JobSubscription]] = {}
+        self._history: OrderedDict[str, Deque[JobEvent]] = OrderedDict()
+        # the last status published for each job, and when
+        self._statuses: Dict[str, JobEvent] = {}
+        self._published_at: Dict[str, float] = {}
+
+        self._thread: Optional[threading.Thread] = None
+        self._counters: Dict[str, int] = {
+            "published": 0,
+            "polls": 0,
+            "poll_failures": 0
+        }
+
+    def _start(self) -> None:
+        # with the lock held
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="job-events", daemon=True)
+            self._thread.start()
+
+    def subscribe(
+        self,
+        job_id: str,
+        loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> JobSubscription:
+        """start watching `job_id`, with the events so far
+            already waiting in the subscription
+
+        this has to be called from the event loop the
+        events will be taken in, unless `loop` is given
+        """
+
+        subscription = JobSubscription(
+            job_id, loop or asyncio.get_running_loop(), self.max_queue)
+        with self._lock:
+            history = self._history.get(job_id, ())
+            status = self._statuses.get(job_id)
+            if status is not None and status not in history:
+                subscription.put(status)
+            for event in history:
+                subscription.put(event)
+            self._subscribers.setdefault(job_id, set()).add(subscription)
+            self._start()
+        return subscription
+
+    def unsubscribe(self, subscription: JobSubscription) -> None:
+        """stop watching the job"""
+
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.job_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.job_id, None)
+
+    def _publish(self, event: JobEvent) -> None:
+        # with the lock held
+        history = self._history.get(event.job_id)
+        if history is None:
+            history = self._history[event.job_id] = deque(maxlen=self.history)
+            while len(self._history) > self.max_jobs:
+                old_job, _ = self._history.popitem(last=False)
+                self._statuses.pop(old_job, None)
+                self._published_at.pop(old_job, None)
+        self._history.move_to_end(event.job_id)
+        history.append(event)
+
+        for subscription in self._subscribers.get(event.job_id, ()):
+            subscription.put(event)
+        self._counters["published"] += 1
+
+    def publish_status(
+        self,
+        job_id: str,
+        status: JobStatus,
+        detail: Optional[str] = None,
+        as_of: Optional[float] = None
+    ) -> bool:
+        """tell watchers `job_id` is now in `status`, unless
+            that's what they were last told
+
+        if the status was looked up at `as_of` (a `time.monotonic()`),
+        it's ignored when something newer has been published since
+
+        Returns: bool - whether it was a change
+
+        """
+
+        with self._lock:
+            if as_of is not None and self._published_at.get(job_id, 0) > as_of:
+                return False
+            last = self._statuses.get(job_id)
+            if last is not None and last.status == status:
+                return False
+
+            event = JobEvent(job_id=job_id, event=JobEventType.status, time=datetime.now(),
+                             status=status, detail=detail, line=None)
+            self._publish(event)
+            self._statuses[job_id] = event
+            self._published_at[job_id] = time.monotonic()
+            return True
+
+    def publish_log(self, job_id: str, line: str) -> None:
+        """pass a line of `job_id`'s build log on to its watchers"""
+
+        with self._lock:
+            self._publish(JobEvent(
+                job_id=job_id, event=JobEventType.log, time=datetime.now(),
+                status=None, detail=None, line=line))
+
+    def poll(self) -> int:
+        """look up the jobs being watched that haven't
+            finished, and publish any that have changed
+
+        Returns: int - how many jobs had changed
+
+        """
+
+        with self._lock:
+            job_ids = [job_id for job_id in self._subscribers
+                       if job_id not in self._statuses
+                       or self._statuses[job_id].status not in FINISHED_STATUSES]
+        if not job_ids:
+            return 0
+
+        started = time.monotonic()
+        database = self._session_factory() if self._session_factory \
+            else beaver.db.db.session()
+        try:
+            statuses = get_job_statuses(database, job_ids)
+        finally:
+            database.close()
+
+        with self._lock:
+            self._counters["polls"] += 1
+
+        return sum(
+            self.publish_status(job_id, status, detail, started)
+            for job_id, (status, detail) in statuses.items()
+        )
+
+    def _run(self) -> None:
+        """poll for as long as anyone's watching (whoever starts
+            watching a job should publish its status then)
+        """
+
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+
+            try:
+                self.poll()
+            except Exception:  # pylint: disable=broad-except
+                with self._lock:
+                    self._counters["poll_failures"] += 1
+                logger.exception("failed to poll job statuses")
+
+    def stats(self) -> Dict[str, int]:
+        """return the broker counters"""
+        with self._lock:
+            return {
+                "watched_jobs": len(self._subscribers),
+                "watchers": sum(len(subs) for subs in self._subscribers.values()),
+                "jobs_with_history": len(self._history),
+                **self._counters
+            }
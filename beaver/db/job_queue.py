@@ -0,0 +1,285 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime, timedelta
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql.expression import ColumnElement
+
+from beaver.db.jobs import ACTIVE_STATUSES, FINISHED_STATUSES, PUBLISHED_STATUSES, Job
+from beaver.models.jobs import BuildStage, JobStatus
+
+logger = logging.getLogger(__name__)
+
+# for each stage, the status a job waits in for a builder,
+# and the status it's in whilst the builder holds its lease
+STAGE_STATUSES = {
+    BuildStage.definition: (JobStatus.Queued, JobStatus.BuildingDefinition),
+    BuildStage.image: (JobStatus.DefinitionMade, JobStatus.BuildingImage)
+}
+
+LEASED_STATUSES = tuple(x for _, x in STAGE_STATUSES.values())
+
+# moving a job to one of these gives up the lease on it
+RELEASED_STATUSES = (JobStatus.DefinitionMade,) + FINISHED_STATUSES
+
+# how many times a job is claimed for a stage before we give up on it
+MAX_ATTEMPTS = 3
+
+# how many jobs we look at to claim one, so a few
+# builders claiming at once don't all miss
+CLAIM_CANDIDATES = 5
+
+
+def _claimable(stage: BuildStage, now: datetime) -> ColumnElement:
+    """jobs waiting for `stage`, or whose builder for
+        `stage` has stopped renewing its lease
+
+    jobs waiting on another job's build are never claimed
+    """
+
+    waiting, leased = STAGE_STATUSES[stage]
+    return and_(Job.build_of.is_(None), or_(
+        Job.status == waiting,
+        and_(Job.status == leased, Job.lease_expires < now)
+    ))
+
+
+def _update_followers(database: Session, job_ids: List[str], values: Dict[Any, Any]) -> None:
+    """give jobs waiting on the builds of `job_ids` the same status,
+        unless they have to be given what the builds made first
+    """
+
+    status = next((v for k, v in values.items() if k.key == "status"), None)
+    if job_ids and status not in PUBLISHED_STATUSES:
+        database.query(Job).filter(Job.build_of.in_(job_ids)).update({
+            k: v for k, v in values.items()
+            if k.key not in {"lease_owner", "lease_expires", "attempts"}
+        }, synchronize_session=False)
+
+
+def reconcile_followers(database: Session, publish: Callable[[Job, JobStatus], None]) -> int:
+    """catch up jobs waiting on another job's build with its status
+
+    a job that joins a build copies its status when it's submitted,
+    so it misses any change the build makes before that commits. it
+    only takes one of `PUBLISHED_STATUSES` from here, once `publish`
+    has given it what the build has made under its own image name.
+    if the build's not there anymore (`publish` raises KeyError),
+    the job is built on its own instead
+
+    Returns: int - the number of jobs brought up to date
+
+    """
+
+    leader = aliased(Job)
+    stale = database.query(Job, leader.status, leader.detail, leader.endtime).join(
+        leader, Job.build_of == leader.job_id
+    ).filter(
+        # a finished build doesn't change again, so neither do its followers
+        Job.status.in_(ACTIVE_STATUSES),
+        leader.status != Job.status
+    ).all()
+
+    for follower, status, detail, endtime in stale:
+        values: Dict[Any, Any] = {Job.status: status, Job.endtime: endtime}
+        if detail is not None:
+            values[Job.detail] = detail
+
+        if status in PUBLISHED_STATUSES:
+            try:
+                publish(follower, status)
+            except KeyError:
+                values = {
+                    Job.build_of: None,
+                    Job.status: JobStatus.Queued,
+                    Job.detail: f"the build of job {follower.build_of} has gone, "
+                                "so building it again"
+                }
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("couldn't give job %s its build", follower.job_id)
+                continue
+
+        # unless someone else has caught it up already
+        database.query(Job).filter(
+            Job.job_id == follower.job_id, Job.status == follower.status
+        ).update(values, synchronize_session=False)
+    database.commit()
+
+    return len(stale)
+
+
+def fail_abandoned_jobs(database: Session, max_attempts: int = MAX_ATTEMPTS) -> int:
+    """fail jobs whose lease has run out `max_attempts` times,
+        rather than handing them to another builder to crash on
+
+    Returns: int - the number of jobs failed
+
+    """
+
+    now = datetime.now()
+    abandoned = [x for x, in database.query(Job.job_id).filter(
+        Job.status.in_(LEASED_STATUSES),
+        Job.lease_expires < now,
+        Job.attempts >= max_attempts
+    )]
+
+    if abandoned:
+        values: Dict[Any, Any] = {
+            Job.status: JobStatus.Failed,
+            Job.endtime: now,
+            Job.detail: f"abandoned after {max_attempts} attempts",
+            Job.lease_owner: None,
+            Job.lease_expires: None
+        }
+        database.query(Job).filter(Job.job_id.in_(abandoned)).update(
+            values, synchronize_session=False)
+        _update_followers(database, abandoned, values)
+    database.commit()
+
+    return len(abandoned)
+
+
+def claim_job(
+    database: Session,
+    worker: str,
+    stage: BuildStage = BuildStage.definition,
+    lease: float = 60,
+    max_attempts: int = MAX_ATTEMPTS
+) -> Optional[Job]:
+    """claim the job that's been waiting longest for `worker`
+        to build its `stage`
+
+    the job is leased to `worker` for `lease` seconds, which
+    it must keep renewing with `renew_lease`. once a lease runs
+    out, the job can be claimed by another builder.
+
+    claiming is a compare-and-set on the job's status and lease,
+    so two builders can never both claim a job. on databases that
+    support it, candidates are also locked with `FOR UPDATE SKIP
+    LOCKED`, so builders claiming at once pass over each other's jobs.
+
+    Args:
+        - database: Session - the database session to use
+        - worker: str - a unique name for the builder
+        - stage: BuildStage (default definition) - the stage it builds
+        - lease: float (default 60) - how long the lease lasts, in seconds
+        - max_attempts: int (default MAX_ATTEMPTS) - how many times
+            a job is claimed for a stage before it's failed instead
+
+    Returns: Optional[Job] - the claimed job, or None if there's nothing to build
+
+    """
+
+    fail_abandoned_jobs(database, max_attempts)
+
+    now = datetime.now()
+    candidates = [x for x, in database.query(Job.job_id).filter(
+        _claimable(stage, now)
+    ).order_by(Job.queuetime).limit(CLAIM_CANDIDATES).with_for_update(skip_locked=True)]
+
+    values: Dict[Any, Any] = {
+        Job.status: STAGE_STATUSES[stage][1],
+        Job.lease_owner: worker,
+        Job.lease_expires: now + timedelta(seconds=lease),
+        Job.attempts: Job.attempts + 1
+    }
+    if stage == BuildStage.definition:
+        values.update({Job.starttime: now, Job.endtime: None})
+
+    for job_id in candidates:
+        claimed = database.query(Job).filter(
+            Job.job_id == job_id, _claimable(stage, now)
+        ).update(values, synchronize_session=False)
+
+        if claimed:
+            database.commit()
+            return database.query(Job).filter(Job.job_id == job_id).one()
+
+    database.commit()
+    return None
+
+
+def _update_leased_job(
+    database: Session,
+    job_id: str,
+    worker: str,
+    values: Dict[Any, Any]
+) -> bool:
+    """update a job, only if `worker` still holds its lease, and
+        any jobs waiting on its build along with it
+    """
+
+    updated = database.query(Job).filter(
+        Job.job_id == job_id,
+        Job.lease_owner == worker,
+        Job.status.in_(LEASED_STATUSES)
+    ).update(values, synchronize_session=False)
+    if updated == 1 and any(x.key == "status" for x in values):
+        _update_followers(database, [job_id], values)
+    database.commit()
+
+    return updated == 1
+
+
+def renew_lease(database: Session, job_id: str, worker: str, lease: float = 60) -> bool:
+    """extend `worker`'s lease on a job for another `lease` seconds
+
+    Returns: bool - False if the lease has been lost, in which
+        case the worker should stop building the job
+
+    """
+
+    return _update_leased_job(database, job_id, worker, {
+        Job.lease_expires: datetime.now() + timedelta(seconds=lease)
+    })
+
+
+def set_leased_job_status(
+    database: Session,
+    job_id: str,
+    worker: str,
+    status: JobStatus,
+    detail: Optional[str] = None
+) -> bool:
+    """move a job `worker` holds the lease on to `status`
+
+    once the job's definition is made, the lease is given up so
+    an image builder can claim it. once the job is finished,
+    it's given an end time too.
+
+    Returns: bool - False if the lease has been lost, in
+        which case the status isn't changed
+
+    """
+
+    values: Dict[Any, Any] = {Job.status: status, Job.detail: detail}
+    if status in RELEASED_STATUSES:
+        values.update({Job.lease_owner: None, Job.lease_expires: None})
+    if status == JobStatus.DefinitionMade:
+        # the image stage gets its own attempts
+        values[Job.attempts] = 0
+    if status in FINISHED_STATUSES:
+        values[Job.endtime] = datetime.now()
+
+    return _update_leased_job(database, job_id, worker, values)
@@ -20,21 +20,24 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 import uuid
 
-from sqlalchemy import Column, Enum, ForeignKey, Integer, String, DateTime
+from sqlalchemy import (Column, Enum, ForeignKey, Index, Integer, String, DateTime,
+                        and_, case, func, insert, or_)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship, Session
 from sqlalchemy.orm.relationships import RelationshipProperty
 
+from beaver.db.caching import ExpiringCache
 from beaver.db.db import Base
 from beaver.db.groups import Group
 from beaver.db.images import Image, ImageContents
-from beaver.db.packages import Package, create_new_package
+from beaver.db.package_dependencies import get_packages_with_dependencies
+from beaver.db.packages import get_or_create_std_packages, package_set_hash
 from beaver.db.users import User
 import beaver.db.names
 from beaver.models.jobs import BuildRequest, JobStatus
-from beaver.models.packages import PackageBase, PackageType
 
 
 class Job(Base):
@@ -48,8 +51,25 @@ class Job(Base):
     starttime = Column(DateTime)
     endtime = Column(DateTime)
 
+    # for the builders claiming jobs, see `beaver.db.job_queue`
+    queuetime = Column(DateTime, nullable=False, default=datetime.now)
+    lease_owner = Column(String)
+    lease_expires = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+
+    # the job building the same packages, which this one waits on
+    build_of = Column(String, ForeignKey("jobs.job_id"))
+
     image: RelationshipProperty[Image] = relationship("Image")
 
+    __table_args__ = (
+        Index("jobs_status_endtime", "status", "endtime"),
+        Index("jobs_image_id", "image_id"),
+        Index("jobs_status_queuetime", "status", "queuetime"),
+        Index("jobs_status_lease_expires", "status", "lease_expires"),
+        Index("jobs_build_of", "build_of")
+    )
+
 
 def get_num_jobs_in_status(status: JobStatus, database: Session) -> int:
     """get number of jobs in the status `status`
@@ -83,6 +103,85 @@ def get_num_jobs_in_status_last_n_hours(
     ).count()
 
 
+# statuses a job stays in until it finishes, and statuses it finishes in
+ACTIVE_STATUSES = (JobStatus.Queued, JobStatus.BuildingDefinition,
+                   JobStatus.DefinitionMade, JobStatus.BuildingImage)
+FINISHED_STATUSES = (JobStatus.Succeeded, JobStatus.Failed)
+
+# statuses a job waiting on another's build only takes once it's been
+# given what the build made (by `beaver.db.job_queue.reconcile_followers`)
+PUBLISHED_STATUSES = (JobStatus.DefinitionMade, JobStatus.Succeeded)
+
+
+class JobCounts(NamedTuple):
+    """how many jobs there are in each status, and how many
+        were submitted recently, and reused another's build
+    """
+    statuses: Dict[JobStatus, int]
+    submitted: int
+    deduplicated: int
+
+
+# the counts for each number of hours
+_job_counts_cache: ExpiringCache[JobCounts] = ExpiringCache()
+
+
+def get_job_counts(
+    database: Session,
+    hours: int = 24,
+    ttl: float = 0
+) -> JobCounts:
+    """count the jobs in each active status, and the jobs that
+        finished in each finished status in the last `hours` hours,
+        along with the jobs submitted in that time, and how many of
+        those were deduplicated
+
+    this is one grouped query, using the (status, endtime)
+    index, rather than a count per status
+
+    Args:
+        - database: Session - the database session to use
+        - hours: int (default 24) - how far back to count finished jobs
+        - ttl: float (default 0) - how many seconds the counts can be
+            reused for, as the dashboards poll them often
+
+    Returns: JobCounts - the count for every status, and the submissions
+
+    """
+
+    if ttl > 0:
+        cached = _job_counts_cache.get(database, hours)
+        if cached is not None:
+            return cached
+
+    # anything submitted since `since` is either still active,
+    # or finished since then, so is counted in this too
+    since = datetime.now() - timedelta(hours=hours)
+    submitted = Job.queuetime > since
+
+    statuses: Dict[JobStatus, int] = {x: 0 for x in JobStatus}
+    total_submitted = total_deduplicated = 0
+    for status, count, n_submitted, n_deduplicated in database.query(
+        Job.status,
+        func.count(),
+        func.sum(case((submitted, 1), else_=0)),
+        func.sum(case((and_(submitted, Job.build_of.isnot(None)), 1), else_=0))
+    ).filter(or_(
+        Job.status.in_(ACTIVE_STATUSES),
+        and_(Job.status.in_(FINISHED_STATUSES), Job.endtime > since)
+    )).group_by(Job.status):
+        statuses[JobStatus(status)] = int(count)
+        total_submitted += int(n_submitted or 0)
+        total_deduplicated += int(n_deduplicated or 0)
+
+    counts = JobCounts(statuses, total_submitted, total_deduplicated)
+
+    if ttl > 0:
+        _job_counts_cache.put(database, counts, ttl, hours)
+
+    return counts
+
+
 def get_job(database: Session, job_id: str) -> Job:
     """return a particular job, identified by `job_id`
 
@@ -94,88 +193,135 @@ def get_job(database: Session, job_id: str) -> Job:
     return database.query(Job).filter(Job.job_id == job_id).one()
 
 
+def get_job_statuses(
+    database: Session,
+    job_ids: Iterable[str]
+) -> Dict[str, Tuple[JobStatus, Optional[str]]]:
+    """return the status and detail of each of the jobs
+        in `job_ids` that exist, in one query
+    """
+
+    return {
+        job_id: (status, detail)
+        for job_id, status, detail in database.query(
+            Job.job_id, Job.status, Job.detail
+        ).filter(Job.job_id.in_(list(job_ids)))
+    }
+
+
+def find_build_for_hash(database: Session, content_hash: str) -> Optional[Job]:
+    """find the latest job that has built, or is building, an image
+        with the packages that hash to `content_hash`
+    """
+
+    return database.query(Job).join(Job.image).filter(
+        Image.content_hash == content_hash,
+        Job.build_of.is_(None),
+        Job.status != JobStatus.Failed
+    ).order_by(Job.queuetime.desc()).first()
+
+
+# how many generated image names to try, if someone
+# else takes the one we picked before we can
+IMAGE_NAME_ATTEMPTS = 3
+
+
 def submit_job(database: Session, build: BuildRequest) -> Job:
-    """create a new job and associated image and packages"""
+    """create a new job and associated image and packages
+
+    it's all one transaction, so if anything goes wrong
+    nothing is left behind
 
-    _request = build.dict()
+    Raises:
+        ValueError: if the image name is taken, or there
+            are no names left to generate one
+    """
+
+    _user, _group = build.image.user_name, build.image.group_name
+
+    for _ in range(IMAGE_NAME_ATTEMPTS):
+        # We need to generate an image name if it isn't provided
+        image_name: str
+        if build.image.image_name:
+            image_name = f"{_user}-{_group}-{build.image.image_name}"
+            if not beaver.db.names.check_image_name(database, image_name):
+                raise ValueError(f"image name {image_name} already exists")
+        else:
+            image_name = beaver.db.names.generate_random_image_name(database, _user, _group)
+
+        try:
+            job = _add_job(database, build, image_name)
+            database.commit()
+            return job
+
+        except IntegrityError as err:
+            database.rollback()
+            # the name's unique, so someone might have beaten us to it
+            if beaver.db.names.check_image_name(database, image_name):
+                raise
+            if build.image.image_name:
+                raise ValueError(f"image name {image_name} already exists") from err
+
+        except Exception:
+            database.rollback()
+            raise
+
+    raise ValueError(f"couldn't find an unused image name for {_user} in {_group}")
+
+
+def _add_job(database: Session, build: BuildRequest, image_name: str) -> Job:
+    """add the job, image and packages for `build`,
+        without committing them
+    """
 
     # First we're going to make the Image object
     # This requires turning the user and group names
     # provided into their respective IDs
-    # We also need to generate an image name if it isn't
-    # provided
-
-    _user = _request["image"]["user_name"]
-    _group = _request["image"]["group_name"]
+    user_id: int = User.get_or_make_user_id_for_user_name(
+        build.image.user_name, database, commit=False)
+    group_id: int = Group.get_or_make_group_id_for_group_name(
+        build.image.group_name, database, commit=False)
 
-    user_id: int = User.get_or_make_user_id_for_user_name(_user, database)
-    group_id: int = Group.get_or_make_group_id_for_group_name(_group, database)
-
-    def _image_name() -> str:
-        _name = f"{_user}-{_group}-{_request['image']['image_name']}"
-        if beaver.db.names.check_image_name(database, _name):
-            return _name
-        raise ValueError(f"image name {_name} already exists")
+    # Add New Packages
+    # Currently, this is just nix stuff
+    package_ids: List[int] = list(dict.fromkeys(
+        build.packages + get_or_create_std_packages(database, build.new_packages)))
 
-    image_name: str = beaver.db.names.generate_random_image_name(
-        database, _user, _group) if not _request["image"].get("image_name") else _image_name()
+    # If these packages (and what they depend on) have already been
+    # built, or are being built, we'll wait for that rather than
+    # building them again
+    content_hash = package_set_hash(get_packages_with_dependencies(database, package_ids))
+    build_of: Optional[Job] = find_build_for_hash(database, content_hash)
 
-    # We can now add it to the DB
+    # We can now add it to the DB, with all its packages at once
     new_image = Image(
         image_name=image_name,
         user_id=user_id,
-        group_id=group_id
+        group_id=group_id,
+        content_hash=content_hash
     )
-
     database.add(new_image)
-    database.commit()
-    database.refresh(new_image)
-    image_id: int = int(new_image.image_id)
+    database.flush()
 
-    # Add New Packages
-    # Currently, this is just nix stuff
-    # Now, why did I make that decision three weeks ago?
-    # I'm not sure.
-    # Past Michael bad.
-
-    package_ids: List[int] = build.packages
-
-    for _new_package in build.new_packages:
-        _new_package_obj: Package = create_new_package(database, PackageBase(
-            package_name=_new_package,
-            commonly_used=False,
-            package_type=PackageType.std,
-            package_version=None,
-            github_filename=None,
-            github_package=None
-        ))
-
-        package_ids.append(int(_new_package_obj.package_id))
-
-    # Now we've got all our packages, we can add all the packages
-    for package_id in package_ids:
-        _new_contents = ImageContents(
-            image_id=image_id,
-            package_id=package_id
-        )
-        database.add(_new_contents)
-    database.commit()
+    if package_ids:
+        database.execute(insert(ImageContents), [
+            {"image_id": new_image.image_id, "package_id": package_id}
+            for package_id in package_ids
+        ])
 
     # Now we can actually create the job
-    # Let's give it an ID
-    _job_uuid: str = str(uuid.uuid4())
-    while True:
-        if database.query(Job).filter(Job.job_id == _job_uuid).count() == 0:
-            break
-        _job_uuid = str(uuid.uuid4())
-
+    # (there's no need to check a random UUID is unique)
     job: Job = Job(
-        job_id=_job_uuid,
-        image_id=image_id
+        job_id=str(uuid.uuid4()),
+        image_id=new_image.image_id
     )
 
-    database.add(job)
-    database.commit()
-    database.refresh(job)
+    if build_of is not None:
+        job.build_of = build_of.job_id
+        job.detail = f"same packages as job {build_of.job_id}"
+        job.starttime = datetime.now()
+        if build_of.status not in PUBLISHED_STATUSES:
+            job.status = build_of.status
 
+    database.add(job)
     return job
@@ -18,11 +18,15 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from itertools import islice
+import math
 import random
+from typing import Iterator, List, Set, Tuple
 
 from sqlalchemy import Column, String
 from sqlalchemy.orm import Session
 
+from beaver.db.caching import ExpiringCache
 from beaver.db.images import Image
 from beaver.db.db import Base
 from beaver.models.names import ImageNameElements
@@ -63,6 +67,7 @@ def create_names(database: Session, item: ImageNameElements) -> ImageNameElement
         database.add(db_name_item)
 
     database.commit()
+    name_allocator.invalidate()
     return item
 
 
@@ -81,11 +86,109 @@ def check_image_name(database: Session, name: str) -> bool:
     return database.query(Image).filter(Image.image_name == name).count() == 0
 
 
+class ImageNamesExhausted(ValueError):
+    """raised when every name has already been used"""
+
+
+def _random_walk(size: int) -> Iterator[int]:
+    """every number below `size` once, in a random order, without listing
+        them - from a random start, in steps that share no factor with `size`
+    """
+
+    if size == 0:
+        return
+    start, step = random.randrange(size), 1
+    if size > 2:
+        step = random.randrange(1, size)
+        while math.gcd(step, size) != 1:
+            step = random.randrange(1, size)
+
+    for i in range(size):
+        yield (start + i * step) % size
+
+
+class ImageNameAllocator:
+    """picks names for images, from the adjectives and names in
+        the database, that aren't in use for the user and group
+
+    the adjectives and names are kept in memory for `ttl` seconds.
+    the pairs of them are walked in a random order, by number, so
+    every pair is reached once without listing them. candidates are
+    looked up by `images.image_name`, which is unique, a few at a time
+    at first, so a name usually takes one query however many the user
+    and group have. if someone else takes the same name in the meantime,
+    their insert or ours fails
+    """
+
+    # how many candidates are looked up at first, and at most -
+    # the batches double in between, so it doesn't take long to
+    # find out they've all been used
+    FIRST_BATCH = 8
+    MAX_BATCH = 512
+
+    def __init__(self, ttl: float = 300) -> None:
+        self.ttl = ttl
+        # the adjectives and names
+        self._elements: ExpiringCache[Tuple[List[str], List[str]]] = ExpiringCache()
+
+    def invalidate(self) -> None:
+        """forget the adjectives and names, so they're
+            loaded again next time
+        """
+        self._elements.clear()
+
+    def _get_elements(self, database: Session) -> Tuple[List[str], List[str]]:
+        cached = self._elements.get(database)
+        if cached is not None:
+            return cached
+
+        elements = get_names(database)
+        adjectives = sorted(set(elements.adjectives))
+        names = sorted(set(elements.names))
+        self._elements.put(database, (adjectives, names), self.ttl)
+        return adjectives, names
+
+    def allocate(self, database: Session, user: str, group: str) -> str:
+        """pick a name for an image for `user` and `group`
+
+        Returns: str - the image name, `user-group-adjective-name`
+
+        Raises:
+            ImageNamesExhausted: if the user and group
+                have used every name already
+        """
+
+        adjectives, names = self._get_elements(database)
+        prefix = f"{user}-{group}-"
+
+        def _candidate(i: int) -> str:
+            return f"{prefix}{adjectives[i // len(names)]}-{names[i % len(names)]}"
+
+        pairs = len(adjectives) * len(names)
+        walk = map(_candidate, _random_walk(pairs))
+        batch = self.FIRST_BATCH
+        candidates = list(islice(walk, batch))
+        while candidates:
+            used: Set[str] = {str(x) for x, in database.query(Image.image_name).filter(
+                Image.image_name.in_(candidates))}
+            for candidate in candidates:
+                if candidate not in used:
+                    return candidate
+            batch = min(batch * 2, self.MAX_BATCH)
+            candidates = list(islice(walk, batch))
+
+        raise ImageNamesExhausted(
+            f"all {pairs} image names have been used by {user} in {group}")
+
+
+name_allocator = ImageNameAllocator()
+
+
 def generate_random_image_name(database: Session, user: str, group: str) -> str:
     """generate a name for an image
 
     this will use the adjectives and names in the DB, along with the username
-    and group name to produce one
+    and group name to produce one, see `ImageNameAllocator`
 
     Args:
         - database: Session - the database session to use
@@ -94,18 +197,9 @@ def generate_random_image_name(database: Session, user: str, group: str) -> str:
 
     Returns: str - the newly created image name
 
-    """
-
-    _elements = get_names(database)
-    _adj = random.choice(_elements.adjectives)
-    _name = random.choice(_elements.names)
+    Raises:
+        ImageNamesExhausted: if there are no names left
 
-    # we need to make sure this isn't already in the DB
-    # yes, this can go into an infinite loop if every
-    # possibility is already used
+    """
 
-    # TODO: can we not have infinite loop?
-    while True:
-        candidate: str = f"{user}-{group}-{_adj}-{_name}"
-        if check_image_name(database, candidate):
-            return candidate
+    return name_allocator.allocate(database, user, group)
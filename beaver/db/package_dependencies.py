@@ -0,0 +1,275 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+import logging
+import threading
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import selectinload, Session
+
+from beaver.db.caching import TableWatcher
+from beaver.db.packages import Package, PackageDependency
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyCycle(ValueError):
+    """a dependency would make a package depend on itself"""
+
+    def __init__(self, cycle: List[int]) -> None:
+        super().__init__("dependency cycle: " + " -> ".join(str(x) for x in cycle))
+        self.cycle = cycle
+
+
+def _walk(adjacency: Dict[int, Tuple[int, ...]], start: Iterable[int]) -> Set[int]:
+    """everything reachable from `start` (included), without recursing,
+        so deep chains and cycles are fine
+    """
+
+    seen = set(start)
+    stack = list(seen)
+    while stack:
+        for nxt in adjacency.get(stack.pop(), ()):
+            if nxt not in seen:
+                seen.add(nxt)
+                stack.append(nxt)
+    return seen
+
+
+class DependencyGraph:
+    """the package dependencies, as adjacency lists both ways, so
+        closures are worked out in memory rather than a query per level
+
+    a graph never changes once it's made (a new one is loaded when
+    the dependencies do), so closures are cached per set of packages,
+    up to `max_closures` of them
+    """
+
+    def __init__(self, edges: Iterable[Tuple[int, int]], max_closures: int = 1024) -> None:
+        dependencies: Dict[int, Set[int]] = {}
+        dependents: Dict[int, Set[int]] = {}
+        for package_id, dependency_id in edges:
+            dependencies.setdefault(package_id, set()).add(dependency_id)
+            dependents.setdefault(dependency_id, set()).add(package_id)
+
+        # sorted, so walks (and the cycles we find) are the same every time
+        self._dependencies = {k: tuple(sorted(v)) for k, v in dependencies.items()}
+        self._dependents = {k: tuple(sorted(v)) for k, v in dependents.items()}
+        self.edges = sum(len(x) for x in self._dependencies.values())
+
+        self.max_closures = max_closures
+        self._closures: OrderedDict[Tuple[bool, FrozenSet[int]], FrozenSet[int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {"hits": 0, "misses": 0}
+
+    def _cached_walk(self, reverse: bool, package_ids: Iterable[int]) -> FrozenSet[int]:
+        key = (reverse, frozenset(package_ids))
+        with self._lock:
+            cached = self._closures.get(key)
+            if cached is not None:
+                self._closures.move_to_end(key)
+                self._counters["hits"] += 1
+                return cached
+            self._counters["misses"] += 1
+
+        result = frozenset(_walk(self._dependents if reverse else self._dependencies, key[1]))
+        with self._lock:
+            self._closures[key] = result
+            while len(self._closures) > self.max_closures:
+                self._closures.popitem(last=False)
+        return result
+
+    def closure(self, package_ids: Iterable[int]) -> FrozenSet[int]:
+        """the packages, and everything they depend on, all the way down"""
+        return self._cached_walk(False, package_ids)
+
+    def dependents(self, package_ids: Iterable[int]) -> FrozenSet[int]:
+        """the packages, and everything that depends on them, all the way up"""
+        return self._cached_walk(True, package_ids)
+
+    def path(self, start: int, goal: int) -> Optional[List[int]]:
+        """the shortest chain of dependencies from `start` to `goal`,
+            if `start` depends on `goal` at all
+        """
+
+        parents: Dict[int, Optional[int]] = {start: None}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            if current == goal:
+                path = [current]
+                while parents[path[-1]] is not None:
+                    path.append(parents[path[-1]])  # type: ignore
+                return path[::-1]
+            for nxt in self._dependencies.get(current, ()):
+                if nxt not in parents:
+                    parents[nxt] = current
+                    queue.append(nxt)
+        return None
+
+    def find_cycle(self) -> Optional[List[int]]:
+        """a cycle in the dependencies, starting and ending with the
+            same package, if there is one
+        """
+
+        done: Set[int] = set()
+        for root in self._dependencies:
+            if root in done:
+                continue
+            # the packages on the current path, and where we're up
+            # to in each of their dependencies
+            on_path: Dict[int, int] = {root: 0}
+            stack: List[Tuple[int, int]] = [(root, 0)]
+            while stack:
+                package, i = stack[-1]
+                children = self._dependencies.get(package, ())
+                if i == len(children):
+                    stack.pop()
+                    del on_path[package]
+                    done.add(package)
+                    continue
+                stack[-1] = (package, i + 1)
+                child = children[i]
+                if child in on_path:
+                    return [x for x, _ in stack[on_path[child]:]] + [child]
+                if child not in done:
+                    on_path[child] = len(stack)
+                    stack.append((child, 0))
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        """return the graph's size and closure cache counters"""
+        with self._lock:
+            return {
+                "packages": len(self._dependencies.keys() | self._dependents.keys()),
+                "edges": self.edges,
+                "closures": len(self._closures),
+                **self._counters
+            }
+
+
+class DependencyGraphCache(TableWatcher):
+    """keeps the dependency graph loaded, loading it again when
+        dependencies are added with this module, or when the number
+        or highest ID of them changes (checked at most every
+        `check_interval` seconds, for ones added by other processes)
+    """
+
+    def __init__(self, check_interval: float = 5, max_closures: int = 1024) -> None:
+        super().__init__((PackageDependency.package_dependency_id,), check_interval)
+        self.max_closures = max_closures
+
+        self._graph: Optional[DependencyGraph] = None
+        self._counters: Dict[str, int] = {"loads": 0, "cyclic": 0}
+
+    def invalidate(self) -> None:
+        """load the graph again next time it's asked for"""
+        with self._lock:
+            self._graph = None
+
+    def get(self, database: Session, fresh: bool = False) -> DependencyGraph:
+        """get the dependency graph of the packages in `database`,
+            checking it's up to date first if `fresh`
+        """
+
+        changed = self._changed(database, fresh)
+        with self._lock:
+            graph = self._graph
+        if graph is not None and not changed:
+            return graph
+
+        try:
+            graph = DependencyGraph(database.query(
+                PackageDependency.package_id, PackageDependency.dependency_id
+            ).filter(
+                PackageDependency.package_id.isnot(None),
+                PackageDependency.dependency_id.isnot(None)
+            ).all(), self.max_closures)
+        except Exception:
+            # so it's loaded again next time
+            with self._lock:
+                self._forget()
+            raise
+
+        # closures still work with a cycle, they just include
+        # everything on it, but something's wrong somewhere
+        cycle = graph.find_cycle()
+        if cycle is not None:
+            logger.warning("package dependencies have a cycle: %s",
+                           " -> ".join(str(x) for x in cycle))
+
+        with self._lock:
+            self._graph = graph
+            self._counters["loads"] += 1
+            self._counters["cyclic"] = int(cycle is not None)
+        return graph
+
+    def stats(self) -> Dict[str, int]:
+        """return the loaded graph's stats, and how often it's been loaded"""
+        with self._lock:
+            graph = self._graph
+            counters = dict(self._counters)
+        return {**(graph.stats() if graph is not None else {}), **counters}
+
+
+dependency_graph = DependencyGraphCache()
+
+
+def add_package_dependency(
+    database: Session,
+    package_id: int,
+    dependency_id: int
+) -> PackageDependency:
+    """record that `package_id` depends on `dependency_id`
+
+    Raises:
+        DependencyCycle: if `dependency_id` already depends on
+            `package_id`, or they're the same package
+    """
+
+    path = dependency_graph.get(database, fresh=True).path(dependency_id, package_id)
+    if path is not None:
+        raise DependencyCycle([package_id] + path)
+
+    db_dependency = PackageDependency(package_id=package_id, dependency_id=dependency_id)
+    database.add(db_dependency)
+    database.commit()
+    database.refresh(db_dependency)
+    dependency_graph.invalidate()
+    return db_dependency
+
+
+def get_packages_with_dependencies(
+    database: Session,
+    package_ids: Iterable[int]
+) -> List[Package]:
+    """get the packages, and everything they depend on, in
+        one query, ordered by ID
+    """
+
+    closure = dependency_graph.get(database).closure(package_ids)
+    if not closure:
+        return []
+    return database.query(Package).filter(
+        Package.package_id.in_(closure)
+    ).options(selectinload(Package.github_package)).order_by(Package.package_id).all()
@@ -20,13 +20,24 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 
-from typing import List
-from sqlalchemy import Column, ForeignKey, Integer, String, Enum, Boolean
-from sqlalchemy.orm import relationship, Session
+from collections import OrderedDict
+import hashlib
+import json
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from sqlalchemy import (Boolean, Column, Enum, ForeignKey, Index, Integer, String,
+                        func, insert)
+from sqlalchemy.orm import relationship, selectinload, Session
 from sqlalchemy.orm.relationships import RelationshipProperty
 
+from beaver.db.caching import TableWatcher
 from beaver.db.db import Base
-from beaver.models.packages import PackageBase, PackageType
+from beaver.db.images import ImageContents
+from beaver.db.pagination import Page, paginate
+from beaver.models.packages import (ImportedPackage, PackageBase, PackageImportResult,
+                                    PackageList, PackageRequest, PackageType)
+import beaver.models.packages
+from beaver.models.pagination import PageRequest
 
 
 class Package(Base):
@@ -44,6 +55,8 @@ class Package(Base):
     github_package: RelationshipProperty[GitHubPackage] = relationship(
         "GitHubPackage", back_populates="package", uselist=False)
 
+    __table_args__ = (Index("packages_package_name", "package_name"),)
+
 
 class GitHubPackage(Base):
     """represents a package being pulled from GitHub"""
@@ -58,6 +71,8 @@ class GitHubPackage(Base):
     package: RelationshipProperty[Package] = relationship(
         "Package", back_populates="github_package", foreign_keys=[package_id])
 
+    __table_args__ = (Index("github_packages_package_id", "package_id"),)
+
 
 class PackageDependency(Base):
     """links to packages as a dependency"""
@@ -72,10 +87,298 @@ class PackageDependency(Base):
     dependency: RelationshipProperty[Package] = relationship(
         "Package", foreign_keys=[dependency_id])
 
+    __table_args__ = (
+        Index("package_dependencies_package_id", "package_id"),
+        Index("package_dependencies_dependency_id", "dependency_id")
+    )
+
+
+def get_all_pacakges(
+    database: Session,
+    page: Optional[PageRequest] = None,
+    package_type: Optional[PackageType] = None,
+    commonly_used: Optional[bool] = None,
+    name: Optional[str] = None
+) -> Page[Package]:
+    """gets a page of the pacakges available, sorted by
+        `package_id` or `package_name`
+
+    Args:
+        - database: Session - the database session to use
+        - page: Optional[PageRequest] - which page (default: the first)
+        - package_type: Optional[PackageType] - only this type of package
+        - commonly_used: Optional[bool] - only packages (not) commonly used
+        - name: Optional[str] - only packages whose name starts with this
+
+    Returns: Page[Package] - the packages and the cursor for the next page
+
+    """
+
+    query = database.query(Package).options(selectinload(Package.github_package))
+    if package_type is not None:
+        query = query.filter(Package.package_type == package_type)
+    if commonly_used is not None:
+        query = query.filter(Package.commonly_used == commonly_used)
+    if name:
+        query = query.filter(Package.package_name.startswith(name, autoescape=True))
+
+    return paginate(query, page or PageRequest(), {
+        "package_id": Package.package_id,
+        "package_name": Package.package_name
+    }, Package.package_id)
+
+
+class CatalogPage(NamedTuple):
+    """a page of the package catalog, ready to send"""
+    body: bytes
+    etag: str
+    next_cursor: Optional[str]
+
+
+class PackageCatalog(TableWatcher):
+    """keeps the pages of the package catalog that have been asked
+        for, already serialised, so asking again doesn't touch the
+        database
+
+    they're all thrown away when packages are added with this module,
+    or when the number or highest ID of packages or GitHub packages
+    changes (checked at most every `check_interval` seconds, for
+    packages added by other processes). pages are also dropped after
+    `max_age` seconds, in case packages are changed in place
+    """
+
+    def __init__(
+        self,
+        max_pages: int = 256,
+        check_interval: float = 5,
+        max_age: float = 300
+    ) -> None:
+        super().__init__((Package.package_id, GitHubPackage.github_package_id), check_interval)
+        self.max_pages = max_pages
+        self.max_age = max_age
+
+        self._pages: OrderedDict[Tuple, Tuple[float, CatalogPage]] = OrderedDict()
+        # bumped whenever the pages are thrown away, so a page
+        # made from older packages isn't kept
+        self._generation = 0
+        self._counters: Dict[str, int] = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def invalidate(self) -> None:
+        """throw away all the pages"""
+        with self._lock:
+            self._clear()
+            self._recheck()
+
+    def _clear(self) -> None:
+        # with the lock held
+        self._pages.clear()
+        self._generation += 1
+        self._counters["invalidations"] += 1
+
+    def _check(self, database: Session) -> None:
+        """throw away the pages if they're from another database,
+            or the packages have changed since they were made
+        """
+
+        if self._changed(database):
+            with self._lock:
+                self._clear()
+
+    def get_page(  # pylint: disable=too-many-arguments
+        self,
+        database: Session,
+        page: Optional[PageRequest] = None,
+        package_type: Optional[PackageType] = None,
+        commonly_used: Optional[bool] = None,
+        name: Optional[str] = None
+    ) -> CatalogPage:
+        """get a page of packages, as `get_all_pacakges` would,
+            from the catalog if we have it
+
+        Raises:
+            ValueError: if the sort field, limit or cursor are invalid
+        """
+
+        page = page or PageRequest()
+        key = (page.limit, page.after, page.sort, page.order,
+               package_type, commonly_used, name)
+
+        self._check(database)
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            cached = self._pages.get(key)
+            if cached is not None and cached[0] > now:
+                self._pages.move_to_end(key)
+                self._counters["hits"] += 1
+                return cached[1]
+            self._counters["misses"] += 1
+
+        result = get_all_pacakges(database, page, package_type, commonly_used, name)
+        body = PackageList(__root__=[
+            beaver.models.packages.Package.from_orm(x) for x in result.items
+        ]).json().encode("utf-8")
+        catalog_page = CatalogPage(
+            body, f'"{hashlib.sha256(body).hexdigest()[:32]}"', result.next_cursor)
+
+        with self._lock:
+            if generation == self._generation:
+                self._pages[key] = (now + self.max_age, catalog_page)
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+
+        return catalog_page
+
+    def stats(self) -> Dict[str, int]:
+        """return the catalog counters"""
+        with self._lock:
+            return {"pages": len(self._pages), **self._counters}
+
+
+package_catalog = PackageCatalog()
+
+
+def package_set_hash(packages: Iterable[Package]) -> str:
+    """a canonical hash of a set of packages, which is the
+        same for any two sets that would build the same image
+
+    it covers each package's type, name and version, and
+    where it comes from on GitHub, down to the commit, but
+    not its ID, so the same package added twice hashes the same
+
+    Args:
+        - packages: Iterable[Package] - the packages to hash
+
+    Returns: str - the SHA-256 hex digest
+
+    """
+
+    def _identity(package: Package) -> str:
+        github: Optional[GitHubPackage] = package.github_package
+        return json.dumps([
+            PackageType(package.package_type).value,
+            package.package_name,
+            package.package_version,
+            package.github_filename,
+            None if github is None else [
+                github.github_user, github.repository_name, github.commit_hash]
+        ])
+
+    return hashlib.sha256(json.dumps(
+        sorted({_identity(x) for x in packages})).encode()).hexdigest()
+
+
+def get_packages_for_image(database: Session, image_id: int) -> List[Package]:
+    """gets the packages that go in the image"""
+    return database.query(Package).join(
+        ImageContents, ImageContents.package_id == Package.package_id
+    ).filter(ImageContents.image_id == image_id).all()
+
+
+# the most names we'll look up, or packages we'll add, in one statement
+PACKAGE_BATCH_SIZE = 500
+
+
+def get_or_create_packages(
+    database: Session,
+    packages: Iterable[PackageRequest]
+) -> List[Tuple[int, bool]]:
+    """get the IDs of the packages with each name, version and
+        type (that aren't from a GitHub file), looking them all
+        up at once and adding the ones we haven't got with
+        multi-row inserts
+
+    nothing is committed, so the new packages go in with
+    whatever transaction they're part of
+
+    Returns: List[Tuple[int, bool]] - the package IDs, and whether
+        each was added, in the order of `packages`
+
+    """
+
+    keys = [(x.type, x.name, x.version) for x in packages]
+    if not keys:
+        return []
+
+    def _existing(names: List[str]) -> Dict[Tuple, int]:
+        found: Dict[Tuple, int] = {}
+        for i in range(0, len(names), PACKAGE_BATCH_SIZE):
+            # highest ID first, so the oldest package of a kind wins
+            for package_id, package_type, name, version in database.query(
+                Package.package_id, Package.package_type,
+                Package.package_name, Package.package_version
+            ).filter(
+                Package.package_name.in_(names[i:i + PACKAGE_BATCH_SIZE]),
+                Package.github_filename.is_(None)
+            ).order_by(Package.package_id.desc()):
+                found[(PackageType(package_type), name, version)] = int(package_id)
+        return found
+
+    package_ids = _existing(list(dict.fromkeys(name for _, name, _ in keys)))
+    missing = [x for x in dict.fromkeys(keys) if x not in package_ids]
+    if missing:
+        rows = [{
+            "package_type": package_type,
+            "package_name": name,
+            "package_version": version,
+            "commonly_used": False
+        } for package_type, name, version in missing]
+        for i in range(0, len(rows), PACKAGE_BATCH_SIZE):
+            database.execute(insert(Package).values(rows[i:i + PACKAGE_BATCH_SIZE]))
+        package_ids.update(_existing(list(dict.fromkeys(name for _, name, _ in missing))))
+        package_catalog.invalidate()
+
+    added = set(missing)
+    return [(package_ids[x], x in added) for x in keys]
+
+
+def get_or_create_std_packages(database: Session, package_names: Iterable[str]) -> List[int]:
+    """get the IDs of the plain Nix packages named `package_names`,
+        adding the ones we haven't got in one insert
+
+    nothing is committed, so the new packages go in with
+    whatever transaction they're part of
+
+    Returns: List[int] - the package IDs, in the order of the names
+
+    """
+
+    return [package_id for package_id, _ in get_or_create_packages(
+        database, [PackageRequest(name=x) for x in dict.fromkeys(package_names)])]
+
+
+def import_packages(
+    database: Session,
+    packages: Iterable[PackageRequest]
+) -> PackageImportResult:
+    """import the packages in a Package Request File, adding the
+        ones we haven't got, all in one transaction
+
+    Returns: PackageImportResult - each package's ID, in the order
+        they were given, and how many were added
+
+    """
+
+    requests = list(packages)
+    package_ids = get_or_create_packages(database, requests)
+    database.commit()
+
+    imported = [
+        ImportedPackage(**request.dict(), package_id=package_id, created=created)
+        for request, (package_id, created) in zip(requests, package_ids)
+    ]
+    return PackageImportResult(
+        packages=imported, created=len({x.package_id for x in imported if x.created}))
+
 
-def get_all_pacakges(database: Session) -> List[Package]:
-    """gets all pacakges available"""
-    return database.query(Package).all()
+def get_package_boosts(database: Session) -> Dict[str, bool]:
+    """get the names of the packages we've got, and whether
+        any package of that name is commonly used, for
+        ranking package search results
+    """
+    return {str(name): bool(commonly_used) for name, commonly_used in database.query(
+        Package.package_name, func.max(Package.commonly_used)
+    ).group_by(Package.package_name)}
 
 
 def create_new_package(database: Session, package: PackageBase) -> Package:
@@ -99,4 +402,5 @@ def create_new_package(database: Session, package: PackageBase) -> Package:
         database.refresh(gh_package)
         database.refresh(db_package)
 
+    package_catalog.invalidate()
     return db_package
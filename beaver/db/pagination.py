@@ -0,0 +1,145 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+import base64
+from datetime import datetime
+import json
+from typing import Any, Dict, Generic, List, Optional, TypeVar
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+
+from beaver.models.pagination import MAX_PAGE_SIZE, PageRequest, SortOrder
+
+T = TypeVar("T")
+
+
+class Page(Generic[T]):
+    """a page of results, with the cursor for the
+        next page if there is one
+    """
+
+    def __init__(self, items: List[T], next_cursor: Optional[str]) -> None:
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value["datetime"])
+    return value
+
+
+def encode_cursor(*values: Any) -> str:
+    """turn the sort values of the last row of a
+        page into an opaque cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(
+        [_encode_value(x) for x in values]).encode("UTF-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """get the sort values back out of a cursor
+
+    Raises:
+        ValueError: if the cursor isn't one we made
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(values, list):
+            raise ValueError
+        return [_decode_value(x) for x in values]
+    except (ValueError, KeyError, TypeError, UnicodeError) as err:
+        raise ValueError(f"invalid cursor {cursor!r}") from err
+
+
+def paginate(
+    query: Query,
+    page: PageRequest,
+    sort_columns: Dict[str, InstrumentedAttribute],
+    key_column: InstrumentedAttribute
+) -> Page:
+    """get a page of `query` using keyset pagination
+
+    rather than an OFFSET, which gets slower the further in you
+    go, each page carries on from the sort value (and `key_column`,
+    to break ties) of the last row of the previous page
+
+    Args:
+        - query: Query - the query to get a page of
+        - page: PageRequest - which page is wanted, and how to sort
+        - sort_columns: Dict[str, InstrumentedAttribute] - the columns
+            that can be sorted by, the first being the default
+        - key_column: InstrumentedAttribute - a unique column to break ties
+
+    Returns: Page - the results, and the cursor for the next page
+
+    Raises:
+        ValueError: if the sort field, limit or cursor are invalid
+
+    """
+
+    if not 1 <= page.limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    sort_name = page.sort or next(iter(sort_columns))
+    if sort_name not in sort_columns:
+        raise ValueError(
+            f"can't sort by {sort_name}, options are {', '.join(sort_columns)}")
+
+    sort_column = sort_columns[sort_name]
+    descending = page.order == SortOrder.desc
+
+    if page.after is not None:
+        if sort_column is key_column:
+            (last_key,) = decode_cursor(page.after)
+            query = query.filter(
+                key_column < last_key if descending else key_column > last_key)
+        else:
+            last_sort, last_key = decode_cursor(page.after)
+            query = query.filter(or_(
+                sort_column < last_sort if descending else sort_column > last_sort,
+                and_(
+                    sort_column == last_sort,
+                    key_column < last_key if descending else key_column > last_key
+                )
+            ))
+
+    order_by = [sort_column] if sort_column is key_column else [sort_column, key_column]
+    items = query.order_by(
+        *[x.desc() if descending else x.asc() for x in order_by]
+    ).limit(page.limit + 1).all()
+
+    next_cursor: Optional[str] = None
+    if len(items) > page.limit:
+        items = items[:page.limit]
+        next_cursor = encode_cursor(
+            *[getattr(items[-1], x.key) for x in order_by])
+
+    return Page(items, next_cursor)
@@ -0,0 +1,284 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+import beaver.db.db
+from beaver.db.image_usage import record_image_usages
+from beaver.models.image_usage import ImageUsageBase
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# a pending image usage, and when it happened
+_Usage = Tuple[ImageUsageBase, datetime]
+
+
+class UsageBufferFull(Exception):
+    """raised when the buffer has been full for longer
+        than we're willing to wait
+    """
+
+
+class ImageUsageBuffer:  # pylint: disable=too-many-instance-attributes
+    """buffers image usage events in memory, writing them to the
+        database in the background with multi-row inserts
+
+    a batch is written when `max_batch` events are waiting, or when
+    the oldest waiting event is `flush_interval` seconds old. at most
+    `max_queue` events are held, after which `record` waits up to
+    `put_timeout` seconds for space before giving up, so a slow
+    database pushes back on callers rather than eating memory
+
+    if the database can't be reached, the batch is tried again,
+    waiting `retry_interval` seconds at first and doubling up to
+    `max_retry_interval`, and nothing more is taken off the queue, so
+    callers are pushed back on rather than usage being lost. if the
+    database refuses the batch (e.g. an unknown image), it's split
+    up until only the usages it refuses are dropped
+
+    batches are written with sessions from `session_factory`,
+    or the app's database session if it isn't given
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        session_factory: Optional[Callable[[], Session]] = None,
+        *,
+        max_batch: int = 500,
+        flush_interval: float = 1,
+        max_queue: int = 10000,
+        put_timeout: float = 0.5,
+        retry_interval: float = 0.5,
+        max_retry_interval: float = 30
+    ) -> None:
+        self._session_factory = session_factory
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._counters: Dict[str, int] = {
+            "recorded": 0,
+            "written": 0,
+            "batches": 0,
+            "rejected": 0,
+            "retries": 0,
+            "failed": 0
+        }
+
+    def _count(self, counter: str, change: int = 1) -> None:
+        with self._counters_lock:
+            self._counters[counter] += change
+
+    def _start(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="image-usage-buffer", daemon=True)
+                self._thread.start()
+
+    def record(self, image_usage: ImageUsageBase, when: Optional[datetime] = None) -> None:
+        """queue a usage of an image to be written, timestamped
+            now unless `when` is given
+
+        Raises:
+            UsageBufferFull: if there's still no space after `put_timeout`
+        """
+
+        self._start()
+        try:
+            self._queue.put((image_usage, when or datetime.now()), timeout=self.put_timeout)
+        except queue.Full as err:
+            self._count("rejected")
+            raise UsageBufferFull(
+                f"{self._queue.maxsize} image usages waiting to be written") from err
+        self._count("recorded")
+
+    def _write_rows(self, database: Session, batch: List[_Usage]) -> List[_Usage]:
+        """write `batch`, halving it whenever the database refuses
+            it, until only the usages it refuses are left out
+
+        Returns: List[_Usage] - the usages still to write, if the
+            database couldn't be reached
+        """
+
+        try:
+            self._count("written", record_image_usages(database, batch))
+            self._count("batches")
+            return []
+
+        except (IntegrityError, DataError):
+            database.rollback()
+            if len(batch) == 1:
+                self._count("failed")
+                logger.exception("dropped an image usage the database refused: %s", batch[0])
+                return []
+            middle = len(batch) // 2
+            rest = self._write_rows(database, batch[:middle])
+            if rest:
+                return rest + batch[middle:]
+            return self._write_rows(database, batch[middle:])
+
+        except Exception:  # pylint: disable=broad-except
+            database.rollback()
+            logger.exception("couldn't write %d image usages", len(batch))
+            return batch
+
+    def _write(self, batch: List[_Usage]) -> List[_Usage]:
+        """write `batch`, in as few statements as the database allows
+
+        Returns: List[_Usage] - the usages still to write, if the
+            database couldn't be reached
+        """
+
+        if not batch:
+            return []
+
+        with self._write_lock:
+            try:
+                database = self._session_factory() if self._session_factory \
+                    else beaver.db.db.session()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("couldn't write %d image usages", len(batch))
+                return batch
+            try:
+                return self._write_rows(database, batch)
+            finally:
+                database.close()
+
+    def _write_until_done(self, batch: List[_Usage]) -> None:
+        """write `batch`, trying again with backoff while the database
+            can't be reached, unless we're closing
+        """
+
+        delay = self.retry_interval
+        while True:
+            batch = self._write(batch)
+            if not batch:
+                return
+            if self._closing.wait(delay):
+                self._count("failed", len(batch))
+                logger.error("gave up on %d image usages when closing", len(batch))
+                return
+            self._count("retries")
+            delay = min(delay * 2, self.max_retry_interval)
+
+    def _run(self) -> None:
+        """write out batches until we're told to stop"""
+
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write_until_done(batch)
+            if stopping:
+                return
+
+    def flush(self) -> int:
+        """write everything currently waiting, without waiting
+            for the background thread
+
+        Returns: int - how many usages were taken off the queue
+        """
+
+        batch: List[_Usage] = []
+        taken = 0
+        stop_seen = False
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop_seen = True
+                continue
+            batch.append(item)
+            taken += 1
+            if len(batch) >= self.max_batch:
+                self._flush_batch(batch)
+                batch = []
+
+        self._flush_batch(batch)
+        if stop_seen:
+            # leave the stop for the background thread
+            self._queue.put(_STOP)
+        return taken
+
+    def _flush_batch(self, batch: List[_Usage]) -> None:
+        """write `batch` once, as there's nobody to try again"""
+        unwritten = self._write(batch)
+        if unwritten:
+            self._count("failed", len(unwritten))
+            logger.error("lost %d image usages, the database couldn't be reached",
+                         len(unwritten))
+
+    def close(self, timeout: float = 10) -> None:
+        """stop the background thread, writing anything still waiting
+            (giving up on a batch it's retrying)
+        """
+
+        with self._thread_lock:
+            thread = self._thread
+            self._thread = None
+
+        if thread is not None and thread.is_alive():
+            self._closing.set()
+            self._queue.put(_STOP)
+            thread.join(timeout)
+        self._closing.clear()
+
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        """return the buffer counters"""
+        with self._counters_lock:
+            return {"waiting": self._queue.qsize(), **self._counters}
@@ -0,0 +1,245 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Type
+
+from sqlalchemy import Column, DateTime, Index, Integer, func, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import ColumnElement
+
+from beaver.db.db import Base
+from beaver.db.images import ImageContents
+from beaver.db.package_dependencies import dependency_graph
+from beaver.models.image_usage import UsageGranularity
+
+# the most rows we'll put in one upsert statement
+UPSERT_BATCH_SIZE = 1000
+
+
+class _UsageRollup:
+    """the columns of a rollup table: how many times an image was
+        used by a user, as a group, in one time bucket
+    """
+
+    bucket = Column(DateTime, primary_key=True)
+    image_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, primary_key=True)
+    usage_count = Column(Integer, nullable=False, default=0)
+
+    @declared_attr
+    def __table_args__(cls):  # pylint: disable=no-self-argument
+        # the dashboards look up one user, group or image over a range of time
+        return tuple(
+            Index(f"{cls.__tablename__}_{x}_bucket", x, "bucket")  # pylint: disable=no-member
+            for x in ("image_id", "user_id", "group_id")
+        )
+
+
+class ImageUsageHourly(_UsageRollup, Base):
+    """image usage, counted by the hour"""
+
+    __tablename__ = "image_usage_hourly"
+
+
+class ImageUsageDaily(_UsageRollup, Base):
+    """image usage, counted by the day"""
+
+    __tablename__ = "image_usage_daily"
+
+
+ROLLUPS: Dict[UsageGranularity, Type[_UsageRollup]] = {
+    UsageGranularity.hour: ImageUsageHourly,
+    UsageGranularity.day: ImageUsageDaily
+}
+
+
+def bucket_for(when: datetime, granularity: UsageGranularity) -> datetime:
+    """get the start of the time bucket `when` falls in"""
+
+    if granularity == UsageGranularity.hour:
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _upsert(
+    database: Session,
+    rollup: Type[_UsageRollup],
+    counts: Mapping[Tuple[datetime, int, int, int], int]
+) -> None:
+    """add `counts` onto the counts already in `rollup`,
+        creating any rows that aren't there yet
+    """
+
+    rows = [{
+        "bucket": bucket,
+        "image_id": image_id,
+        "user_id": user_id,
+        "group_id": group_id,
+        "usage_count": count
+    } for (bucket, image_id, user_id, group_id), count in counts.items()]
+
+    dialect = database.get_bind().dialect.name
+
+    for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+        chunk = rows[i:i + UPSERT_BATCH_SIZE]
+
+        if dialect == "mysql":
+            stmt = mysql.insert(rollup).values(chunk)
+            database.execute(stmt.on_duplicate_key_update(
+                usage_count=rollup.usage_count + stmt.inserted.usage_count))
+
+        elif dialect in ("sqlite", "postgresql"):
+            stmt = (sqlite if dialect == "sqlite" else postgresql).insert(rollup).values(chunk)
+            database.execute(stmt.on_conflict_do_update(
+                index_elements=["bucket", "image_id", "user_id", "group_id"],
+                set_={"usage_count": rollup.usage_count + stmt.excluded.usage_count}
+            ))
+
+        else:
+            # no upsert in this dialect, so we do it one row at a time
+            for row in chunk:
+                existing = database.get(rollup, (
+                    row["bucket"], row["image_id"], row["user_id"], row["group_id"]))
+                if existing is None:
+                    database.add(rollup(**row))
+                else:
+                    existing.usage_count += row["usage_count"]
+            database.flush()
+
+
+def add_usage_to_rollups(database: Session, usages: Iterable[Mapping[str, Any]]) -> None:
+    """count image usage into the rollup tables
+
+    this doesn't commit, so it can go in the same
+    transaction as recording the usage itself
+
+    Args:
+        - database: Session - the database session to use
+        - usages: Iterable[Mapping[str, Any]] - the usage, each with
+            `image_id`, `user_id`, `group_id` and `datetime`
+
+    """
+
+    counts: Dict[UsageGranularity, Counter] = {x: Counter() for x in ROLLUPS}
+    for usage in usages:
+        for granularity, counter in counts.items():
+            counter[(
+                bucket_for(usage["datetime"], granularity),
+                usage["image_id"],
+                usage["user_id"],
+                usage["group_id"]
+            )] += 1
+
+    for granularity, counter in counts.items():
+        if counter:
+            _upsert(database, ROLLUPS[granularity], counter)
+
+
+def clear_rollups(database: Session) -> None:
+    """empty the rollup tables, ready to rebuild them"""
+    for rollup in ROLLUPS.values():
+        database.query(rollup).delete(synchronize_session=False)
+
+
+def _series(
+    database: Session,
+    granularity: UsageGranularity,
+    criterion: Callable[[Type[_UsageRollup]], ColumnElement],
+    since: Optional[datetime],
+    until: Optional[datetime]
+) -> List[Tuple[datetime, int]]:
+    """count usage matching `criterion` in each time bucket
+
+    buckets are included if they start in [`since`, `until`),
+    with `since` rounded down to the start of its bucket
+    """
+
+    rollup = ROLLUPS[granularity]
+    query = database.query(
+        rollup.bucket, func.sum(rollup.usage_count)
+    ).filter(criterion(rollup))
+
+    if since is not None:
+        query = query.filter(rollup.bucket >= bucket_for(since, granularity))
+    if until is not None:
+        query = query.filter(rollup.bucket < until)
+
+    return [(bucket, int(count)) for bucket, count in
+            query.group_by(rollup.bucket).order_by(rollup.bucket)]
+
+
+def get_usage_series_for_user(
+    database: Session,
+    user: int,
+    granularity: UsageGranularity,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[Tuple[datetime, int]]:
+    """count image usage by the user in each time bucket"""
+    return _series(database, granularity, lambda x: x.user_id == user, since, until)
+
+
+def get_usage_series_for_group(
+    database: Session,
+    group: int,
+    granularity: UsageGranularity,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[Tuple[datetime, int]]:
+    """count image usage by the group in each time bucket"""
+    return _series(database, granularity, lambda x: x.group_id == group, since, until)
+
+
+def get_usage_series_by_image(
+    database: Session,
+    image: int,
+    granularity: UsageGranularity,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[Tuple[datetime, int]]:
+    """count usage of the image in each time bucket"""
+    return _series(database, granularity, lambda x: x.image_id == image, since, until)
+
+
+def get_usage_series_by_package(
+    database: Session,
+    package: int,
+    granularity: UsageGranularity,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[Tuple[datetime, int]]:
+    """count usage of images containing the package, or packages
+        that depend on it, in each time bucket
+    """
+
+    packages = dependency_graph.get(database).dependents([package])
+
+    def _criterion(rollup: Type[_UsageRollup]) -> ColumnElement:
+        return rollup.image_id.in_(select(ImageContents.image_id).where(
+            ImageContents.package_id.in_(packages)))
+
+    return _series(database, granularity, _criterion, since, until)
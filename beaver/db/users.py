@@ -18,7 +18,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, Index, String, Integer
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
 
@@ -31,14 +31,22 @@ class User(Base):
     user_id = Column(Integer, primary_key=True, autoincrement=True)
     user_name = Column(String)
 
+    __table_args__ = (Index("users_user_name", "user_name"),)
+
     @staticmethod
-    def get_or_make_user_id_for_user_name(username: str, database: Session) -> int:
+    def get_or_make_user_id_for_user_name(
+        username: str,
+        database: Session,
+        commit: bool = True
+    ) -> int:
         """get user id for the username given
             if they don't exist in the database - make them
 
         Args:
             - username: str - the username to search for/add if needed
             - database: Session - the database session
+            - commit: bool - whether to commit a new user, or just
+                flush it as part of a bigger transaction
 
         Returns: int - the found or newly created user ID
 
@@ -51,8 +59,11 @@ class User(Base):
         except NoResultFound:
             new_user = User(user_name=username)
             database.add(new_user)
-            database.commit()
-            database.refresh(new_user)
+            if commit:
+                database.commit()
+                database.refresh(new_user)
+            else:
+                database.flush()
             user_id = int(new_user.user_id)
 
         return user_id
@@ -0,0 +1,75 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException, Request
+
+
+def _too_large(max_size: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"the body can be at most {max_size} bytes")
+
+
+async def _read_chunks(request: Request, max_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """the request's body, in chunks as it streams in
+
+    Raises:
+        HTTPException: 413 as soon as there's more than `max_size` bytes
+    """
+
+    if max_size is not None:
+        # refuse what says it's too big before reading any of it
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > max_size:
+            raise _too_large(max_size)
+
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise _too_large(max_size)
+        yield chunk
+
+
+async def read_body(request: Request, max_size: int) -> bytes:
+    """the request's body, as `Request.body` would give it
+
+    Raises:
+        HTTPException: 413 as soon as there's more than `max_size` bytes
+    """
+    return b"".join([x async for x in _read_chunks(request, max_size)])
+
+
+async def read_lines(request: Request, max_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """the lines of the request's body, as it streams in,
+        without their line endings
+
+    Raises:
+        HTTPException: 413 as soon as there's more than `max_size` bytes
+    """
+
+    buffer = b""
+    async for chunk in _read_chunks(request, max_size):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
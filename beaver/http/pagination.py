@@ -0,0 +1,59 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Callable, List, Optional, TypeVar
+
+from fastapi import HTTPException, Query, Response
+
+from beaver.db.pagination import Page
+from beaver.models.pagination import MAX_PAGE_SIZE, PageRequest, SortOrder
+
+T = TypeVar("T")
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def page_request(
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = Query(
+        None, description=f"the cursor from the {NEXT_CURSOR_HEADER} header"),
+    sort: Optional[str] = None,
+    order: SortOrder = SortOrder.asc
+) -> PageRequest:
+    """dependency collecting the pagination query parameters"""
+    return PageRequest(limit=limit, after=after, sort=sort, order=order)
+
+
+def paged_response(response: Response, get_page: Callable[[], Page[T]]) -> List[T]:
+    """get a page of results, putting the cursor for the next
+        page (if there is one) in the `X-Next-Cursor` header
+
+    Raises:
+        HTTPException: 400 if the sort field or cursor are invalid
+    """
+
+    try:
+        page = get_page()
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=err.args) from err
+
+    if page.next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = page.next_cursor
+    return page.items
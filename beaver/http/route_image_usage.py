@@ -18,57 +18,252 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import List
-from fastapi import APIRouter, Depends
+import asyncio
+from datetime import datetime
+import json
+from typing import Any, List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+import sqlalchemy.exc
 from sqlalchemy.orm import Session
 
 from beaver.db.db import get_db
 import beaver.db.image_usage
-from beaver.models.image_usage import ImageUsage, ImageUsageBase
+import beaver.db.usage_rollups
+from beaver.db.usage_buffer import UsageBufferFull
+from beaver.http.body import read_body, read_lines
+from beaver.http.pagination import page_request, paged_response
+from beaver.models.image_usage import (ImageUsage, ImageUsageBase, ImageUsageBatchResult,
+                                       ImageUsageRecord, UsageGranularity, UsagePoint,
+                                       UsageSeries)
+from beaver.models.pagination import PageRequest
+from beaver.utils.env import Env
 
 router = APIRouter(prefix="/images/usage", tags=["image_usage"])
 
+# the most usage records we'll take in one batch, and the most
+# bytes we'll read for them, allowing for whitespace
+MAX_BATCH_SIZE = 10000
+MAX_BATCH_BYTES = 256 * MAX_BATCH_SIZE
+
+NDJSON_CONTENT_TYPES = {"application/x-ndjson", "application/jsonl"}
+
 
 @router.get("/byuser/{user}", response_model=List[ImageUsage])
-async def get_image_usage_by_user(
+async def get_image_usage_by_user(  # pylint: disable=too-many-arguments
     user: int,
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    *,
+    page: PageRequest = Depends(page_request),
     database: Session = Depends(get_db)
 ) -> List[beaver.db.image_usage.ImageUsage]:
-    """returns image usage by the user specified"""
-    return beaver.db.image_usage.get_image_usage_for_user(database, user)
+    """returns a page of image usage by the user specified"""
+    return paged_response(response, lambda: beaver.db.image_usage.get_image_usage_for_user(
+        database, user, page, since, until))
 
 
 @router.get("/bygroup/{group}", response_model=List[ImageUsage])
-async def get_image_usage_by_group(
+async def get_image_usage_by_group(  # pylint: disable=too-many-arguments
     group: int,
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    *,
+    page: PageRequest = Depends(page_request),
     database: Session = Depends(get_db)
 ) -> List[beaver.db.image_usage.ImageUsage]:
-    """returns image usage by the group specified"""
-    return beaver.db.image_usage.get_image_usage_for_group(database, group)
+    """returns a page of image usage by the group specified"""
+    return paged_response(response, lambda: beaver.db.image_usage.get_image_usage_for_group(
+        database, group, page, since, until))
 
 
 @router.get("/byimage/{image}", response_model=List[ImageUsage])
-async def get_image_usage_by_image(
+async def get_image_usage_by_image(  # pylint: disable=too-many-arguments
     image: int,
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    *,
+    page: PageRequest = Depends(page_request),
     database: Session = Depends(get_db)
 ) -> List[beaver.db.image_usage.ImageUsage]:
-    """returns image usage by the image specified"""
-    return beaver.db.image_usage.get_image_usage_by_image(database, image)
+    """returns a page of image usage by the image specified"""
+    return paged_response(response, lambda: beaver.db.image_usage.get_image_usage_by_image(
+        database, image, page, since, until))
 
 
 @router.get("/bypackage/{package}", response_model=List[ImageUsage])
-async def get_image_usage_by_package(
+async def get_image_usage_by_package(  # pylint: disable=too-many-arguments
     package: int,
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    *,
+    page: PageRequest = Depends(page_request),
     database: Session = Depends(get_db)
 ) -> List[beaver.db.image_usage.ImageUsage]:
-    """returns image usage by the package specified"""
-    return beaver.db.image_usage.get_image_usage_by_package(database, package)
+    """returns a page of image usage by the package specified"""
+    return paged_response(response, lambda: beaver.db.image_usage.get_image_usage_by_package(
+        database, package, page, since, until))
+
+
+def _usage_series(
+    granularity: UsageGranularity,
+    series: List[Tuple[datetime, int]]
+) -> UsageSeries:
+    """turn (bucket, count) pairs into a `UsageSeries`"""
+    return UsageSeries(
+        granularity=granularity,
+        total=sum(count for _, count in series),
+        points=[UsagePoint(bucket=bucket, count=count) for bucket, count in series]
+    )
+
+
+@router.get("/stats/byuser/{user}", response_model=UsageSeries)
+async def get_usage_stats_by_user(
+    user: int,
+    granularity: UsageGranularity = UsageGranularity.day,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    database: Session = Depends(get_db)
+) -> UsageSeries:
+    """returns counts of image usage by the user specified, per hour or day"""
+    return _usage_series(granularity, beaver.db.usage_rollups.get_usage_series_for_user(
+        database, user, granularity, since, until))
+
+
+@router.get("/stats/bygroup/{group}", response_model=UsageSeries)
+async def get_usage_stats_by_group(
+    group: int,
+    granularity: UsageGranularity = UsageGranularity.day,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    database: Session = Depends(get_db)
+) -> UsageSeries:
+    """returns counts of image usage by the group specified, per hour or day"""
+    return _usage_series(granularity, beaver.db.usage_rollups.get_usage_series_for_group(
+        database, group, granularity, since, until))
+
+
+@router.get("/stats/byimage/{image}", response_model=UsageSeries)
+async def get_usage_stats_by_image(
+    image: int,
+    granularity: UsageGranularity = UsageGranularity.day,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    database: Session = Depends(get_db)
+) -> UsageSeries:
+    """returns counts of usage of the image specified, per hour or day"""
+    return _usage_series(granularity, beaver.db.usage_rollups.get_usage_series_by_image(
+        database, image, granularity, since, until))
+
+
+@router.get("/stats/bypackage/{package}", response_model=UsageSeries)
+async def get_usage_stats_by_package(
+    package: int,
+    granularity: UsageGranularity = UsageGranularity.day,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    database: Session = Depends(get_db)
+) -> UsageSeries:
+    """returns counts of usage of images containing the package
+        specified, per hour or day
+    """
+    return _usage_series(granularity, beaver.db.usage_rollups.get_usage_series_by_package(
+        database, package, granularity, since, until))
 
 
-@router.post("/", response_model=ImageUsage)
+@router.post("/", response_model=ImageUsage, responses={
+    202: {"model": ImageUsageBase, "description": "Usage queued to be recorded"},
+    503: {"description": "Too much usage waiting to be recorded"}
+})
 async def record_image_usage(
     image_usage: ImageUsageBase,
     database: Session = Depends(get_db)
-) -> beaver.db.image_usage.ImageUsage:
-    """records that an image has been used"""
+):
+    """records that an image has been used
+
+    if usage buffering is configured, this is queued to be
+    written in a batch, and a 202 is returned straight away
+    """
+
+    if Env.usage_buffer is not None:
+        try:
+            # waiting for space in the buffer mustn't hold up other requests
+            await asyncio.to_thread(Env.usage_buffer.record, image_usage)
+        except UsageBufferFull as err:
+            raise HTTPException(
+                status_code=503, detail=err.args, headers={"Retry-After": "1"}) from err
+        return JSONResponse(status_code=202, content=jsonable_encoder(image_usage))
+
     return beaver.db.image_usage.record_image_usage(database, image_usage)
+
+
+async def _read_ndjson(request: Request) -> List[Any]:
+    """read a newline delimited JSON body as it streams in"""
+
+    items: List[Any] = []
+    async for line in read_lines(request, MAX_BATCH_BYTES):
+        if line.strip():
+            if len(items) >= MAX_BATCH_SIZE:
+                raise HTTPException(
+                    status_code=413, detail=f"at most {MAX_BATCH_SIZE} records per batch")
+            items.append(json.loads(line))
+
+    return items
+
+
+@router.post("/batch", response_model=ImageUsageBatchResult)
+async def record_image_usage_batch(
+    request: Request,
+    database: Session = Depends(get_db)
+) -> ImageUsageBatchResult:
+    """records a batch of image usage in one go
+
+    the body is either a JSON array of image usage records, or
+    newline delimited JSON (`application/x-ndjson`) with one
+    record per line. each record is of the form:
+        {
+            "image_id": ID,
+            "user_id": ID,
+            "group_id": ID,
+            "datetime": "when the image was used"
+        }
+
+    either all the records are recorded, or none are. bodies of
+    more than `MAX_BATCH_BYTES` are refused as they're read
+    """
+
+    try:
+        if request.headers.get("content-type", "").split(";")[0] in NDJSON_CONTENT_TYPES:
+            items = await _read_ndjson(request)
+        else:
+            items = json.loads(await read_body(request, MAX_BATCH_BYTES))
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail="invalid JSON") from err
+
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="expected a list of records")
+    if len(items) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"at most {MAX_BATCH_SIZE} records per batch")
+
+    records: List[ImageUsageRecord] = []
+    for i, item in enumerate(items):
+        try:
+            records.append(ImageUsageRecord.parse_obj(item))
+        except ValidationError as err:
+            raise HTTPException(status_code=422, detail=[
+                {"record": i, **x} for x in err.errors()]) from err
+
+    try:
+        return ImageUsageBatchResult(recorded=beaver.db.image_usage.record_image_usages(
+            database, [(x, x.datetime) for x in records]))
+    except sqlalchemy.exc.IntegrityError as err:
+        database.rollback()
+        raise HTTPException(
+            status_code=400, detail="records refer to unknown images, users or groups") from err
@@ -19,13 +19,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from typing import List
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Response
 from sqlalchemy.orm import Session
 
 from beaver.db.db import get_db
 import beaver.db.images
+from beaver.http.pagination import page_request, paged_response
 from beaver.utils.env import Env
 from beaver.models.images import Image
+from beaver.models.pagination import PageRequest
 
 
 router = APIRouter(prefix="/images", tags=["images"])
@@ -34,10 +36,11 @@ router = APIRouter(prefix="/images", tags=["images"])
 @router.get("/{user}", response_model=List[Image])
 async def get_images_for_user(
     user: str,
+    response: Response,
+    page: PageRequest = Depends(page_request),
     database: Session = Depends(get_db)
 ) -> List[beaver.db.images.Image]:
-    """returns images available for the specific user"""
-    images = beaver.db.images.get_images_for_user(database, user)
-    for group in Env.idm.get_groups_for_user(user):
-        images += beaver.db.images.get_images_for_group_name(database, group)
-    return images
+    """returns a page of the images available for the specific user"""
+    groups = await Env.idm.get_groups_for_user_async(user)
+    return paged_response(response, lambda: beaver.db.images.get_images_visible_to_user(
+        database, user, groups, page))
@@ -18,33 +18,45 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from fastapi import APIRouter, Depends
+import time
+from typing import AsyncIterator
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Session
 
 from beaver.db.db import get_db
 import beaver.db.jobs
-from beaver.db.jobs import get_num_jobs_in_status, get_num_jobs_in_status_last_n_hours
-from beaver.models.jobs import JobInfo, JobStatus, Job
+from beaver.db.jobs import FINISHED_STATUSES, get_job_counts
+from beaver.models.jobs import JobEvent, JobInfo, JobStatus, Job
+from beaver.utils.env import Env
 
 router = APIRouter(prefix="/jobs", tags=["jobs"])
 
+# how many seconds the job counts are reused for
+JOB_INFO_TTL = 2
+
+# how many seconds to wait for a job event before sending
+# a comment, so proxies don't close the connection
+JOB_EVENTS_KEEPALIVE = 15
+
 
 @router.get("/", response_model=JobInfo)
 async def get_basic_job_info(database: Session = Depends(get_db)) -> JobInfo:
     """return some info about number of jobs in various states"""
+    counts = get_job_counts(database, ttl=JOB_INFO_TTL)
     return JobInfo(
-        jobs_queued=get_num_jobs_in_status(
-            JobStatus.Queued, database),
-        jobs_building_definition=get_num_jobs_in_status(
-            JobStatus.BuildingDefinition, database),
-        jobs_pending_image_build=get_num_jobs_in_status(
-            JobStatus.DefinitionMade, database),
-        jobs_building_image=get_num_jobs_in_status(
-            JobStatus.BuildingImage, database),
-        jobs_completed_last_24_hours=get_num_jobs_in_status_last_n_hours(
-            JobStatus.Succeeded, database),
-        jobs_failed_last_24_hours=get_num_jobs_in_status_last_n_hours(
-            JobStatus.Failed, database)
+        jobs_queued=counts.statuses[JobStatus.Queued],
+        jobs_building_definition=counts.statuses[JobStatus.BuildingDefinition],
+        jobs_pending_image_build=counts.statuses[JobStatus.DefinitionMade],
+        jobs_building_image=counts.statuses[JobStatus.BuildingImage],
+        jobs_completed_last_24_hours=counts.statuses[JobStatus.Succeeded],
+        jobs_failed_last_24_hours=counts.statuses[JobStatus.Failed],
+        jobs_submitted_last_24_hours=counts.submitted,
+        jobs_deduplicated_last_24_hours=counts.deduplicated,
+        deduplication_rate_last_24_hours=(
+            counts.deduplicated / counts.submitted if counts.submitted else 0)
     )
 
 
@@ -52,3 +64,52 @@ async def get_basic_job_info(database: Session = Depends(get_db)) -> JobInfo:
 async def get_job(job_id: str, database: Session = Depends(get_db)) -> beaver.db.jobs.Job:
     """return the job identified by `job_id`"""
     return beaver.db.jobs.get_job(database, job_id)
+
+
+def _server_sent_event(event: JobEvent) -> str:
+    return f"event: {event.event.value}\ndata: {event.json()}\n\n"
+
+
+@router.get("/{job_id}/events")
+async def stream_job_events(
+    job_id: str,
+    database: Session = Depends(get_db)
+) -> StreamingResponse:
+    """stream what happens to the job identified by `job_id`, as
+        server-sent events, until it succeeds or fails
+
+    `status` events are sent as it moves through the build, starting
+    with the status it's in now, and `log` events with its build log
+    (if it's being built in this process)
+    """
+
+    as_of = time.monotonic()
+    try:
+        job = beaver.db.jobs.get_job(database, job_id)
+    except NoResultFound as err:
+        raise HTTPException(status_code=404, detail=f"no job {job_id}") from err
+
+    status, detail = JobStatus(job.status), job.detail
+    # don't hold on to a connection for as long as we're streaming
+    database.close()
+
+    events = Env.job_events
+    events.publish_status(job_id, status, detail, as_of)
+    subscription = events.subscribe(job_id)
+
+    async def _stream() -> AsyncIterator[str]:
+        try:
+            while True:
+                event = await subscription.get(JOB_EVENTS_KEEPALIVE)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+
+                yield _server_sent_event(event)
+                if event.status in FINISHED_STATUSES:
+                    return
+        finally:
+            events.unsubscribe(subscription)
+
+    return StreamingResponse(_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
@@ -0,0 +1,78 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Dict
+
+from fastapi import APIRouter
+
+import beaver.db.db
+import beaver.db.package_dependencies
+import beaver.db.packages
+from beaver.utils.env import Env
+from beaver.utils.idm import CachingIdentityManager
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get("/idm", response_model=Dict[str, int])
+async def get_idm_metrics() -> Dict[str, int]:
+    """returns the group membership cache counters,
+        or nothing if the identity manager isn't cached
+    """
+    idm = getattr(Env, "idm", None)
+    if isinstance(idm, CachingIdentityManager):
+        return idm.stats()
+    return {}
+
+
+@router.get("/usage-buffer", response_model=Dict[str, int])
+async def get_usage_buffer_metrics() -> Dict[str, int]:
+    """returns the image usage buffer counters,
+        or nothing if usage isn't buffered
+    """
+    if Env.usage_buffer is not None:
+        return Env.usage_buffer.stats()
+    return {}
+
+
+@router.get("/job-events", response_model=Dict[str, int])
+async def get_job_events_metrics() -> Dict[str, int]:
+    """returns the job event broker counters"""
+    return Env.job_events.stats()
+
+
+@router.get("/package-catalog", response_model=Dict[str, int])
+async def get_package_catalog_metrics() -> Dict[str, int]:
+    """returns the package catalog counters"""
+    return beaver.db.packages.package_catalog.stats()
+
+
+@router.get("/package-dependencies", response_model=Dict[str, int])
+async def get_package_dependencies_metrics() -> Dict[str, int]:
+    """returns the dependency graph's size and counters"""
+    return beaver.db.package_dependencies.dependency_graph.stats()
+
+
+@router.get("/db", response_model=Dict[str, float])
+async def get_db_metrics() -> Dict[str, float]:
+    """returns the database connection pool's size and counters,
+        including how long requests waited for a connection
+    """
+    return beaver.db.db.get_pool_stats()
@@ -18,21 +18,99 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import List
-from fastapi import APIRouter, Depends
+import asyncio
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 
 from beaver.db.db import get_db
 import beaver.db.packages
-from beaver.models.packages import Package, PackageBase
+from beaver.http.body import read_lines
+from beaver.http.pagination import NEXT_CURSOR_HEADER, page_request
+from beaver.models.packages import (Package, PackageBase, PackageImportResult, PackageRequest,
+                                    PackageRequestFile, PackageSearchResult, PackageType)
+from beaver.models.pagination import PageRequest
+from beaver.utils.env import Env
+from beaver.utils.package_requests import read_requirements
 
 router = APIRouter(prefix="/packages", tags=["packages"])
 
+# the most packages we'll take in one import
+MAX_IMPORT_SIZE = 10000
+# the most lines of a requirements.txt we'll read, allowing for comments
+MAX_REQUIREMENTS_LINES = 5 * MAX_IMPORT_SIZE
+
+REQUIREMENTS_CONTENT_TYPES = {"text/plain"}
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """whether the client's `If-None-Match` includes `etag`"""
+    if if_none_match is None:
+        return False
+    tags = {x.strip().removeprefix("W/") for x in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
 
 @router.get("/", response_model=List[Package])
-async def get_all_packages(database: Session = Depends(get_db)) -> List[beaver.db.packages.Package]:
-    """returns all available packages"""
-    return beaver.db.packages.get_all_pacakges(database)
+async def get_all_packages(  # pylint: disable=too-many-arguments
+    package_type: Optional[PackageType] = None,
+    commonly_used: Optional[bool] = None,
+    name: Optional[str] = None,
+    *,
+    page: PageRequest = Depends(page_request),
+    if_none_match: Optional[str] = Header(None),
+    database: Session = Depends(get_db)
+) -> Response:
+    """returns a page of available packages, optionally filtered
+        by type, whether they're commonly used, or name prefix
+
+    pages come from the package catalog, so are usually already made,
+    and have an `ETag` - if it's in `If-None-Match`, it's a 304
+    """
+
+    try:
+        catalog_page = beaver.db.packages.package_catalog.get_page(
+            database, page, package_type, commonly_used, name)
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=err.args) from err
+
+    headers = {"ETag": catalog_page.etag, "Cache-Control": "no-cache"}
+    if catalog_page.next_cursor is not None:
+        headers[NEXT_CURSOR_HEADER] = catalog_page.next_cursor
+
+    if _etag_matches(if_none_match, catalog_page.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(catalog_page.body, media_type="application/json", headers=headers)
+
+
+@router.get("/search", response_model=List[PackageSearchResult])
+async def search_packages(
+    q: str = Query(..., min_length=1, max_length=100),  # pylint: disable=invalid-name
+    limit: int = Query(20, ge=1, le=100),
+    database: Session = Depends(get_db)
+) -> List[PackageSearchResult]:
+    """search nixpkgs for packages matching `q`, by attribute or name,
+        with packages we already have ranked higher
+
+    Raises:
+        HTTPException: 503 if package search isn't set up
+    """
+
+    if Env.package_search is None:
+        raise HTTPException(status_code=503, detail="package search isn't configured")
+    try:
+        # loading the index the first time takes a while
+        index = await asyncio.to_thread(Env.package_search.index)
+    except FileNotFoundError as err:
+        raise HTTPException(status_code=503, detail="nixpkgs hasn't been imported") from err
+
+    boosts = Env.package_search.boosts(
+        lambda: beaver.db.packages.get_package_boosts(database))
+    return [PackageSearchResult(
+        **x.package._asdict(), score=x.score, known=x.known, commonly_used=x.commonly_used
+    ) for x in index.search(q, limit, boosts)]
 
 
 @router.post("/", response_model=Package)
@@ -42,3 +120,47 @@ async def add_new_package(
 ) -> beaver.db.packages.Package:
     """create a new package"""
     return beaver.db.packages.create_new_package(database, package)
+
+
+async def _read_requirements(request: Request) -> List[PackageRequest]:
+    """read a `requirements.txt` body as it streams in"""
+
+    lines: List[str] = []
+    async for line in read_lines(request):
+        if len(lines) >= MAX_REQUIREMENTS_LINES:
+            raise HTTPException(
+                status_code=413, detail=f"at most {MAX_REQUIREMENTS_LINES} lines per import")
+        lines.append(line.decode("utf-8"))
+
+    return list(read_requirements(lines))
+
+
+@router.post("/import", response_model=PackageImportResult)
+async def import_packages(
+    request: Request,
+    database: Session = Depends(get_db)
+) -> PackageImportResult:
+    """imports a Package Request File, adding the packages we
+        haven't got, and returns each one's ID, in order
+
+    the body is either a Package Request File:
+        {"packages": [{"name": NAME, "version": VERSION, "type": "std|R|py"}]}
+    or a `requirements.txt`, sent as `text/plain`, whose
+    packages are imported as Python packages
+    """
+
+    try:
+        if request.headers.get("content-type", "").split(";")[0] in REQUIREMENTS_CONTENT_TYPES:
+            packages = await _read_requirements(request)
+        else:
+            packages = PackageRequestFile.parse_obj(await request.json()).packages
+    except ValidationError as err:
+        raise HTTPException(status_code=422, detail=jsonable_encoder(err.errors())) from err
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err)) from err
+
+    if len(packages) > MAX_IMPORT_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"at most {MAX_IMPORT_SIZE} packages per import")
+
+    return beaver.db.packages.import_packages(database, packages)
@@ -19,8 +19,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import datetime
+import enum
+from typing import List
 
-from pydantic import BaseModel  # pylint: disable=no-name-in-module
+from pydantic import BaseModel, validator  # pylint: disable=no-name-in-module
 
 from beaver.models.groups import Group
 from beaver.models.users import User
@@ -34,6 +36,29 @@ class ImageUsageBase(BaseModel):
     group_id: int
 
 
+def _to_local_time(value: datetime.datetime) -> datetime.datetime:
+    """convert aware times to the server's local time, without an offset"""
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+class ImageUsageRecord(ImageUsageBase):
+    """an image usage dataset, timestamped by the client
+
+    times with an offset are converted to the server's local
+    time, which is what's recorded (without an offset)
+    """
+    datetime: datetime.datetime
+
+    _local_datetime = validator("datetime", allow_reuse=True)(_to_local_time)
+
+
+class ImageUsageBatchResult(BaseModel):
+    """the result of recording a batch of image usage"""
+    recorded: int
+
+
 class ImageUsage(ImageUsageBase):
     """full representation of an image usage dataset"""
     image: Image
@@ -44,3 +69,22 @@ class ImageUsage(ImageUsageBase):
     class Config:
         """orm config"""
         orm_mode = True
+
+
+class UsageGranularity(enum.Enum):
+    """the size of the time buckets usage is rolled up into"""
+    hour = "hour"  # pylint: disable=invalid-name
+    day = "day"  # pylint: disable=invalid-name
+
+
+class UsagePoint(BaseModel):
+    """how many times something was used in one time bucket"""
+    bucket: datetime.datetime
+    count: int
+
+
+class UsageSeries(BaseModel):
+    """usage counts over time, from the rollup tables"""
+    granularity: UsageGranularity
+    total: int
+    points: List[UsagePoint]
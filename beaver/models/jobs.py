@@ -35,6 +35,9 @@ class JobInfo(BaseModel):
     jobs_building_image: int
     jobs_completed_last_24_hours: int
     jobs_failed_last_24_hours: int
+    jobs_submitted_last_24_hours: int
+    jobs_deduplicated_last_24_hours: int
+    deduplication_rate_last_24_hours: float
 
 
 class JobStatus(enum.Enum):
@@ -48,6 +51,32 @@ class JobStatus(enum.Enum):
     Failed = "Failed"  # pylint: disable=invalid-name
 
 
+class BuildStage(enum.Enum):
+    """the stages of building a job, each run by its own pool of builders"""
+
+    definition = "definition"  # pylint: disable=invalid-name
+    image = "image"  # pylint: disable=invalid-name
+
+
+class JobEventType(enum.Enum):
+    """the kinds of event streamed about a job"""
+
+    status = "status"  # pylint: disable=invalid-name
+    log = "log"  # pylint: disable=invalid-name
+
+
+class JobEvent(BaseModel):
+    """models something happening to a job - its status
+        changing, or a line of its build log
+    """
+    job_id: str
+    event: JobEventType
+    time: datetime
+    status: JobStatus | None
+    detail: str | None
+    line: str | None
+
+
 class JobBase(BaseModel):
     """models the basic information of a job required at job creation"""
     job_id: str
@@ -60,6 +89,7 @@ class Job(JobBase):
     detail: str | None
     starttime: datetime | None
     endtime: datetime | None
+    build_of: str | None
 
     image: Image
 
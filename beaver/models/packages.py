@@ -19,6 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import enum
+from typing import List
 
 from pydantic import BaseModel  # pylint: disable=no-name-in-module
 
@@ -64,3 +65,49 @@ class Package(PackageBase):
     class Config:
         """orm config"""
         orm_mode = True
+
+
+class PackageList(BaseModel):
+    """a list of packages, to serialise in one go"""
+    __root__: List[Package]
+
+
+class PackageRequest(BaseModel):
+    """a package in a Package Request File, without a
+        version meaning the default version
+    """
+    name: str
+    version: str | None = None
+    type: PackageType = PackageType.std
+
+
+class PackageRequestFile(BaseModel):
+    """a Package Request File, describing a selection of packages"""
+    packages: List[PackageRequest]
+
+
+class ImportedPackage(PackageRequest):
+    """a requested package, and the package it is now"""
+    package_id: int
+    created: bool
+
+
+class PackageImportResult(BaseModel):
+    """the packages in a request, in the order they were given"""
+    packages: List[ImportedPackage]
+    created: int
+
+
+class PackageSearchResult(BaseModel):
+    """a package in nixpkgs matching a search
+
+    `known` is whether we've got a package of that name,
+    and `commonly_used` whether it's commonly used
+    """
+    attribute: str
+    name: str
+    version: str
+    description: str
+    score: float
+    known: bool
+    commonly_used: bool
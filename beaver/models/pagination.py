@@ -0,0 +1,44 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import enum
+
+from pydantic import BaseModel  # pylint: disable=no-name-in-module
+
+MAX_PAGE_SIZE = 1000
+
+
+class SortOrder(enum.Enum):
+    """directions results can be sorted in"""
+    asc = "asc"  # pylint: disable=invalid-name
+    desc = "desc"  # pylint: disable=invalid-name
+
+
+class PageRequest(BaseModel):
+    """represents which page of a list of results is wanted
+
+    `after` is the opaque cursor returned with the previous page,
+    and `sort` the name of the field to sort by (each list has
+    its own default and choice of fields)
+    """
+    limit: int = 100
+    after: str | None = None
+    sort: str | None = None
+    order: SortOrder = SortOrder.asc
@@ -18,26 +18,34 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import json
 import os
 import unittest
+import unittest.mock
 
 from fastapi.testclient import TestClient
+import sqlalchemy.event
 
 import beaver.db.db
 from beaver.db.groups import Group
 from beaver.db.images import Image, ImageContents
 from beaver.db.image_usage import ImageUsage
+from beaver.db.job_queue import claim_job, reconcile_followers, set_leased_job_status
+import beaver.db.jobs
 from beaver.db.jobs import Job
 from beaver.db.names import ImageNameAdjective, ImageNameName
+import beaver.db.package_dependencies
 from beaver.db.packages import GitHubPackage, Package
+from beaver.db.usage_buffer import ImageUsageBuffer
 from beaver.db.users import User
 import beaver.http
-from beaver.models.jobs import JobStatus
+from beaver.models.jobs import BuildRequest, JobStatus
+from beaver.utils.env import Env
 from . import set_up_database
 
 
-class TestAPICreateUpdateEndpoints(unittest.TestCase):
+class TestAPICreateUpdateEndpoints(unittest.TestCase):  # pylint: disable=too-many-public-methods
     """testing all API endpoints that create or update data
         with fake SQLite DB
     """
@@ -170,6 +178,83 @@ class TestAPICreateUpdateEndpoints(unittest.TestCase):
         db_package["github_package"] = gh_package
         assert db_package == new_pkg
 
+    def test_import_packages(self):
+        """test importing a Package Request File
+
+        - we expect each package's ID back, in order, with
+            ones we've already got used rather than added
+        - we expect the same number of statements however
+            many packages there are
+        - we expect importing it again to add nothing
+        """
+
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        def _import(packages):
+            statements.clear()
+            sqlalchemy.event.listen(beaver.db.db.engine, "before_cursor_execute", _count)
+            try:
+                response = self.client.post("/packages/import", json={"packages": packages})
+            finally:
+                sqlalchemy.event.remove(beaver.db.db.engine, "before_cursor_execute", _count)
+            self.assertEqual(response.status_code, 200)
+            return response.json(), len(statements)
+
+        _, few = _import([{"name": "importedFew", "type": "R"}])
+        packages = [
+            {"name": "testPackage1"},
+            {"name": "numpy", "version": "1.24.0", "type": "py"},
+            {"name": "numpy", "type": "py"},
+            {"name": "testPackage1", "type": "R"}
+        ] + [{"name": f"imported{i}", "version": "1.0"} for i in range(20)]
+        data, many = _import(packages)
+        self.assertEqual(few, many)
+
+        self.assertEqual(data["created"], 23)
+        self.assertEqual([(x["name"], x["version"], x["type"]) for x in data["packages"]],
+                         [(x["name"], x.get("version"), x.get("type", "std")) for x in packages])
+        self.assertEqual(data["packages"][0]["package_id"], 2)
+        self.assertFalse(data["packages"][0]["created"])
+        self.assertTrue(all(x["created"] for x in data["packages"][1:]))
+
+        again, _ = _import(packages)
+        self.assertEqual(again["created"], 0)
+        self.assertEqual([x["package_id"] for x in again["packages"]],
+                         [x["package_id"] for x in data["packages"]])
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(Package).count(), 3 + 1 + 23)
+        self.assertEqual(self.client.post("/packages/import", json={
+            "packages": [{"name": "bad", "type": "perl"}]}).status_code, 422)
+
+    def test_import_packages_requirements(self):
+        """test importing a requirements.txt
+
+        - we expect its packages to be imported as Python
+            packages, versioned if they're pinned
+        - we expect a 400 for a line we can't import, with
+            nothing added
+        """
+
+        response = self.client.post("/packages/import", data=(
+            "# analysis\nnumpy==1.24.0\npandas>=2.0  # any\n\n-r more.txt\nscikit_learn\n"
+        ), headers={"content-type": "text/plain"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(x["name"], x["version"], x["type"]) for x in response.json()["packages"]],
+            [("numpy", "1.24.0", "py"), ("pandas", None, "py"), ("scikit-learn", None, "py")])
+
+        response = self.client.post("/packages/import", data="scipy\n./local/package\n",
+                                    headers={"content-type": "text/plain"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("line 2", response.json()["detail"])
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(Package).count(), 3 + 3)
+
     def test_create_new_name_elements_adjectives(self):
         """test adding new adjectives to the possibilites of
             image names
@@ -257,6 +342,153 @@ class TestAPICreateUpdateEndpoints(unittest.TestCase):
 
         self.assertEqual(db_image_usage, new_image_usage)
 
+    def test_add_image_usage_buffered(self):
+        """test adding usage information for an image when
+            usage is being written in batches
+
+        - we expect a 202 with the usage information we provided
+        - we expect the usage information to be in the database
+            once the buffer has been flushed
+        """
+
+        Env.usage_buffer = ImageUsageBuffer()
+        try:
+            new_image_usage = {
+                "image_id": 1,
+                "user_id": 1,
+                "group_id": 1
+            }
+
+            response = self.client.post("/images/usage/", json=new_image_usage)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.json(), new_image_usage)
+
+            Env.usage_buffer.close()
+        finally:
+            Env.usage_buffer = None
+
+        database = next(beaver.db.db.get_db())
+        db_image_usage = database.query(ImageUsage).one()
+        self.assertEqual(db_image_usage.image_id, 1)
+        self.assertTrue(datetime.now() - timedelta(0, 10)
+                        < db_image_usage.datetime)
+
+    def test_add_image_usage_batch(self):
+        """test adding a batch of usage information, as
+            a JSON array
+
+        - we expect the number recorded to be returned
+        - we expect all of them in the database, with the
+            times given by the client
+        """
+
+        usages = [{
+            "image_id": 1,
+            "user_id": 1,
+            "group_id": 1,
+            "datetime": datetime(2006, 1, 2, 22, 4, i).isoformat()
+        } for i in range(3)]
+
+        response = self.client.post("/images/usage/batch", json=usages)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"recorded": 3})
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(sorted(x.datetime for x in database.query(ImageUsage).all()),
+                         [datetime(2006, 1, 2, 22, 4, i) for i in range(3)])
+
+    def test_add_image_usage_batch_offsets(self):
+        """test adding usage timestamped with offsets from UTC
+
+        - we expect times with an offset stored in the server's
+            local time, so the same moment is stored the same
+        - we expect the rollups to count them in the same bucket
+        """
+
+        usages = [{"image_id": 1, "user_id": 1, "group_id": 1, "datetime": x}
+                  for x in ("2026-01-02T01:30:00+02:00", "2026-01-01T23:30:00+00:00")]
+        response = self.client.post("/images/usage/batch", json=usages)
+        self.assertEqual(response.status_code, 200)
+
+        local = datetime(2026, 1, 1, 23, 30, tzinfo=timezone.utc).astimezone().replace(
+            tzinfo=None)
+        database = next(beaver.db.db.get_db())
+        self.assertEqual([x.datetime for x in database.query(ImageUsage).all()], [local] * 2)
+
+        series = self.client.get("/images/usage/stats/byimage/1", params={
+            "granularity": "hour"}).json()
+        self.assertEqual(series["points"], [
+            {"bucket": local.replace(minute=0).isoformat(), "count": 2}])
+
+    def test_add_image_usage_batch_ndjson(self):
+        """test adding a batch of usage information, as
+            newline delimited JSON
+
+        - we expect the number recorded to be returned
+        - we expect all of them in the database
+        """
+
+        body = "\n".join(json.dumps({
+            "image_id": 1,
+            "user_id": 1,
+            "group_id": 1,
+            "datetime": datetime(2006, 1, 2, 22, 4, i).isoformat()
+        }) for i in range(4)) + "\n"
+
+        response = self.client.post("/images/usage/batch", data=body, headers={
+            "content-type": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"recorded": 4})
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 4)
+
+    def test_add_image_usage_batch_too_large(self):
+        """test that a batch body that's too big is refused
+            without reading all of it
+
+        - we expect a 413 for a JSON body that says it's too big
+        - we expect a 413 for newline delimited JSON that streams
+            in too much, even with no line ending in sight
+        - we expect nothing in the database
+        """
+
+        def _stream():
+            for _ in range(100):
+                yield b"x" * 64
+
+        with unittest.mock.patch("beaver.http.route_image_usage.MAX_BATCH_BYTES", 1000):
+            response = self.client.post("/images/usage/batch", json=[{"image_id": 1}] * 100)
+            self.assertEqual(response.status_code, 413)
+
+            response = self.client.post("/images/usage/batch", data=_stream(), headers={
+                "content-type": "application/x-ndjson"})
+            self.assertEqual(response.status_code, 413)
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 0)
+
+    def test_add_image_usage_batch_invalid(self):
+        """test that a batch with a bad record in it is
+            refused, and nothing is recorded
+
+        - we expect a 422 pointing at the bad record
+        - we expect nothing in the database
+        """
+
+        usages = [
+            {"image_id": 1, "user_id": 1, "group_id": 1,
+             "datetime": datetime.now().isoformat()},
+            {"image_id": 1, "user_id": 1, "group_id": 1}
+        ]
+
+        response = self.client.post("/images/usage/batch", json=usages)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()["detail"][0]["record"], 1)
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 0)
+
     def test_create_new_job_image_name_provided(self):
         """test creating a new job with a custom image name"""
 
@@ -385,6 +617,159 @@ class TestAPICreateUpdateEndpoints(unittest.TestCase):
         self.assertEqual(set(_package_ids), set(x.package_id for x in database.query(
             ImageContents).filter(ImageContents.image_id == new_job.image_id).all()))
 
+    def test_create_new_job_same_packages(self):
+        """test that a job for the same packages as another
+            waits on that job's build, rather than building again
+
+        - we expect the second job to be linked to the first, and
+            never claimed by a builder itself
+        - we expect a different set of packages not to be linked
+        - we expect the second job to finish once it's been given
+            the first's build, after the first finishes
+        - we expect the deduplication to show in the job counts
+        """
+
+        def _request(image_name, packages):
+            return self.client.post("/build", json={
+                "image": {
+                    "image_name": image_name,
+                    "user_name": "testUser0",
+                    "group_name": "testGroup0"
+                },
+                "packages": packages,
+                "new_packages": []
+            }).json()
+
+        first = _request("first", [1, 2])
+        second = _request("second", [2, 1])
+        other = _request("other", [1, 2, 3])
+
+        self.assertIsNone(first["build_of"])
+        self.assertEqual(second["build_of"], first["job_id"])
+        self.assertEqual(second["status"], "Queued")
+        self.assertIsNone(other["build_of"])
+
+        database = next(beaver.db.db.get_db())
+        owners = {x.job_id: x.lease_owner for x in (
+            claim_job(database, "worker0"), claim_job(database, "worker1"))}
+        self.assertEqual(set(owners), {first["job_id"], other["job_id"]})
+        self.assertIsNone(claim_job(database, "worker2"))
+
+        self.assertTrue(set_leased_job_status(
+            database, first["job_id"], owners[first["job_id"]], JobStatus.Succeeded))
+        # and once it's built, another waits on it too
+        third = _request("third", [1, 2])
+        self.assertEqual(third["build_of"], first["job_id"])
+
+        # neither is done until a builder has given them the build
+        for job in (second, third):
+            self.assertEqual(self.client.get(f"/jobs/{job['job_id']}").json()["status"],
+                             "Queued")
+        publish = unittest.mock.Mock()
+        self.assertEqual(reconcile_followers(database, publish), 2)
+        self.assertEqual(publish.call_count, 2)
+        for job in (second, third):
+            self.assertEqual(self.client.get(f"/jobs/{job['job_id']}").json()["status"],
+                             "Succeeded")
+
+        info = self.client.get("/jobs").json()
+        self.assertEqual(info["jobs_submitted_last_24_hours"], 4)
+        self.assertEqual(info["jobs_deduplicated_last_24_hours"], 2)
+        self.assertEqual(info["deduplication_rate_last_24_hours"], 0.5)
+
+    def test_create_new_job_new_packages(self):
+        """test creating a new job with packages we haven't got yet
+
+        - we expect each new package to be added once, and ones
+            we've already got to be used rather than added again
+        - we expect the same number of statements however
+            many new packages there are
+        """
+
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        def _submit(image_name, new_packages):
+            statements.clear()
+            sqlalchemy.event.listen(beaver.db.db.engine, "before_cursor_execute", _count)
+            try:
+                response = self.client.post("/build", json={
+                    "image": {
+                        "image_name": image_name,
+                        "user_name": "testUser0",
+                        "group_name": "testGroup0"
+                    },
+                    "packages": [1],
+                    "new_packages": new_packages
+                })
+            finally:
+                sqlalchemy.event.remove(beaver.db.db.engine, "before_cursor_execute", _count)
+            self.assertEqual(response.status_code, 200)
+            return response.json(), len(statements)
+
+        # the dependency graph is loaded by whichever build comes first
+        graph = beaver.db.package_dependencies.DependencyGraphCache(check_interval=60)
+        with unittest.mock.patch.object(beaver.db.package_dependencies, "dependency_graph", graph):
+            graph.get(next(beaver.db.db.get_db()))
+            _, one_package = _submit("one", ["newPackage0"])
+            data, many_packages = _submit(
+                "many", ["newPackage0", "testPackage2"] + [f"newPackage{i}" for i in range(1, 5)])
+        self.assertEqual(one_package, many_packages)
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(Package).count(), 3 + 5)
+        self.assertEqual(
+            {(x.package_name, x.package_type.value) for x in database.query(Package).join(
+                ImageContents, ImageContents.package_id == Package.package_id
+            ).join(Job, Job.image_id == ImageContents.image_id).filter(
+                Job.job_id == data["job_id"])},
+            {("testPackage0", "std"), ("testPackage2", "std")} |
+            {(f"newPackage{i}", "std") for i in range(5)})
+
+    def test_create_new_job_failure_leaves_nothing(self):
+        """test that a job that fails part way through
+            being created doesn't leave anything behind
+
+        - we expect no new user, group, packages, image or job
+        """
+
+        database = next(beaver.db.db.get_db())
+        request = BuildRequest(
+            image={"image_name": "broken", "user_name": "newUser", "group_name": "newGroup"},
+            packages=[1], new_packages=["newPackage"])
+
+        with unittest.mock.patch("beaver.db.jobs.find_build_for_hash",
+                                 side_effect=RuntimeError("database went away")):
+            with self.assertRaises(RuntimeError):
+                beaver.db.jobs.submit_job(database, request)
+
+        self.assertEqual(
+            [database.query(x).count() for x in (User, Group, Package, Image, Job)],
+            [1, 1, 3, 1, 0])
+
+    def test_create_new_job_image_name_taken_meanwhile(self):
+        """test creating a new job where someone else takes
+            the name generated for it before it's added
+
+        - we expect another name to be generated, and used
+        """
+
+        with unittest.mock.patch(
+            "beaver.db.names.generate_random_image_name",
+            side_effect=["testImage", "testUser0-testGroup0-testAdj0-testName0"]
+        ):
+            response = self.client.post("/build", json={
+                "image": {"user_name": "testUser0", "group_name": "testGroup0"},
+                "packages": [1],
+                "new_packages": []
+            })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["image"]["image_name"],
+                         "testUser0-testGroup0-testAdj0-testName0")
+
     def test_create_new_job_user_not_exists(self):
         ...  # TODO
 
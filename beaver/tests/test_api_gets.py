@@ -19,29 +19,42 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from datetime import datetime
+from pathlib import Path
+import tempfile
+import threading
 import unittest
+import unittest.mock
 import os
 
 from fastapi.testclient import TestClient
+import sqlalchemy.event
+import beaver.db.image_usage
 from beaver.db.image_usage import ImageUsage
+from beaver.db.job_events import JobEventBroker
 from beaver.db.images import Image, ImageContents
 from beaver.db.names import ImageNameAdjective, ImageNameName
 from beaver.db.jobs import Job
 
+import beaver.db.packages
 from beaver.db.packages import GitHubPackage, Package
 from beaver.db.groups import Group
 from beaver.db.users import User
 import beaver.db.db
 import beaver.http
 from beaver.models.jobs import JobStatus
+from beaver.utils.env import Env
+from beaver.utils.idm import LocalJSONIdentityManager
+from beaver.utils.nixpkgs import NixpkgsAttribute, PackageSearch, write_index
 from . import set_up_database
 
 
-class TestAPIGetEndpoints(unittest.TestCase):
+class TestAPIGetEndpoints(unittest.TestCase):  # pylint: disable=too-many-public-methods
     """testing all API get endpoints with fake SQLite DB"""
 
-    def setUp(self) -> None:
+    def setUp(self) -> None:  # pylint: disable=too-many-statements
         set_up_database()
+        # some tests use their own identity manager
+        self.idm = getattr(Env, "idm", None)
 
         self.app = beaver.http.app
         self.client = TestClient(self.app)
@@ -272,9 +285,201 @@ class TestAPIGetEndpoints(unittest.TestCase):
         assert _gh["github_user"] == "testGHUser"
         assert _gh["repository_name"] == "testRepoName"
 
-    # def test_get_images_for_user(self):
-    #     # TODO
-    #     ...
+    def test_get_packages_paginated(self):
+        """test getting packages a page at a time
+
+        Expects:
+            - two packages, and a cursor for the next page
+            - following the cursor, the last package and no cursor
+            - together, all three packages
+        """
+        response = self.client.get("/packages", params={"limit": 2})
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertEqual(len(first_page), 2)
+        self.assertIn("X-Next-Cursor", response.headers)
+
+        response = self.client.get("/packages", params={
+            "limit": 2, "after": response.headers["X-Next-Cursor"]})
+        self.assertEqual(response.status_code, 200)
+        second_page = response.json()
+        self.assertEqual(len(second_page), 1)
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+        self.assertEqual([x["package_name"] for x in first_page + second_page], [
+            "testPackage1", "testPackage2", "testPackage3"])
+
+    def test_get_packages_sorted_and_filtered(self):
+        """test sorting and filtering packages
+
+        Expects:
+            - sorting by name descending to reverse the packages
+            - filtering by name prefix to only give matching packages
+            - an unknown sort field or bad cursor to be rejected
+        """
+        response = self.client.get("/packages", params={
+            "sort": "package_name", "order": "desc", "limit": 2})
+        self.assertEqual([x["package_name"] for x in response.json()], [
+            "testPackage3", "testPackage2"])
+
+        response = self.client.get("/packages", params={
+            "sort": "package_name", "order": "desc",
+            "after": response.headers["X-Next-Cursor"]})
+        self.assertEqual([x["package_name"] for x in response.json()], ["testPackage1"])
+
+        response = self.client.get("/packages", params={"name": "testPackage2"})
+        self.assertEqual([x["package_name"] for x in response.json()], ["testPackage2"])
+
+        response = self.client.get("/packages", params={"name": "other"})
+        self.assertEqual(response.json(), [])
+
+        self.assertEqual(self.client.get("/packages", params={
+            "sort": "github_filename"}).status_code, 400)
+        self.assertEqual(self.client.get("/packages", params={
+            "after": "notACursor"}).status_code, 400)
+
+    def test_get_packages_cached(self):
+        """test the package catalog being served from memory,
+            with ETags the client can revalidate with
+
+        Expects:
+            - asking again to not touch the database, and give the same ETag
+            - a 304 with no body when the ETag's given in If-None-Match
+            - a new ETag once a package is added, whether through
+                the API or by someone else
+        """
+
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        catalog = beaver.db.packages.PackageCatalog(check_interval=60)
+        with unittest.mock.patch.object(beaver.db.packages, "package_catalog", catalog):
+            first = self.client.get("/packages")
+            etag = first.headers["ETag"]
+
+            sqlalchemy.event.listen(beaver.db.db.engine, "before_cursor_execute", _count)
+            try:
+                again = self.client.get("/packages")
+                not_modified = self.client.get("/packages", headers={"If-None-Match": etag})
+            finally:
+                sqlalchemy.event.remove(beaver.db.db.engine, "before_cursor_execute", _count)
+
+            self.assertEqual(statements, [])
+            self.assertEqual(again.headers["ETag"], etag)
+            self.assertEqual(again.json(), first.json())
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.content, b"")
+
+            self.client.post("/packages/", json={
+                "package_name": "newPackage", "package_version": None,
+                "commonly_used": False, "package_type": "std",
+                "github_filename": None, "github_package": None})
+            added = self.client.get("/packages", headers={"If-None-Match": etag})
+            self.assertEqual(added.status_code, 200)
+            self.assertEqual(len(added.json()), 4)
+
+            database = next(beaver.db.db.get_db())
+            database.add(Package(package_name="addedElsewhere"))
+            database.commit()
+            catalog.check_interval = 0
+            self.assertEqual(len(self.client.get("/packages").json()), 5)
+
+    def test_search_packages(self):
+        """test searching nixpkgs through the API
+
+        Expects:
+            - a 503 until package search is set up and nixpkgs imported
+            - matching packages, with the ones we've got marked and ranked first,
+                and commonly used ones before those
+        """
+
+        old_search = Env.package_search
+        with tempfile.TemporaryDirectory() as index_dir:
+            try:
+                Env.package_search = None
+                self.assertEqual(self.client.get(
+                    "/packages/search", params={"q": "test"}).status_code, 503)
+
+                Env.package_search = PackageSearch(Path(index_dir) / "index.json")
+                self.assertEqual(self.client.get(
+                    "/packages/search", params={"q": "test"}).status_code, 503)
+
+                write_index([
+                    NixpkgsAttribute("testPackage1", "testPackage1", "1.0", ""),
+                    NixpkgsAttribute("testPackage10", "testPackage10", "1.0", ""),
+                    NixpkgsAttribute("testPackage2", "testPackage2", "2.0", "")
+                ], Path(index_dir) / "index.json")
+                database = next(beaver.db.db.get_db())
+                database.query(Package).filter(Package.package_name == "testPackage2").update(
+                    {"commonly_used": True})
+                database.commit()
+
+                response = self.client.get("/packages/search", params={"q": "testpackage"})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([(x["attribute"], x["known"]) for x in response.json()], [
+                    ("testPackage2", True), ("testPackage1", True), ("testPackage10", False)])
+
+                self.assertEqual(self.client.get(
+                    "/packages/search", params={"q": ""}).status_code, 422)
+            finally:
+                Env.package_search = old_search
+
+    def test_image_usage_time_filter(self):
+        """test filtering image usage by time
+
+        Expects:
+            - usage from 2006 when asking since 2006
+            - nothing when asking for usage since 2007
+        """
+        response = self.client.get("/images/usage/byuser/1", params={
+            "since": datetime(2006, 1, 1).isoformat()})
+        self.assertEqual(len(response.json()), 1)
+
+        response = self.client.get("/images/usage/byuser/1", params={
+            "since": datetime(2007, 1, 1).isoformat()})
+        self.assertEqual(response.json(), [])
+
+    def test_get_images_for_user(self):
+        """test getting the images available to a user,
+            both their own and their groups'
+
+        testUser0 made testImage1 (for testGroup0), and is in
+        testGroup0 and testGroup1, which testImage2 was made for
+
+        Expects:
+            - testImage1 and testImage2 returned
+            - testImage1 only returned once, even though it
+                was made by the user and for one of their groups
+            - the user and group of each image included
+        """
+
+        Env.idm = LocalJSONIdentityManager(Path("_test_idm.json"))
+        Env.idm.add_user_to_group("testUser0", "testGroup0")
+        Env.idm.add_user_to_group("testUser0", "testGroup1")
+
+        response = self.client.get("/images/testUser0")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+
+        self.assertEqual([x["image_name"] for x in data], ["testImage1", "testImage2"])
+        self.assertEqual(data[0]["user"]["user_name"], "testUser0")
+        self.assertEqual(data[1]["group"]["group_name"], "testGroup1")
+
+    def test_get_images_for_unknown_user(self):
+        """test getting the images for a user we've
+            never seen, who isn't in any groups
+
+        Expects:
+            - an empty list
+        """
+
+        Env.idm = LocalJSONIdentityManager(Path("_test_idm.json"))
+
+        response = self.client.get("/images/nobody")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
 
     def test_image_usage_by_user(self):
         """test collecting image usage information
@@ -357,6 +562,39 @@ class TestAPIGetEndpoints(unittest.TestCase):
         assert data[0]["image_id"] == 1
         assert data[0]["datetime"] == self.default_time.isoformat()
 
+    def test_image_usage_stats(self):
+        """test getting counts of image usage over time
+            from the rollup tables
+
+        The usage in the test data went in without the
+        rollups, so they're rebuilt first
+
+        Expects:
+            - one use of image id 1 by user id 1, in the
+                hour and the day of Jan 2 2006
+            - the same usage counted for package id 1
+            - nothing for user id 3
+
+        """
+
+        beaver.db.image_usage.rebuild_usage_rollups(next(beaver.db.db.get_db()))
+
+        response = self.client.get("/images/usage/stats/byuser/1?granularity=hour")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "granularity": "hour",
+            "total": 1,
+            "points": [{"bucket": "2006-01-02T22:00:00", "count": 1}]
+        })
+
+        response = self.client.get("/images/usage/stats/bypackage/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["points"], [{"bucket": "2006-01-02T00:00:00", "count": 1}])
+
+        response = self.client.get("/images/usage/stats/byuser/3")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["total"], 0)
+
     def test_get_job_information(self):
         """test getting counts of jobs in various states
 
@@ -367,8 +605,14 @@ class TestAPIGetEndpoints(unittest.TestCase):
                 "jobs_pending_image_build": 2,
                 "jobs_building_image": 8,
                 "jobs_completed_last_24_hours": 5,
-                "jobs_failed_last_24_hours": 3
+                "jobs_failed_last_24_hours": 3,
+                "jobs_submitted_last_24_hours": 29,
+                "jobs_deduplicated_last_24_hours": 0,
+                "deduplication_rate_last_24_hours": 0
             }
+
+            (the old finished jobs aren't counted as submitted,
+            as they finished before the last 24 hours)
         """
 
         response = self.client.get("/jobs")
@@ -379,9 +623,36 @@ class TestAPIGetEndpoints(unittest.TestCase):
             "jobs_pending_image_build": 2,
             "jobs_building_image": 8,
             "jobs_completed_last_24_hours": 5,
-            "jobs_failed_last_24_hours": 3
+            "jobs_failed_last_24_hours": 3,
+            "jobs_submitted_last_24_hours": 29,
+            "jobs_deduplicated_last_24_hours": 0,
+            "deduplication_rate_last_24_hours": 0
         }
 
+    def test_get_job_information_one_query(self):
+        """test the job counts take one query, and polling
+            again straight away reuses them
+
+        Expects:
+            - one query for the first request
+            - none for the second
+        """
+
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        sqlalchemy.event.listen(beaver.db.db.engine, "before_cursor_execute", _count)
+        try:
+            first = self.client.get("/jobs").json()
+            self.assertEqual(len(statements), 1)
+
+            self.assertEqual(self.client.get("/jobs").json(), first)
+            self.assertEqual(len(statements), 1)
+        finally:
+            sqlalchemy.event.remove(beaver.db.db.engine, "before_cursor_execute", _count)
+
     def test_get_job(self):
         """test getting job information
 
@@ -488,6 +759,55 @@ class TestAPIGetEndpoints(unittest.TestCase):
         assert data["endtime"] == self.now.isoformat()
         assert data["detail"] == "Failed Build 1"
 
+    def test_stream_job_events(self):
+        """test streaming a job's progress as server-sent events
+
+        Test Cases:
+            - Stream Job c1, which has already succeeded
+            Expects:
+                - just its status, and the stream to end
+
+            - Stream Job bi1, which then succeeds in another process
+            Expects:
+                - its status now, the build log published in
+                    this process, then its new status
+
+            - Stream a job that doesn't exist
+            Expects:
+                - 404
+        """
+
+        old_events, Env.job_events = Env.job_events, JobEventBroker(poll_interval=0.05)
+        try:
+            response = self.client.get("/jobs/c1/events")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+            self.assertEqual(response.text.count("event: status"), 1)
+            self.assertIn('"status": "Succeeded"', response.text)
+
+            def _finish_build():
+                Env.job_events.publish_log("bi1", "building layer 1 of 3")
+                database = next(beaver.db.db.get_db())
+                database.query(Job).filter(Job.job_id == "bi1").update(
+                    {Job.status: JobStatus.Succeeded})
+                database.commit()
+                database.close()
+
+            finish = threading.Timer(0.2, _finish_build)
+            finish.start()
+            response = self.client.get("/jobs/bi1/events")
+            finish.join()
+
+            events = [line for line in response.text.splitlines() if line.startswith("data:")]
+            self.assertEqual(len(events), 3)
+            self.assertIn('"status": "BuildingImage"', events[0])
+            self.assertIn('"line": "building layer 1 of 3"', events[1])
+            self.assertIn('"status": "Succeeded"', events[2])
+
+            self.assertEqual(self.client.get("/jobs/missing/events").status_code, 404)
+        finally:
+            Env.job_events = old_events
+
     def test_get_image_names(self):
         """test getting possible image name parts
 
@@ -527,3 +847,11 @@ class TestAPIGetEndpoints(unittest.TestCase):
 
     def tearDown(self) -> None:
         os.remove("_tmp_db.db")
+        if self.idm is not None:
+            Env.idm = self.idm
+        elif hasattr(Env, "idm"):
+            del Env.idm
+        try:
+            os.remove("_test_idm.json")
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,178 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from pathlib import Path
+import tempfile
+import unittest
+
+from beaver.builders.definition.nix import NixDefinition, NixLayeredDefinitionBuilder
+from beaver.builders.image.layered import LayeredImage, LayeredImageBuilder
+from beaver.builders.worker import pipeline_from_config
+from beaver.db.packages import Package
+from beaver.models.packages import PackageType
+from beaver.utils.repository.tmp import TempRepository
+
+
+class TestLayeredBuilders(unittest.TestCase):
+    """testing the builders making layered images with Nix"""
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.dir = Path(self._dir.name)
+
+        (self.dir / "derivations").mkdir()
+        (self.dir / "derivations" / "rvtest.nix").write_text(
+            "rvtest = pkgs.stdenv.mkDerivation { };\n", encoding="utf-8")
+
+        self.builder = NixLayeredDefinitionBuilder(
+            self.dir / "definitions", self.dir / "derivations")
+
+    def _packages(self):
+        return {
+            Package(package_name="samtools", commonly_used=True,
+                    package_type=PackageType.std),
+            Package(package_name="bcftools", commonly_used=False,
+                    package_type=PackageType.std),
+            Package(package_name="git", commonly_used=True,
+                    package_type=PackageType.std),
+            Package(package_name="rvtest", commonly_used=False,
+                    package_type=PackageType.std, github_filename="rvtest.nix"),
+            Package(package_name="ggplot2", commonly_used=False,
+                    package_type=PackageType.R),
+            Package(package_name="numpy", commonly_used=True,
+                    package_type=PackageType.py)
+        }
+
+    def test_layers(self):
+        """test the packages are split between the layers
+
+        Expects:
+            - the defaults in the base image, even if asked for again
+            - commonly used packages in the common image on top of it
+            - everything else in the image itself, on top of that
+        """
+
+        definition = self.builder.build(self._packages(), "user-group-image")
+        self.assertEqual(definition.image_name, "user-group-image")
+
+        nix = definition.path.read_text(encoding="utf-8")
+        base, common, image = (
+            nix[nix.index("base = "):nix.index("common = ")],
+            nix[nix.index("common = "):nix.index("in\n")],
+            nix[nix.index("in\n"):]
+        )
+
+        self.assertIn("# Image Name: user-group-image", nix)
+        self.assertEqual(nix.count("pkgs.git\n"), 1)
+        for default in ("bash", "coreutils", "git", "openssl"):
+            self.assertIn(f"pkgs.{default}\n", base)
+        self.assertIn("pkgs.samtools", common)
+        self.assertIn("fromImage = base;", common)
+        self.assertIn("fromImage = common;", image)
+        for package in ("pkgs.bcftools", "rvtest", "r-with-packages", "python-with-packages"):
+            self.assertIn(package, image)
+        self.assertIn("rvtest = pkgs.stdenv.mkDerivation", nix)
+        self.assertNotIn("common = ", self.builder.render(set(), "image"))
+
+    def test_invalid_names(self):
+        """test names that can't go in a Nix file are refused
+
+        Expects:
+            - a ValueError for the package name, and the image name
+        """
+
+        with self.assertRaises(ValueError):
+            self.builder.render({Package(package_name="a; rm -rf /",
+                                         package_type=PackageType.std)}, "image")
+        with self.assertRaises(ValueError):
+            self.builder.render(set(), 'image"; evil')
+
+    def test_building_image(self):
+        """test the image builder runs the stream the
+            definition makes into an archive
+
+        Expects:
+            - nix-build run on the definition
+            - the stream it makes written to an archive named after the image
+        """
+
+        calls = []
+
+        def _run(args, stdout=None):
+            calls.append(args)
+            if stdout is not None:
+                stdout.write(b"image")
+
+        definition = NixDefinition.from_repo(
+            next(iter(self.builder.build(set(), "image").to_repo())))
+        image = LayeredImageBuilder(self.dir / "images", run=_run).build(definition)
+
+        self.assertIsInstance(image, LayeredImage)
+        self.assertEqual(Path(image), self.dir / "images" / "image.tar")
+        self.assertEqual(Path(image).read_bytes(), b"image")
+        self.assertEqual(calls[0][:2], ["nix-build", str(definition.path)])
+        self.assertEqual(calls[1], [str(self.dir / "images" / "image-stream")])
+
+    def test_needs_repository(self):
+        """test the Nix builders aren't used without a repository
+            to pass what they make between them
+
+        Expects:
+            - a ValueError from the config with no repository
+            - a ValueError for a definition from an empty repository
+        """
+
+        with self.assertRaises(ValueError):
+            pipeline_from_config({"definitions": {"output_dir": self.dir / "definitions"}})
+        with self.assertRaises(ValueError):
+            pipeline_from_config({"images": {"output_dir": self.dir / "images"}})
+        with self.assertRaises(ValueError):
+            NixDefinition.from_repo(TempRepository().get("image"))
+
+        pipeline = pipeline_from_config({
+            "definitions": {"output_dir": self.dir / "definitions"},
+            "images": {"output_dir": self.dir / "images"},
+            "repository": {"root": self.dir / "repository"},
+            "definition_workers": 1,
+            "image_workers": 1
+        })
+        self.assertEqual(len(pipeline.workers), 2)
+
+    def test_per_image_resources(self):
+        """test each image has to be given some CPUs and disk
+
+        Expects:
+            - a ValueError for no (or negative) CPUs or disk per image
+            - no limit from disk per image that isn't given
+        """
+
+        for option in ("cpus_per_image", "disk_per_image"):
+            for value in (0, -1):
+                with self.subTest(option=option, value=value):
+                    with self.assertRaises(ValueError):
+                        pipeline_from_config({"cpu_budget": 4, "disk_budget": 100,
+                                              option: value})
+
+        pipeline = pipeline_from_config({"definition_workers": 0, "image_workers": 2,
+                                         "cpu_budget": 4, "disk_per_image": None})
+        self.assertEqual(len(pipeline.workers), 2)
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
@@ -0,0 +1,99 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import unittest
+
+from fastapi.testclient import TestClient
+import sqlalchemy.exc
+from sqlalchemy.pool import QueuePool
+
+import beaver.db.db
+import beaver.http
+from beaver.utils.env import Env
+from beaver.tests import set_up_database
+
+
+class TestConnectionPool(unittest.TestCase):
+    """testing the database connection pool, and its metrics"""
+
+    def setUp(self) -> None:
+        set_up_database()
+
+    def test_pool_sizing(self):
+        """test a pool sized from the config
+
+        Expects:
+            - a connection to wait for, and time out, when they're all in use
+            - the wait, timeout and connections in use in the metrics
+            - SQLAlchemy's own pool for SQLite, if it isn't sized
+        """
+
+        beaver.db.db.create_connectors(
+            "sqlite:///./_tmp_db.db", pool_size=1, max_overflow=0, pool_timeout=0.1)
+        self.assertIsInstance(beaver.db.db.engine.pool, QueuePool)
+
+        connection = beaver.db.db.engine.connect()
+        with self.assertRaises(sqlalchemy.exc.TimeoutError):
+            beaver.db.db.engine.connect()
+
+        stats = beaver.db.db.get_pool_stats()
+        self.assertEqual((stats["size"], stats["checked_out"], stats["overflow"]), (1, 1, 0))
+        self.assertEqual((stats["checkouts"], stats["connects"], stats["timeouts"]), (1, 1, 1))
+        self.assertGreaterEqual(stats["wait_seconds_max"], 0.1)
+
+        connection.close()
+        beaver.db.db.engine.connect().close()
+        stats = beaver.db.db.get_pool_stats()
+        self.assertEqual((stats["checked_out"], stats["checkouts"], stats["connects"]), (0, 2, 1))
+
+        beaver.db.db.engine.dispose()
+        beaver.db.db.create_connectors("sqlite:///./_tmp_db.db")
+        self.assertNotIn("size", beaver.db.db.get_pool_stats())
+
+    def test_connecting_from_config(self):
+        """test the web app connecting to the database in the config
+            when it starts, rather than when it's imported
+
+        Expects:
+            - the URL and pool from the config
+            - the pool's metrics from /metrics/db
+        """
+
+        old_database, old_engine = Env.database, beaver.db.db.engine
+        Env.database = {"url": "sqlite:///./_tmp_db.db", "pool_size": 2, "pool_pre_ping": True}
+        beaver.db.db.engine = None
+        try:
+            with TestClient(beaver.http.app) as client:
+                self.assertEqual(str(beaver.db.db.engine.url), "sqlite:///./_tmp_db.db")
+                self.assertEqual(client.get("/images/usage/byuser/1").status_code, 200)
+                metrics = client.get("/metrics/db").json()
+        finally:
+            beaver.db.db.engine.dispose()
+            Env.database = old_database
+            old_engine.dispose()
+
+        self.assertEqual(metrics["size"], 2)
+        self.assertEqual(metrics["checked_out"], 0)
+        self.assertGreaterEqual(metrics["checkouts"], 1)
+
+    def tearDown(self) -> None:
+        beaver.db.db.engine.dispose()
+        os.remove("_tmp_db.db")
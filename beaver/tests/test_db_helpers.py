@@ -18,14 +18,34 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from datetime import datetime, timedelta
 import os
+import threading
+import time
 import unittest
+import unittest.mock
+
+import sqlalchemy.event
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 import beaver.db.db
 from beaver.db.groups import Group
-from beaver.db.names import ImageNameAdjective, ImageNameName, generate_random_image_name
+from beaver.db.image_usage import (ImageUsage, rebuild_usage_rollups, record_image_usage,
+                                   record_image_usages)
+from beaver.db.images import Image, get_images_visible_to_user
+from beaver.db.jobs import Job, get_job_counts
+from beaver.db.names import (ImageNameAdjective, ImageNameAllocator, ImageNameName,
+                             ImageNamesExhausted, create_names, generate_random_image_name)
+import beaver.db.names
+from beaver.db.packages import GitHubPackage, Package, package_set_hash
+from beaver.db.usage_buffer import ImageUsageBuffer, UsageBufferFull
+from beaver.db.usage_rollups import get_usage_series_by_image, get_usage_series_for_user
 from beaver.db.users import User
 import beaver.http
+from beaver.models.image_usage import ImageUsageBase, UsageGranularity
+from beaver.models.jobs import JobStatus
+from beaver.models.names import ImageNameElements
+from beaver.models.packages import PackageType
 from beaver.tests import set_up_database
 
 
@@ -70,6 +90,70 @@ class TestDBHelpers(unittest.TestCase):
         self.assertIn(
             image_name, {f"testUser-testGroup-{x}" for x in self.possible_image_names})
 
+    def test_image_names_run_out(self):
+        """test that generated names are never reused, and that
+            we find out as soon as they've all been used
+
+        Expects:
+            - every name to be generated once, for the same user and group
+            - then ImageNamesExhausted, rather than looping forever
+            - another group to still have every name
+            - new name elements to be used straight away
+        """
+
+        database = next(beaver.db.db.get_db())
+        generated = set()
+        for _ in range(4):
+            image_name = generate_random_image_name(database, "testUser", "testGroup")
+            self.assertNotIn(image_name, generated)
+            generated.add(image_name)
+            database.add(Image(image_name=image_name, user_id=1, group_id=1))
+            database.commit()
+
+        self.assertEqual(generated,
+                         {f"testUser-testGroup-{x}" for x in self.possible_image_names})
+        with self.assertRaises(ImageNamesExhausted):
+            generate_random_image_name(database, "testUser", "testGroup")
+        self.assertIn(generate_random_image_name(database, "testUser", "testGroupOther"),
+                      {f"testUser-testGroupOther-{x}" for x in self.possible_image_names})
+
+        create_names(database, ImageNameElements(adjectives=["adjective2"], names=[]))
+        self.assertIn(generate_random_image_name(database, "testUser", "testGroup"),
+                      {"testUser-testGroup-adjective2-name0",
+                       "testUser-testGroup-adjective2-name1"})
+
+    def test_image_names_walked_without_listing(self):
+        """test that names are picked without going
+            through every pair of adjective and name
+
+        Expects:
+            - the walk to reach every pair once, however many there are
+            - a name from a million pairs with one query
+        """
+
+        # pylint: disable=protected-access
+        for size in (0, 1, 2, 3, 12, 97):
+            self.assertEqual(sorted(beaver.db.names._random_walk(size)), list(range(size)))
+
+        database = next(beaver.db.db.get_db())
+        allocator = ImageNameAllocator()
+        elements = [f"x{i}" for i in range(1000)]
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        with unittest.mock.patch.object(allocator, "_get_elements",
+                                        return_value=(elements, elements)):
+            sqlalchemy.event.listen(beaver.db.db.engine, "before_cursor_execute", _count)
+            try:
+                image_name = allocator.allocate(database, "testUser", "testGroup")
+            finally:
+                sqlalchemy.event.remove(beaver.db.db.engine, "before_cursor_execute", _count)
+
+        self.assertTrue(image_name.startswith("testUser-testGroup-x"))
+        self.assertEqual(len(statements), 1)
+
     def test_get_user_id_from_user_name_that_doesnt_exist(self):
         """test that when we request the user id for a user
         that doesn't exist, it creates the user in the database
@@ -109,5 +193,308 @@ class TestDBHelpers(unittest.TestCase):
             "testGroup", database)
         self.assertEqual(group_id, 1)
 
+    def test_get_images_visible_to_user(self):
+        """test getting the images for a user and their
+            groups in one go
+
+        Expects:
+            - the user's own image, and the image for the
+                group they're in, but not the other group's
+            - each image once, even when it matches on
+                both user and group
+        """
+
+        database = next(beaver.db.db.get_db())
+        other_group_id = Group.get_or_make_group_id_for_group_name(
+            "testOtherGroup", database)
+        other_user_id = User.get_or_make_user_id_for_user_name(
+            "testOtherUser", database)
+
+        database.add(Image(image_name="own", user_id=1, group_id=1))
+        database.add(Image(image_name="group", user_id=other_user_id, group_id=1))
+        database.add(Image(image_name="other", user_id=other_user_id,
+                           group_id=other_group_id))
+        database.commit()
+
+        self.assertEqual([x.image_name for x in get_images_visible_to_user(
+            database, "testUser", ["testGroup"]).items], ["own", "group"])
+        self.assertEqual([x.image_name for x in get_images_visible_to_user(
+            database, "testUser", []).items], ["own"])
+        self.assertEqual([x.image_name for x in get_images_visible_to_user(
+            database, "nobody", ["testOtherGroup"]).items], ["other"])
+
+    def test_job_counts_cached_per_period(self):
+        """test the cached job counts are kept apart for each period
+
+        Expects:
+            - a job that failed yesterday to count in the last two
+                days, but not the last day, even when both are cached
+        """
+
+        database = next(beaver.db.db.get_db())
+        database.add(Image(image_name="image", user_id=1, group_id=1))
+        database.add(Job(job_id="old", image_id=1, status=JobStatus.Failed,
+                         endtime=datetime.now() - timedelta(hours=30)))
+        database.commit()
+
+        self.assertEqual(get_job_counts(database, 24, ttl=60).statuses[JobStatus.Failed], 0)
+        self.assertEqual(get_job_counts(database, 48, ttl=60).statuses[JobStatus.Failed], 1)
+        self.assertEqual(get_job_counts(database, 24, ttl=60).statuses[JobStatus.Failed], 0)
+
+    def tearDown(self) -> None:
+        os.remove("_tmp_db.db")
+
+
+class TestPackageSetHash(unittest.TestCase):
+    """testing the hash that identifies identical builds"""
+
+    def test_package_set_hash(self):
+        """test the hash is the same for the same packages,
+            however they're given, and different otherwise
+
+        Expects:
+            - order, duplicates and IDs not to matter
+            - a different version or GitHub commit to
+        """
+
+        def _package(package_id, name, version=None, commit=None):
+            package = Package(package_id=package_id, package_name=name,
+                              package_version=version, package_type=PackageType.std)
+            if commit is not None:
+                package.github_package = GitHubPackage(
+                    github_user="user", repository_name=name, commit_hash=commit)
+            return package
+
+        packages = [_package(1, "a"), _package(2, "b", "1.0"), _package(3, "c", commit="abc")]
+        same = [_package(6, "c", commit="abc"), _package(4, "a"), _package(5, "b", "1.0"),
+                _package(7, "a")]
+
+        self.assertEqual(package_set_hash(packages), package_set_hash(same))
+        self.assertNotEqual(package_set_hash(packages), package_set_hash(
+            [_package(1, "a"), _package(2, "b", "1.1"), _package(3, "c", commit="abc")]))
+        self.assertNotEqual(package_set_hash(packages), package_set_hash(
+            [_package(1, "a"), _package(2, "b", "1.0"), _package(3, "c", commit="abd")]))
+
+
+class TestImageUsageBuffer(unittest.TestCase):
+    """testing writing image usage in batches in the background"""
+
+    def setUp(self) -> None:
+        set_up_database()
+
+        database = next(beaver.db.db.get_db())
+        database.add(User(user_name="testUser"))
+        database.add(Group(group_name="testGroup"))
+        database.commit()
+        database.add(Image(image_name="testImage", user_id=1, group_id=1))
+        database.commit()
+
+        self.usage = ImageUsageBase(image_id=1, user_id=1, group_id=1)
+
+    def test_usage_written_in_one_batch(self):
+        """test that usage recorded close together is written
+            in a single batch, with the times it was recorded
+
+        Expects:
+            - nothing written before the buffer is closed
+            - all five usages written, in one batch, when it is
+        """
+
+        buffer = ImageUsageBuffer(max_batch=10, flush_interval=60)
+        before = datetime.now()
+        for _ in range(4):
+            buffer.record(self.usage)
+        buffer.record(self.usage, datetime(2006, 1, 2))
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 0)
+
+        buffer.close()
+        times = sorted(x.datetime for x in database.query(ImageUsage).all())
+        self.assertEqual(len(times), 5)
+        self.assertEqual(times[0], datetime(2006, 1, 2))
+        self.assertTrue(all(x >= before for x in times[1:]))
+
+        self.assertEqual(buffer.stats()["written"], 5)
+        self.assertEqual(buffer.stats()["batches"], 1)
+
+    def test_full_buffer_pushes_back(self):
+        """test that once the buffer is full, recording
+            more usage is refused rather than queued
+
+        Expects:
+            - the third usage to be refused whilst the first
+                is being written and the second is waiting
+            - the first two to be written once the database is free
+        """
+
+        writing = threading.Event()
+        database_free = threading.Event()
+
+        def _slow_session():
+            writing.set()
+            database_free.wait(5)
+            return beaver.db.db.session()
+
+        buffer = ImageUsageBuffer(
+            _slow_session, max_batch=1, flush_interval=0, max_queue=1, put_timeout=0.01)
+        buffer.record(self.usage)
+        writing.wait(5)
+        buffer.record(self.usage)
+
+        with self.assertRaises(UsageBufferFull):
+            buffer.record(self.usage)
+
+        database_free.set()
+        buffer.close()
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 2)
+        self.assertEqual(buffer.stats()["rejected"], 1)
+
+    def test_refused_usage_dropped_alone(self):
+        """test that a usage the database refuses doesn't take
+            the rest of its batch with it
+
+        Expects:
+            - every usage but the refused one written
+            - only the refused one counted as failed
+        """
+
+        def _refusing(database, batch):
+            if any(x.image_id == 999 for x, _ in batch):
+                raise IntegrityError("INSERT INTO image_usage", {}, Exception("foreign key"))
+            return record_image_usages(database, batch)
+
+        buffer = ImageUsageBuffer(max_batch=10, flush_interval=60)
+        for i in range(7):
+            buffer.record(ImageUsageBase(image_id=999, user_id=1, group_id=1) if i == 4
+                          else self.usage)
+
+        with unittest.mock.patch("beaver.db.usage_buffer.record_image_usages", _refusing):
+            buffer.close()
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 6)
+        self.assertEqual((buffer.stats()["written"], buffer.stats()["failed"]), (6, 1))
+
+    def test_unreachable_database_retried(self):
+        """test that usage is kept, and callers pushed back on,
+            while the database can't be reached
+
+        Expects:
+            - the batch being retried kept, and the queue not emptied,
+                so more usage is refused once it's full
+            - everything kept written once the database is back
+        """
+
+        database_up = threading.Event()
+        attempts = []
+
+        def _unreachable(database, batch):
+            attempts.append(1)
+            if not database_up.is_set():
+                raise OperationalError("INSERT INTO image_usage", {}, Exception("gone away"))
+            return record_image_usages(database, batch)
+
+        buffer = ImageUsageBuffer(max_batch=1, flush_interval=0, max_queue=1,
+                                  put_timeout=0.01, retry_interval=0.01)
+        with unittest.mock.patch("beaver.db.usage_buffer.record_image_usages", _unreachable):
+            buffer.record(self.usage)
+            while len(attempts) < 3:
+                time.sleep(0.01)
+            buffer.record(self.usage)
+            with self.assertRaises(UsageBufferFull):
+                buffer.record(self.usage)
+
+            database_up.set()
+            while buffer.stats()["written"] < 2:
+                time.sleep(0.01)
+            buffer.close()
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(database.query(ImageUsage).count(), 2)
+        self.assertEqual(buffer.stats()["failed"], 0)
+        self.assertGreaterEqual(buffer.stats()["retries"], 2)
+
+    def tearDown(self) -> None:
+        os.remove("_tmp_db.db")
+
+
+class TestUsageRollups(unittest.TestCase):
+    """testing the hourly and daily image usage rollups"""
+
+    def setUp(self) -> None:
+        set_up_database()
+
+        database = next(beaver.db.db.get_db())
+        for i in range(2):
+            database.add(User(user_name=f"testUser{i}"))
+            database.add(Group(group_name=f"testGroup{i}"))
+        database.commit()
+        database.add(Image(image_name="testImage", user_id=1, group_id=1))
+        database.commit()
+
+        usage = ImageUsageBase(image_id=1, user_id=1, group_id=1)
+        other_user = ImageUsageBase(image_id=1, user_id=2, group_id=2)
+        record_image_usages(database, [
+            (usage, datetime(2006, 1, 2, 22, 4)),
+            (usage, datetime(2006, 1, 2, 22, 59)),
+            (usage, datetime(2006, 1, 2, 23, 1)),
+            (other_user, datetime(2006, 1, 2, 23, 30)),
+            (usage, datetime(2006, 1, 3, 9, 0))
+        ])
+
+    def test_rollups_counted_as_recorded(self):
+        """test that recording usage counts it into the
+            right hourly and daily buckets
+
+        Expects:
+            - the user's usage counted into three hours, over two days
+            - the other user's usage counted towards the image
+            - usage recorded later added onto the existing counts
+        """
+
+        database = next(beaver.db.db.get_db())
+
+        self.assertEqual(
+            get_usage_series_for_user(database, 1, UsageGranularity.hour),
+            [(datetime(2006, 1, 2, 22), 2),
+             (datetime(2006, 1, 2, 23), 1),
+             (datetime(2006, 1, 3, 9), 1)])
+        self.assertEqual(
+            get_usage_series_for_user(database, 1, UsageGranularity.day),
+            [(datetime(2006, 1, 2), 3), (datetime(2006, 1, 3), 1)])
+        self.assertEqual(
+            get_usage_series_by_image(database, 1, UsageGranularity.day),
+            [(datetime(2006, 1, 2), 4), (datetime(2006, 1, 3), 1)])
+
+        record_image_usages(database, [
+            (ImageUsageBase(image_id=1, user_id=1, group_id=1), datetime(2006, 1, 3, 12))])
+        self.assertEqual(
+            get_usage_series_for_user(database, 1, UsageGranularity.day,
+                                      since=datetime(2006, 1, 3, 10)),
+            [(datetime(2006, 1, 3), 2)])
+
+        record_image_usage(database, ImageUsageBase(image_id=1, user_id=1, group_id=1))
+        self.assertEqual(
+            get_usage_series_for_user(database, 1, UsageGranularity.hour,
+                                      since=datetime(2007, 1, 1))[0][1], 1)
+
+    def test_rebuilding_rollups(self):
+        """test that the rollups can be rebuilt from the
+            raw usage, for usage recorded before they existed
+
+        Expects:
+            - all the usage to be recounted
+            - the same counts as when they were kept up to date
+        """
+
+        database = next(beaver.db.db.get_db())
+        expected = get_usage_series_by_image(database, 1, UsageGranularity.hour)
+
+        self.assertEqual(rebuild_usage_rollups(database), 5)
+        self.assertEqual(
+            get_usage_series_by_image(database, 1, UsageGranularity.hour), expected)
+
     def tearDown(self) -> None:
         os.remove("_tmp_db.db")
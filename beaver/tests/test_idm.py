@@ -18,11 +18,14 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import json
 from pathlib import Path
+from typing import Dict, List, Set
 import unittest
 
-from beaver.utils.idm import LocalJSONIdentityManager
+from beaver.utils.idm import CachingIdentityManager, IdentityManager, LocalJSONIdentityManager
+from beaver.utils.idm.pool import ConnectionPool
 
 
 class TestLocalIdentityManager(unittest.TestCase):
@@ -77,3 +80,298 @@ class TestLocalIdentityManager(unittest.TestCase):
         self.assertEqual(_idm.get_groups_for_user(
             "userX"), {"groupX", "groupY"})
         self.assertEqual(_idm.get_groups_for_user("userY"), {"groupX"})
+
+    def test_get_user_groups_async(self):
+        """test reading groups through the async
+            interface gives the same answer
+        """
+
+        _idm = LocalJSONIdentityManager(Path("_test.json"))
+        _idm.add_user_to_group("userX", "groupX")
+        _idm.add_user_to_group("userX", "groupY")
+
+        self.assertEqual(asyncio.run(_idm.get_groups_for_user_async(
+            "userX")), {"groupX", "groupY"})
+
+    def test_get_groups_for_many_users(self):
+        """test getting the groups for several users at
+            once, including one that isn't in any group
+        """
+
+        _idm = LocalJSONIdentityManager(Path("_test.json"))
+        _idm.add_user_to_group("userX", "groupX")
+        _idm.add_user_to_group("userX", "groupY")
+        _idm.add_user_to_group("userY", "groupX")
+
+        self.assertEqual(_idm.get_groups_for_users(["userX", "userY", "userZ"]), {
+            "userX": {"groupX", "groupY"},
+            "userY": {"groupX"},
+            "userZ": set()
+        })
+
+    def test_file_changes_picked_up(self):
+        """test that changes made to the file by something
+            else are seen on the next lookup
+        """
+
+        _idm = LocalJSONIdentityManager(Path("_test.json"))
+        _idm.add_user_to_group("userX", "groupX")
+        self.assertEqual(_idm.get_groups_for_user("userX"), {"groupX"})
+
+        with open("_test.json", "w", encoding="UTF-8") as idm_file:
+            json.dump({"groupX": ["userX"], "groupYY": ["userX", "userY"]}, idm_file)
+
+        self.assertEqual(_idm.get_groups_for_user(
+            "userX"), {"groupX", "groupYY"})
+        self.assertEqual(_idm.get_groups_for_user("userY"), {"groupYY"})
+
+    def test_batched_additions(self):
+        """test that additions in a batch are only written
+            to the file at the end, and aren't duplicated
+        """
+
+        _idm = LocalJSONIdentityManager(Path("_test.json"))
+        with _idm.batch():
+            _idm.add_user_to_group("userA", "groupA")
+            _idm.add_users_to_groups([("userB", "groupA"), ("userA", "groupA")])
+            self.assertFalse(Path("_test.json").exists())
+            self.assertEqual(_idm.get_groups_for_user("userB"), {"groupA"})
+
+        with open("_test.json", encoding="UTF-8") as idm_file:
+            self.assertEqual(json.load(idm_file), {"groupA": ["userA", "userB"]})
+
+
+class _CountingIdentityManager(IdentityManager):
+    """an identity manager that counts how many times
+        it has been asked about each user
+    """
+
+    def __init__(self, groups: Dict[str, Set[str]]) -> None:
+        self.groups = groups
+        self.calls: Dict[str, int] = {}
+
+    def get_groups_for_user(self, user_id: str) -> Set[str]:
+        self.calls[user_id] = self.calls.get(user_id, 0) + 1
+        return set(self.groups.get(user_id, set()))
+
+
+class TestCachingIdentityManager(unittest.TestCase):
+    """test cases for the caching layer that sits in
+        front of an identity manager
+    """
+
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.backend = _CountingIdentityManager({
+            "user0": {"group0", "group1"},
+            "user1": {"group0"},
+            "user2": {"group2"}
+        })
+        self.idm = CachingIdentityManager(
+            self.backend, max_size=2, ttl=10, negative_ttl=2,
+            clock=lambda: self.now)
+
+    def test_repeated_lookups_hit_cache(self):
+        """test that asking for the same user twice only
+            asks the backend once
+        """
+        self.assertEqual(self.idm.get_groups_for_user(
+            "user0"), {"group0", "group1"})
+        self.assertEqual(self.idm.get_groups_for_user(
+            "user0"), {"group0", "group1"})
+        self.assertEqual(self.backend.calls["user0"], 1)
+
+        stats = self.idm.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_entries_expire(self):
+        """test that an entry older than the TTL
+            goes back to the backend
+        """
+        self.idm.get_groups_for_user("user0")
+        self.now = 11
+        self.idm.get_groups_for_user("user0")
+        self.assertEqual(self.backend.calls["user0"], 2)
+
+    def test_unknown_users_cached_briefly(self):
+        """test that users with no groups are cached,
+            but for the shorter negative TTL
+        """
+        self.assertEqual(self.idm.get_groups_for_user("nobody"), set())
+        self.idm.get_groups_for_user("nobody")
+        self.assertEqual(self.backend.calls["nobody"], 1)
+        self.assertEqual(self.idm.stats()["negative_hits"], 1)
+
+        self.now = 3
+        self.idm.get_groups_for_user("nobody")
+        self.assertEqual(self.backend.calls["nobody"], 2)
+
+    def test_least_recently_used_evicted(self):
+        """test that going over `max_size` throws out
+            the least recently used user
+        """
+        self.idm.get_groups_for_user("user0")
+        self.idm.get_groups_for_user("user1")
+        self.idm.get_groups_for_user("user0")
+        self.idm.get_groups_for_user("user2")
+
+        self.idm.get_groups_for_user("user0")
+        self.idm.get_groups_for_user("user1")
+        self.assertEqual(self.backend.calls["user0"], 1)
+        self.assertEqual(self.backend.calls["user1"], 2)
+        self.assertEqual(self.idm.stats()["evictions"], 2)
+
+    def test_invalidate(self):
+        """test that invalidating a user, or the whole cache,
+            makes us go back to the backend
+        """
+        self.idm.get_groups_for_user("user0")
+        self.idm.get_groups_for_user("user1")
+
+        self.idm.invalidate("user0")
+        self.idm.get_groups_for_user("user0")
+        self.idm.get_groups_for_user("user1")
+        self.assertEqual(self.backend.calls["user0"], 2)
+        self.assertEqual(self.backend.calls["user1"], 1)
+
+        self.idm.invalidate()
+        self.idm.get_groups_for_user("user1")
+        self.assertEqual(self.backend.calls["user1"], 2)
+
+    def test_async_lookups_use_cache(self):
+        """test that async lookups share the cache
+            with sync ones
+        """
+        self.idm.get_groups_for_user("user0")
+        self.assertEqual(asyncio.run(self.idm.get_groups_for_user_async(
+            "user0")), {"group0", "group1"})
+        self.assertEqual(asyncio.run(self.idm.get_groups_for_user_async(
+            "user1")), {"group0"})
+        self.idm.get_groups_for_user("user1")
+
+        self.assertEqual(self.backend.calls, {"user0": 1, "user1": 1})
+
+    def test_bulk_lookup_fallback(self):
+        """test that a backend without its own bulk lookup
+            answers for every user asked for
+        """
+        self.assertEqual(self.backend.get_groups_for_users(["user0", "user1", "nobody"]), {
+            "user0": {"group0", "group1"},
+            "user1": {"group0"},
+            "nobody": set()
+        })
+
+    def test_bulk_lookup_only_asks_for_misses(self):
+        """test that a bulk lookup through the cache only
+            goes to the backend for users it doesn't have
+        """
+        self.idm.get_groups_for_user("user0")
+        self.assertEqual(self.idm.get_groups_for_users(["user0", "user1"]), {
+            "user0": {"group0", "group1"},
+            "user1": {"group0"}
+        })
+        self.assertEqual(self.backend.calls, {"user0": 1, "user1": 1})
+
+        self.assertEqual(asyncio.run(self.idm.get_groups_for_users_async(
+            ["user1"])), {"user1": {"group0"}})
+        self.assertEqual(self.backend.calls, {"user0": 1, "user1": 1})
+
+    def test_cached_groups_not_shared(self):
+        """test that modifying a returned set doesn't
+            change what's in the cache
+        """
+        self.idm.get_groups_for_user("user0").add("groupX")
+        self.assertEqual(self.idm.get_groups_for_user(
+            "user0"), {"group0", "group1"})
+
+
+class _FakeConnection:
+    """a stand-in for a directory connection"""
+
+    def __init__(self, number: int) -> None:
+        self.number = number
+        self.healthy = True
+        self.closed = False
+
+
+class TestConnectionPool(unittest.TestCase):
+    """test cases for the pool of long-lived
+        connections used by the LDAP identity manager
+    """
+
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.made: List[_FakeConnection] = []
+
+        def _factory() -> _FakeConnection:
+            conn = _FakeConnection(len(self.made))
+            self.made.append(conn)
+            return conn
+
+        def _close(conn: _FakeConnection) -> None:
+            conn.closed = True
+
+        self.pool: ConnectionPool[_FakeConnection] = ConnectionPool(
+            _factory, size=2, timeout=0.01,
+            health_check=lambda conn: conn.healthy,
+            health_check_interval=30,
+            close=_close,
+            clock=lambda: self.now)
+
+    def test_connections_reused(self):
+        """test that connections go back into the pool
+            and get used again
+        """
+        for _ in range(3):
+            with self.pool.connection() as conn:
+                self.assertEqual(conn.number, 0)
+        self.assertEqual(len(self.made), 1)
+        self.assertEqual(self.pool.stats()["reused"], 2)
+
+    def test_pool_size_limited(self):
+        """test that we can't borrow more connections
+            than the size of the pool
+        """
+        with self.pool.connection(), self.pool.connection():
+            with self.assertRaises(TimeoutError):
+                with self.pool.connection():
+                    pass
+        self.assertEqual(len(self.made), 2)
+
+    def test_broken_connection_discarded(self):
+        """test that a connection in use when an error
+            happens is closed and not reused
+        """
+        with self.assertRaises(RuntimeError):
+            with self.pool.connection():
+                raise RuntimeError
+
+        self.assertTrue(self.made[0].closed)
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.number, 1)
+
+    def test_unhealthy_idle_connection_replaced(self):
+        """test that a connection idle for longer than the
+            health check interval is checked, and replaced
+            if it has gone bad
+        """
+        with self.pool.connection() as conn:
+            conn.healthy = False
+
+        # not idle long enough to be checked
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.number, 0)
+
+        self.now = 31
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.number, 1)
+        self.assertTrue(self.made[0].closed)
+
+    def test_close(self):
+        """test that closing the pool closes idle connections"""
+        with self.pool.connection():
+            pass
+        self.pool.close()
+        self.assertTrue(self.made[0].closed)
+        self.assertEqual(self.pool.stats()["idle"], 0)
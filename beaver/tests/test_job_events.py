@@ -0,0 +1,159 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import List, Set
+import unittest
+
+from beaver.builders.definition import Definition
+from beaver.builders.definition.tmp import TempBuilder
+from beaver.builders.image.tmp import TempImageBuilder
+from beaver.builders.worker import BuildWorker
+import beaver.db.db
+from beaver.db.groups import Group
+from beaver.db.images import Image
+from beaver.db.job_events import JobEventBroker, JobSubscription
+from beaver.db.jobs import Job
+from beaver.db.packages import Package
+from beaver.db.users import User
+from beaver.models.jobs import BuildStage, JobEvent, JobEventType, JobStatus
+from beaver.tests import set_up_database
+from beaver.utils.repository.tmp import TempRepository
+
+
+class _LoggingBuilder(TempBuilder):
+    def build(self, _: Set[Package], image_name: str = "image") -> Definition:
+        logging.getLogger("beaver.builders.test").info("writing %s", image_name)
+        return super().build(_, image_name)
+
+
+class TestJobEvents(unittest.TestCase):
+    """testing job progress being passed on to watchers"""
+
+    def setUp(self) -> None:
+        set_up_database()
+
+        database = next(beaver.db.db.get_db())
+        database.add(Image(image_name="watchedImage",
+                           user=User(user_name="watcher"), group=Group(group_name="watchers")))
+        database.flush()
+        database.add(Job(job_id="watched", image_id=1))
+        database.commit()
+
+        self.loop = asyncio.new_event_loop()
+        self.broker = JobEventBroker(poll_interval=60)
+
+    def _events(self, subscription: JobSubscription) -> List[JobEvent]:
+        events = []
+        while True:
+            event = self.loop.run_until_complete(subscription.get(0.05))
+            if event is None:
+                return events
+            events.append(event)
+
+    def test_publishing(self):
+        """test events getting to the people watching the job
+
+        Expects:
+            - status changes and log lines, from any thread, in order
+            - the same status only passed on once
+            - a status looked up before a newer one was published ignored
+            - new watchers getting the latest status and the log so far
+        """
+
+        watcher = self.broker.subscribe("watched", self.loop)
+        before = time.monotonic()
+        publisher = threading.Thread(target=lambda: (
+            self.broker.publish_status("watched", JobStatus.BuildingDefinition),
+            self.broker.publish_log("watched", "line 1"),
+            self.broker.publish_status("watched", JobStatus.BuildingDefinition)
+        ))
+        publisher.start()
+        publisher.join()
+
+        self.assertFalse(self.broker.publish_status("watched", JobStatus.Queued, as_of=before))
+        self.assertEqual(
+            [(x.event, x.status, x.line) for x in self._events(watcher)],
+            [(JobEventType.status, JobStatus.BuildingDefinition, None),
+             (JobEventType.log, None, "line 1")])
+
+        for i in range(2, 6):
+            self.broker.publish_log("watched", f"line {i}")
+        late = JobEventBroker(history=2)
+        late.publish_status("watched", JobStatus.BuildingImage)
+        late.publish_log("watched", "line 1")
+        late.publish_log("watched", "line 2")
+        self.assertEqual(
+            [(x.status, x.line) for x in self._events(late.subscribe("watched", self.loop))],
+            [(JobStatus.BuildingImage, None), (None, "line 1"), (None, "line 2")])
+
+        self.broker.unsubscribe(watcher)
+        self.assertEqual(self.broker.stats()["watchers"], 0)
+
+    def test_polling(self):
+        """test status changes made by other processes
+            being picked up from the database
+
+        Expects:
+            - the job's status when it's first looked up
+            - nothing when it hasn't changed
+            - its new status when it has
+        """
+
+        watcher = self.broker.subscribe("watched", self.loop)
+        self.assertEqual(self.broker.poll(), 1)
+        self.assertEqual(self.broker.poll(), 0)
+
+        database = next(beaver.db.db.get_db())
+        database.query(Job).update({Job.status: JobStatus.Failed, Job.detail: "broken"})
+        database.commit()
+
+        self.assertEqual(self.broker.poll(), 1)
+        self.assertEqual(
+            [(x.status, x.detail) for x in self._events(watcher)],
+            [(JobStatus.Queued, None), (JobStatus.Failed, "broken")])
+
+    def test_worker_publishes(self):
+        """test a builder in this process publishing
+            the job's progress as it builds it
+
+        Expects:
+            - the status when the job's claimed, and once it's built
+            - what the definition builder logs, as the build log
+        """
+
+        logging.getLogger("beaver.builders.test").setLevel(logging.INFO)
+        watcher = self.broker.subscribe("watched", self.loop)
+
+        self.assertTrue(BuildWorker(
+            BuildStage.definition, _LoggingBuilder(), TempImageBuilder(),
+            TempRepository(), events=self.broker).run_once())
+
+        self.assertEqual(
+            [(x.status, x.line) for x in self._events(watcher)],
+            [(JobStatus.BuildingDefinition, None),
+             (None, "writing watchedImage"),
+             (JobStatus.DefinitionMade, None)])
+
+    def tearDown(self) -> None:
+        self.loop.close()
@@ -0,0 +1,296 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime, timedelta
+import os
+from pathlib import Path
+import tempfile
+import threading
+from typing import Set
+import unittest
+import unittest.mock
+
+from beaver.builders.definition import Definition
+from beaver.builders.definition.tmp import TempBuilder
+from beaver.builders.image.tmp import TempImageBuilder, TmpImage
+from beaver.builders.worker import BuildPipeline, BuildWorker, image_workers_within_budget
+import beaver.db.db
+from beaver.db.groups import Group
+from beaver.db.images import Image, ImageContents
+from beaver.db.job_queue import claim_job, reconcile_followers, renew_lease, set_leased_job_status
+from beaver.db.jobs import Job
+from beaver.db.packages import Package
+from beaver.db.users import User
+from beaver.models.jobs import BuildStage, JobStatus
+from beaver.tests import set_up_database
+from beaver.utils.repository import RepositorableObject
+from beaver.utils.repository.fs import FileSystemRepository
+from beaver.utils.repository.tmp import TempRepository
+
+
+class _FailingBuilder(TempBuilder):
+    def build(self, _: Set[Package], image_name: str = "image") -> Definition:
+        raise RuntimeError("no such package")
+
+
+class TestJobQueue(unittest.TestCase):
+    """testing builders claiming jobs from the database"""
+
+    def setUp(self) -> None:
+        set_up_database()
+
+        database = next(beaver.db.db.get_db())
+        database.add_all([
+            Package(package_name="testPackage"),
+            User(user_name="testUser"),
+            Group(group_name="testGroup")
+        ])
+        database.commit()
+        database.add(Image(image_name="testImage", user_id=1, group_id=1))
+        database.add(ImageContents(image_id=1, package_id=1))
+
+        self.queued = datetime(2006, 1, 2, 22, 4, 5)
+        for i in range(3):
+            database.add(Job(job_id=f"q{i}", image_id=1,
+                             queuetime=self.queued + timedelta(seconds=i)))
+        database.commit()
+
+    def test_claiming_jobs(self):
+        """test that each job goes to one builder, oldest first
+
+        Expects:
+            - three different builders to get the three jobs, in order
+            - a fourth to get nothing
+            - only the builder holding the lease can change the job
+        """
+
+        database = next(beaver.db.db.get_db())
+
+        claimed = [claim_job(database, f"worker{i}") for i in range(4)]
+        self.assertEqual([x.job_id for x in claimed[:3]], ["q0", "q1", "q2"])
+        self.assertIsNone(claimed[3])
+
+        job = claimed[0]
+        self.assertEqual(job.status, JobStatus.BuildingDefinition)
+        self.assertEqual(job.lease_owner, "worker0")
+        self.assertEqual(job.attempts, 1)
+
+        self.assertFalse(renew_lease(database, "q0", "worker1"))
+        self.assertFalse(set_leased_job_status(database, "q0", "worker1", JobStatus.Failed))
+        self.assertTrue(renew_lease(database, "q0", "worker0"))
+        self.assertTrue(set_leased_job_status(database, "q0", "worker0", JobStatus.Succeeded))
+
+        database.refresh(job)
+        self.assertEqual(job.status, JobStatus.Succeeded)
+        self.assertIsNotNone(job.endtime)
+        self.assertIsNone(job.lease_owner)
+
+    def test_expired_leases_reclaimed(self):
+        """test that a job whose builder stopped renewing
+            its lease goes to another builder
+
+        Expects:
+            - the job to go to the second builder once the lease runs out
+            - the first builder to find it has lost the lease
+            - the job to be failed once it has run out of attempts
+        """
+
+        database = next(beaver.db.db.get_db())
+        database.query(Job).filter(Job.job_id != "q0").delete()
+        database.commit()
+
+        self.assertEqual(claim_job(database, "worker0", lease=-1).job_id, "q0")
+        self.assertEqual(claim_job(database, "worker1", lease=-1).job_id, "q0")
+        self.assertFalse(renew_lease(database, "q0", "worker0"))
+
+        self.assertIsNone(claim_job(database, "worker2", max_attempts=2))
+        job = database.query(Job).filter(Job.job_id == "q0").one()
+        self.assertEqual(job.status, JobStatus.Failed)
+        self.assertEqual(job.attempts, 2)
+
+    def test_followers_reconciled(self):
+        """test that a job which joined a build with a stale
+            status is caught up with the build
+
+        Expects:
+            - the follower to take the build's status, detail and endtime
+            - nothing more to do once it has
+        """
+
+        database = next(beaver.db.db.get_db())
+        database.query(Job).filter(Job.job_id != "q0").delete()
+        database.add(Job(job_id="f0", image_id=1, build_of="q0", status=JobStatus.Queued))
+        database.commit()
+
+        # the build finishing before the follower was committed
+        database.query(Job).filter(Job.job_id == "q0").update({
+            Job.status: JobStatus.Failed, Job.detail: "broken", Job.endtime: datetime.now()
+        })
+        database.commit()
+
+        publish = unittest.mock.Mock()
+        self.assertEqual(reconcile_followers(database, publish), 1)
+        leader, follower = database.query(Job).order_by(Job.job_id.desc()).all()
+        self.assertEqual(follower.status, JobStatus.Failed)
+        self.assertEqual(follower.detail, "broken")
+        self.assertEqual(follower.endtime, leader.endtime)
+        self.assertEqual(reconcile_followers(database, publish), 0)
+        publish.assert_not_called()
+
+    def test_followers_given_the_build(self):
+        """test that a job waiting on another's build is given what
+            the build made, under its own image name, before it's done
+
+        Expects:
+            - the follower's own definition and image in the repository
+                once a builder has caught it up, and not before
+            - a follower whose build has gone from the repository
+                to be built on its own
+        """
+
+        database = next(beaver.db.db.get_db())
+        database.query(Job).filter(Job.job_id != "q0").delete()
+        database.query(Image).update({Image.content_hash: "key"})
+        # the orphan's build is under another key, which isn't there
+        for i, (name, key) in enumerate((("follower", "key"), ("orphan", "gone")), 2):
+            database.add(Image(image_id=i, image_name=name, user_id=1,
+                               group_id=1, content_hash=key))
+            database.add(Job(job_id=f"f{i}", image_id=i, build_of="q0"))
+        database.query(Job).filter(Job.job_id == "q0").update({
+            Job.status: JobStatus.Succeeded, Job.endtime: datetime.now()})
+        database.commit()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            repo = FileSystemRepository(Path(tmp) / "repo")
+            for key, name in (("definition-key", "beaver-key.nix"), ("image-key", "image.tar")):
+                (Path(tmp) / name).write_bytes(name.encode())
+                repo.add(RepositorableObject(Path(tmp) / name), key)
+
+            worker = BuildWorker(BuildStage.image, TempBuilder(), TempImageBuilder(), repo)
+            self.assertNotIn("follower", repo)
+            self.assertFalse(worker.run_once())
+
+            self.assertEqual(Path(repo.get("follower")).read_bytes(), b"beaver-key.nix")
+            self.assertEqual(Path(repo.get("follower.tar")).read_bytes(), b"image.tar")
+
+        follower, orphan = database.query(Job).filter(Job.job_id != "q0").order_by(Job.job_id)
+        self.assertEqual(follower.status, JobStatus.Succeeded)
+        self.assertEqual(orphan.status, JobStatus.Queued)
+        self.assertIsNone(orphan.build_of)
+
+    def test_workers_build_stages(self):
+        """test the definition and image builders each
+            building their stage of the jobs in the queue
+
+        Expects:
+            - the definition builder to make all three definitions,
+                handing them on to the image builder
+            - the image builder to build all three images
+            - a job whose build raises to fail, with the error as its detail
+        """
+
+        definitions = BuildWorker(BuildStage.definition, TempBuilder(), TempImageBuilder(),
+                                  TempRepository(), heartbeat_interval=0.01)
+        images = BuildWorker(BuildStage.image, TempBuilder(), TempImageBuilder(),
+                             TempRepository(), heartbeat_interval=0.01)
+
+        self.assertFalse(images.run_once())
+        self.assertTrue(all(definitions.run_once() for _ in range(3)))
+        self.assertFalse(definitions.run_once())
+
+        database = next(beaver.db.db.get_db())
+        jobs = database.query(Job).all()
+        self.assertEqual({x.status for x in jobs}, {JobStatus.DefinitionMade})
+        self.assertEqual({x.lease_owner for x in jobs}, {None})
+
+        self.assertTrue(all(images.run_once() for _ in range(3)))
+        self.assertFalse(images.run_once())
+        database.expire_all()
+        self.assertEqual({x.status for x in database.query(Job).all()}, {JobStatus.Succeeded})
+
+        database.add(Job(job_id="broken", image_id=1))
+        database.commit()
+
+        self.assertTrue(BuildWorker(BuildStage.definition, _FailingBuilder(),
+                                    TempImageBuilder(), TempRepository()).run_once())
+        job = database.query(Job).filter(Job.job_id == "broken").one()
+        self.assertEqual(job.status, JobStatus.Failed)
+        self.assertEqual(job.detail, "no such package")
+
+    def test_definitions_not_held_up_by_images(self):
+        """test that definitions are still made whilst
+            an image takes a long time to build
+
+        Expects:
+            - a definition to be made whilst the image is building
+        """
+
+        building, finish = threading.Event(), threading.Event()
+
+        class _SlowImageBuilder(TempImageBuilder):
+            def build(self, definition: Definition) -> TmpImage:
+                building.set()
+                finish.wait(5)
+                return super().build(definition)
+
+        definitions = BuildWorker(BuildStage.definition, TempBuilder(), TempImageBuilder(),
+                                  TempRepository())
+        images = BuildWorker(BuildStage.image, TempBuilder(), _SlowImageBuilder(),
+                             TempRepository())
+
+        self.assertTrue(definitions.run_once())
+        image_build = threading.Thread(target=images.run_once)
+        image_build.start()
+        building.wait(5)
+
+        try:
+            self.assertTrue(definitions.run_once())
+        finally:
+            finish.set()
+            image_build.join()
+
+        database = next(beaver.db.db.get_db())
+        self.assertEqual(
+            [x.status for x in database.query(Job).order_by(Job.queuetime)],
+            [JobStatus.Succeeded, JobStatus.DefinitionMade, JobStatus.Queued])
+
+    def test_image_workers_within_budget(self):
+        """test the image builders being capped by the CPU
+            and disk they've got
+
+        Expects:
+            - as many as asked for, with no budget
+            - fewer, to fit the tighter of the CPU and disk budgets
+        """
+
+        self.assertEqual(image_workers_within_budget(4), 4)
+        self.assertEqual(image_workers_within_budget(4, cpu_budget=16, cpus_per_image=8), 2)
+        self.assertEqual(image_workers_within_budget(
+            4, cpu_budget=16, cpus_per_image=4, disk_budget=100, disk_per_image=40), 2)
+
+        pipeline = BuildPipeline(TempBuilder(), TempImageBuilder(), TempRepository(),
+                                 definition_workers=3, image_workers=4,
+                                 cpu_budget=1, cpus_per_image=1)
+        self.assertEqual([x.stage for x in pipeline.workers],
+                         [BuildStage.definition] * 3 + [BuildStage.image])
+        self.assertEqual(len({x.worker_id for x in pipeline.workers}), 4)
+
+    def tearDown(self) -> None:
+        os.remove("_tmp_db.db")
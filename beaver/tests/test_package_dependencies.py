@@ -0,0 +1,165 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import unittest
+import unittest.mock
+
+import beaver.db.db
+from beaver.db.groups import Group
+from beaver.db.image_usage import get_image_usage_by_package, record_image_usage
+from beaver.db.images import Image, ImageContents
+from beaver.db.package_dependencies import (DependencyCycle, DependencyGraph,
+                                            DependencyGraphCache, add_package_dependency,
+                                            get_packages_with_dependencies)
+from beaver.db.packages import Package, PackageDependency
+from beaver.db.users import User
+from beaver.models.image_usage import ImageUsageBase
+from beaver.tests import set_up_database
+
+
+class TestDependencyGraph(unittest.TestCase):
+    """testing working out dependency closures in memory"""
+
+    def test_closures(self):
+        """test the closure of packages, both ways
+
+        Expects:
+            - everything depended on, through a diamond, once
+            - everything depending on a package
+            - asking again for the same packages to come from the cache
+            - a long chain to be fine, without recursing
+        """
+
+        # 1 -> 2 -> 4, 1 -> 3 -> 4, 5 on its own
+        graph = DependencyGraph([(1, 2), (1, 3), (2, 4), (3, 4), (5, 6)])
+        self.assertEqual(graph.closure([1]), {1, 2, 3, 4})
+        self.assertEqual(graph.closure([3, 5]), {3, 4, 5, 6})
+        self.assertEqual(graph.closure([7]), {7})
+        self.assertEqual(graph.dependents([4]), {1, 2, 3, 4})
+
+        graph.closure([5, 3])
+        self.assertEqual(graph.stats(), {
+            "packages": 6, "edges": 5, "closures": 4, "hits": 1, "misses": 4})
+
+        chain = DependencyGraph((i, i + 1) for i in range(20000))
+        self.assertEqual(len(chain.closure([0])), 20001)
+        self.assertEqual(chain.path(19990, 20000), list(range(19990, 20001)))
+
+    def test_cycles(self):
+        """test finding cycles in the dependencies
+
+        Expects:
+            - no cycle in a diamond
+            - the packages on a cycle, which is closed
+            - closures that include everything on a cycle
+        """
+
+        self.assertIsNone(DependencyGraph([(1, 2), (1, 3), (2, 4), (3, 4)]).find_cycle())
+
+        graph = DependencyGraph([(1, 2), (2, 3), (3, 4), (4, 2)])
+        self.assertEqual(graph.find_cycle(), [2, 3, 4, 2])
+        self.assertEqual(graph.closure([3]), {2, 3, 4})
+        self.assertEqual(DependencyGraph([(1, 1)]).find_cycle(), [1, 1])
+
+
+class TestPackageDependencies(unittest.TestCase):
+    """testing package dependencies in the database"""
+
+    def setUp(self) -> None:
+        set_up_database()
+
+        database = next(beaver.db.db.get_db())
+        database.add_all([Package(package_name=f"depPackage{i}") for i in range(1, 6)])
+        database.add(Image(image_name="depImage", user=User(user_name="depUser"),
+                           group=Group(group_name="depGroup")))
+        database.flush()
+        database.add(ImageContents(image_id=1, package_id=3))
+        database.commit()
+        self.database = database
+
+    def test_adding_dependencies(self):
+        """test adding dependencies, and getting packages with them
+
+        Expects:
+            - the packages, and what they depend on
+            - a dependency that would make a cycle to be refused
+            - dependencies added elsewhere to show up once checked for
+        """
+
+        add_package_dependency(self.database, 3, 2)
+        add_package_dependency(self.database, 2, 1)
+        self.assertEqual([x.package_name for x in get_packages_with_dependencies(
+            self.database, [3, 4])], ["depPackage1", "depPackage2", "depPackage3", "depPackage4"])
+
+        with self.assertRaises(DependencyCycle) as raised:
+            add_package_dependency(self.database, 1, 3)
+        self.assertEqual(raised.exception.cycle, [1, 3, 2, 1])
+        with self.assertRaises(DependencyCycle):
+            add_package_dependency(self.database, 5, 5)
+
+        cache = DependencyGraphCache(check_interval=60)
+        self.assertEqual(cache.get(self.database).closure([4]), {4})
+        self.database.add(PackageDependency(package_id=4, dependency_id=5))
+        self.database.commit()
+        self.assertEqual(cache.get(self.database).closure([4]), {4})
+        cache.check_interval = 0
+        self.assertEqual(cache.get(self.database).closure([4]), {4, 5})
+        self.assertEqual(cache.stats()["loads"], 2)
+
+    def test_failed_load_retried(self):
+        """test the graph is loaded again after loading it fails
+
+        Expects:
+            - the error from loading the changed dependencies
+            - them to be loaded next time, rather than the old graph kept
+        """
+
+        cache = DependencyGraphCache(check_interval=60)
+        self.assertEqual(cache.get(self.database).closure([3]), {3})
+        self.database.add(PackageDependency(package_id=3, dependency_id=2))
+        self.database.commit()
+
+        with unittest.mock.patch("beaver.db.package_dependencies.DependencyGraph",
+                                 side_effect=RuntimeError("lost the database")):
+            with self.assertRaises(RuntimeError):
+                cache.get(self.database, fresh=True)
+        self.assertEqual(cache.get(self.database).closure([3]), {2, 3})
+
+    def test_usage_by_dependency(self):
+        """test image usage for a package counting images
+            that only have it as a dependency
+
+        Expects:
+            - usage of the image, which has package 3, for package 1
+            - nothing for package 4, which nothing depends on
+        """
+
+        add_package_dependency(self.database, 3, 2)
+        add_package_dependency(self.database, 2, 1)
+        record_image_usage(self.database, ImageUsageBase(image_id=1, user_id=1, group_id=1))
+
+        self.assertEqual(
+            [x.image_id for x in get_image_usage_by_package(self.database, 1).items], [1])
+        self.assertEqual(get_image_usage_by_package(self.database, 4).items, [])
+
+    def tearDown(self) -> None:
+        self.database.close()
+        os.remove("_tmp_db.db")
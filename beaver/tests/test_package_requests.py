@@ -0,0 +1,88 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+from pathlib import Path
+import tempfile
+import unittest
+
+from beaver.models.packages import PackageRequest, PackageType
+from beaver.utils.package_requests import (parse_requirement, read_package_request_file,
+                                           read_requirements)
+
+
+class TestPackageRequests(unittest.TestCase):
+    """testing reading Package Request Files and requirements.txt"""
+
+    def test_parse_requirement(self):
+        """test reading single requirements
+
+        Expects:
+            - names normalised, and versions only when pinned exactly
+            - extras, markers and URLs dropped
+            - nothing for comments and pip options
+            - paths and bare URLs refused
+        """
+
+        def _parsed(line):
+            request = parse_requirement(line)
+            return None if request is None else (request.name, request.version)
+
+        self.assertEqual(_parsed("NumPy==1.24.0"), ("numpy", "1.24.0"))
+        self.assertEqual(_parsed("zope.interface === 6.0"), ("zope-interface", "6.0"))
+        self.assertEqual(_parsed("requests[socks]>=2.0,<3"), ("requests", None))
+        self.assertEqual(_parsed("pandas==2.*"), ("pandas", None))
+        self.assertEqual(_parsed("pywin32==306; sys_platform == 'win32'"), ("pywin32", "306"))
+        self.assertEqual(_parsed("pip @ https://example.com/pip.zip"), ("pip", None))
+        self.assertEqual(parse_requirement("numpy").type, PackageType.py)
+
+        for line in ("", "   # just a comment", "-r other.txt", "--index-url https://x"):
+            self.assertIsNone(parse_requirement(line))
+        for line in ("./local", "https://example.com/pip.zip", "numpy 1.0"):
+            with self.assertRaises(ValueError):
+                parse_requirement(line)
+
+    def test_read_files(self):
+        """test reading whole files
+
+        Expects:
+            - continued lines joined, with errors giving the line
+            - requirements.txt read as Python packages
+            - Package Request Files read as they are, defaulting the type
+        """
+
+        self.assertEqual([x.name for x in read_requirements(
+            ["scipy \\\n", "  ==1.10.0\n", "numpy\n"])], ["scipy", "numpy"])
+        with self.assertRaisesRegex(ValueError, "line 3"):
+            list(read_requirements(["scipy", "", "/opt/numpy"]))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            requirements = Path(tmp_dir) / "requirements.txt"
+            requirements.write_text("numpy==1.24.0\n", encoding="utf-8")
+            self.assertEqual(read_package_request_file(requirements), [
+                PackageRequest(name="numpy", version="1.24.0", type=PackageType.py)])
+
+            request_file = Path(tmp_dir) / "packages.json"
+            request_file.write_text(json.dumps({"packages": [
+                {"name": "samtools", "version": "1.17"}, {"name": "ggplot2", "type": "R"}
+            ]}), encoding="utf-8")
+            self.assertEqual(read_package_request_file(request_file), [
+                PackageRequest(name="samtools", version="1.17"),
+                PackageRequest(name="ggplot2", type=PackageType.R)])
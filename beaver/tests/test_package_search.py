@@ -0,0 +1,126 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import gzip
+import json
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+from beaver.utils.nixpkgs import (NixpkgsAttribute, PackageSearch, PackageSearchIndex,
+                                  read_packages_json, write_index)
+
+_PACKAGES = {
+    "samtools": {"pname": "samtools", "version": "1.17",
+                 "meta": {"description": "Tools for manipulating SAM/BAM files"}},
+    "bcftools": {"pname": "bcftools", "version": "1.17", "meta": {}},
+    "htslib": {"pname": "htslib", "version": "1.17", "meta": {}},
+    "python3Packages.pysam": {"pname": "pysam", "version": "0.21.0", "meta": {}},
+    "samtools_0_1_19": {"pname": "samtools", "version": "0.1.19", "meta": {}},
+    "sambamba": {"name": "sambamba-1.0", "meta": {}},
+}
+
+
+class TestPackageSearch(unittest.TestCase):
+    """testing importing and searching nixpkgs"""
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.dir = Path(self._dir.name)
+
+        with gzip.open(self.dir / "packages.json.gz", "wt", encoding="utf-8") as dump:
+            json.dump({"version": 2, "packages": _PACKAGES}, dump)
+        self.packages = read_packages_json(self.dir / "packages.json.gz")
+        self.index = PackageSearchIndex(self.packages)
+
+    def test_reading_dumps(self):
+        """test reading the different dumps of nixpkgs
+
+        Expects:
+            - every package, with its name, version and description
+            - the same from `nix search --json`, without the system
+        """
+
+        self.assertEqual(len(self.packages), 6)
+        self.assertIn(NixpkgsAttribute("samtools", "samtools", "1.17",
+                                       "Tools for manipulating SAM/BAM files"), self.packages)
+        self.assertIn(NixpkgsAttribute("sambamba", "sambamba-1.0", "", ""), self.packages)
+
+        (self.dir / "search.json").write_text(json.dumps({
+            "legacyPackages.x86_64-linux.python3Packages.pysam": {
+                "pname": "pysam", "version": "0.21.0", "description": "pysam"}
+        }), encoding="utf-8")
+        self.assertEqual(read_packages_json(self.dir / "search.json"), [
+            NixpkgsAttribute("python3Packages.pysam", "pysam", "0.21.0", "pysam")])
+
+    def test_ranking(self):
+        """test the results are ranked
+
+        Expects:
+            - an exact match first, then the longer attribute of the same name
+            - prefixes, shortest first, before packages that only contain the query
+            - packages matched by the end of their attribute path
+            - close matches for a typo
+            - packages we've got, and commonly used ones, boosted
+        """
+
+        def _search(query, **kwargs):
+            return [x.package.attribute for x in self.index.search(query, **kwargs)]
+
+        self.assertEqual(_search("samtools")[:2], ["samtools", "samtools_0_1_19"])
+        self.assertEqual(_search("sam")[:3], ["sambamba", "samtools", "samtools_0_1_19"])
+        self.assertEqual(_search("sam")[-1], "python3Packages.pysam")
+        self.assertEqual(_search("pysam"), ["python3Packages.pysam"])
+        self.assertIn("samtools", _search("samtols"))
+        self.assertEqual(_search("  "), [])
+        self.assertEqual(len(_search("sam", limit=2)), 2)
+
+        results = self.index.search("sam", boosts={"sambamba": False, "pysam": True})
+        self.assertEqual([x.package.attribute for x in results[:2]],
+                         ["python3Packages.pysam", "sambamba"])
+        self.assertEqual([(x.known, x.commonly_used) for x in results[:2]],
+                         [(True, True), (True, False)])
+
+    def test_reloading(self):
+        """test the index is loaded again when nixpkgs is imported again
+
+        Expects:
+            - the packages from the first import, then the second
+            - the first import to be searched whilst the second loads
+        """
+
+        search = PackageSearch(self.dir / "index.json", check_interval=0)
+        with self.assertRaises(FileNotFoundError):
+            search.index()
+
+        write_index(self.packages, self.dir / "index.json")
+        self.assertEqual(len(search.index()), 6)
+
+        write_index(self.packages[:2], self.dir / "index.json")
+        os.utime(self.dir / "index.json", (0, 0))
+        self.assertEqual(len(search.index()), 6)
+        reloader = search._reloader  # pylint: disable=protected-access
+        if reloader is not None:
+            reloader.join()
+        self.assertEqual(len(search.index()), 2)
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
@@ -0,0 +1,176 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import os
+from typing import Callable, FrozenSet, Iterator, List, Set, Tuple
+import unittest
+
+from sqlalchemy import event
+
+import beaver.db.db
+from beaver.db.groups import Group
+import beaver.db.image_usage
+import beaver.db.images
+import beaver.db.job_queue
+import beaver.db.jobs
+import beaver.db.names
+import beaver.db.package_dependencies
+import beaver.db.packages
+import beaver.db.usage_rollups
+from beaver.db.users import User
+from beaver.models.image_usage import UsageGranularity
+from beaver.models.jobs import BuildStage, JobStatus
+from beaver.models.pagination import PageRequest
+from beaver.tests import set_up_database
+
+# the tables these are always read in full
+WHOLE_TABLE_READS = {"image_name_adjectives", "image_name_names", "package_dependencies"}
+
+
+class TestQueryPlans(unittest.TestCase):
+    """testing that the queries in beaver.db find their
+        rows using indexes, rather than scanning tables
+    """
+
+    def setUp(self) -> None:
+        set_up_database()
+
+    @contextmanager
+    def _statements(self) -> Iterator[List[Tuple[str, tuple]]]:
+        """collect the statements run in the `with` block"""
+
+        statements: List[Tuple[str, tuple]] = []
+
+        def _collect(_conn, _cursor, statement, parameters, _context, _executemany):
+            statements.append((statement, parameters))
+
+        event.listen(beaver.db.db.engine, "before_cursor_execute", _collect)
+        try:
+            yield statements
+        finally:
+            event.remove(beaver.db.db.engine, "before_cursor_execute", _collect)
+
+    def _scans(self, statement: str, parameters: tuple) -> Set[str]:
+        """the tables SQLite would scan, without an index, to run `statement`"""
+
+        connection = beaver.db.db.engine.raw_connection()
+        try:
+            plan = connection.cursor().execute(
+                f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        finally:
+            connection.close()
+
+        return {
+            detail.split()[1] for *_, detail in plan
+            if detail.startswith("SCAN ") and " INDEX " not in detail
+        }
+
+    def _assert_indexed(
+        self,
+        query: Callable[[], object],
+        allowed: FrozenSet[str] = frozenset()
+    ) -> None:
+        """run `query`, and check everything it reads from the database
+            it finds using an index, other than the `allowed` tables
+        """
+
+        with self._statements() as statements:
+            query()
+
+        reads = [x for x in statements if x[0].lstrip().upper().startswith(
+            ("SELECT", "UPDATE", "DELETE"))]
+        self.assertTrue(reads)
+
+        for statement, parameters in reads:
+            with self.subTest(statement=statement):
+                self.assertEqual(
+                    self._scans(statement, parameters) - WHOLE_TABLE_READS - allowed, set())
+
+    def test_queries_use_indexes(self):
+        """test each query in beaver.db for scans, rather than
+            hoping nobody notices until the tables are big
+
+        Expects:
+            - no tables scanned, except the name elements that
+                are always read in full
+        """
+
+        database = next(beaver.db.db.get_db())
+        since, until = datetime(2006, 1, 2), datetime(2006, 1, 3)
+
+        queries: List[Callable[[], object]] = [
+            lambda: User.get_or_make_user_id_for_user_name("testUser", database),
+            lambda: Group.get_or_make_group_id_for_group_name("testGroup", database),
+            lambda: beaver.db.images.get_images_for_user(database, "testUser"),
+            lambda: beaver.db.images.get_images_for_group_name(database, "testGroup"),
+            lambda: beaver.db.images.get_images_visible_to_user(
+                database, "testUser", ["testGroup", "otherGroup"]),
+            lambda: beaver.db.images.get_images_visible_to_user(
+                database, "testUser", ["testGroup"], PageRequest(sort="image_name")),
+            lambda: beaver.db.names.check_image_name(database, "testImage"),
+            lambda: beaver.db.names.get_names(database),
+            lambda: beaver.db.jobs.get_job_counts(database),
+            lambda: beaver.db.job_queue.claim_job(database, "worker", BuildStage.definition),
+            lambda: beaver.db.job_queue.claim_job(database, "worker", BuildStage.image),
+            lambda: beaver.db.job_queue.renew_lease(database, "test", "worker"),
+            lambda: beaver.db.job_queue.reconcile_followers(database, lambda *_: None),
+            lambda: beaver.db.jobs.get_job_statuses(database, ["test", "other"]),
+            lambda: beaver.db.jobs.get_num_jobs_in_status(JobStatus.Queued, database),
+            lambda: beaver.db.jobs.get_num_jobs_in_status_last_n_hours(
+                JobStatus.Succeeded, database),
+            lambda: database.query(beaver.db.jobs.Job).filter(
+                beaver.db.jobs.Job.job_id == "test").all(),
+            lambda: beaver.db.packages.get_all_pacakges(
+                database, PageRequest(sort="package_name")),
+            lambda: beaver.db.packages.PackageCatalog().get_page(
+                database, PageRequest(sort="package_name")),
+            lambda: beaver.db.package_dependencies.get_packages_with_dependencies(
+                database, [1, 2]),
+        ]
+
+        for usage in (
+            beaver.db.image_usage.get_image_usage_for_user,
+            beaver.db.image_usage.get_image_usage_for_group,
+            beaver.db.image_usage.get_image_usage_by_image,
+            beaver.db.image_usage.get_image_usage_by_package
+        ):
+            queries.append(lambda usage=usage: usage(database, 1, None, since, until))
+
+        for series in (
+            beaver.db.usage_rollups.get_usage_series_for_user,
+            beaver.db.usage_rollups.get_usage_series_for_group,
+            beaver.db.usage_rollups.get_usage_series_by_image,
+            beaver.db.usage_rollups.get_usage_series_by_package
+        ):
+            queries.append(lambda series=series: series(
+                database, 1, UsageGranularity.hour, since, until))
+
+        for query in queries:
+            self._assert_indexed(query)
+
+        # an unfiltered page walks the table in key order,
+        # stopping once it has a page, which is fine
+        self._assert_indexed(
+            lambda: beaver.db.packages.get_all_pacakges(database), frozenset({"packages"}))
+
+    def tearDown(self) -> None:
+        os.remove("_tmp_db.db")
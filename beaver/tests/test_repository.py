@@ -0,0 +1,187 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from pathlib import Path
+import tempfile
+import unittest
+import unittest.mock
+
+from beaver.builders.builds import build_definition, build_image
+from beaver.builders.definition.nix import NixLayeredDefinitionBuilder
+from beaver.builders.definition.tmp import TempBuilder
+from beaver.builders.image.layered import LayeredImage, LayeredImageBuilder
+from beaver.db.packages import Package
+from beaver.models.packages import PackageType
+from beaver.utils.repository import RepositorableObject
+from beaver.utils.repository.fs import FileSystemRepository, content_hash
+from beaver.utils.repository.tmp import TempRepository
+
+
+class TestFileSystemRepository(unittest.TestCase):
+    """testing the content addressed repository"""
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.dir = Path(self._dir.name)
+        self.repo = FileSystemRepository(self.dir / "repo")
+
+    def _file(self, name: str, contents: bytes) -> RepositorableObject:
+        path = self.dir / name
+        path.write_bytes(contents)
+        return RepositorableObject(path)
+
+    def test_add_get(self):
+        """test adding and getting objects
+
+        Expects:
+            - objects under their name, and any other key they're given
+            - the same contents only stored once, keeping their names
+            - nothing under keys that weren't added
+            - keys that aren't names refused
+        """
+
+        first = self._file("first.nix", b"{ }")
+        self.repo.add(first)
+        self.repo.add(first, "another-key")
+        self.repo.add(self._file("second.nix", b"{ }"))
+
+        self.assertIn("first.nix", self.repo)
+        self.assertEqual(Path(self.repo.get("another-key")).name, "first.nix")
+        self.assertEqual(Path(self.repo.get("second.nix")).read_bytes(), b"{ }")
+        self.assertEqual(Path(self.repo.get("first.nix")).parent.name, content_hash(first))
+        self.assertEqual(len(list((self.dir / "repo" / "objects").iterdir())), 1)
+        self.assertEqual(list((self.dir / "repo" / "tmp").iterdir()), [])
+
+        self.assertNotIn("missing", self.repo)
+        with self.assertRaises(KeyError):
+            self.repo.get("missing")
+        with self.assertRaises(ValueError):
+            self.repo.add(first, "../escape")
+
+    def test_eviction(self):
+        """test the least recently used objects are removed
+            when the repo gets too big
+
+        Expects:
+            - the object that was used least recently to go,
+                along with the keys pointing at it
+            - recently used objects to stay
+        """
+
+        repo = FileSystemRepository(self.dir / "small", max_size=25)
+        for i, name in enumerate(("a", "b")):
+            repo.add(self._file(name, name.encode() * 10))
+            stored = Path(repo.get(name)).parent
+            os.utime(stored, (i, i))
+
+        repo.get("a")
+        repo.add(self._file("c", b"c" * 10))
+
+        self.assertIn("a", repo)
+        self.assertNotIn("b", repo)
+        self.assertIn("c", repo)
+        self.assertEqual(repo.size(), 20)
+        self.assertFalse((self.dir / "small" / "refs" / "b").exists())
+
+    def test_tagging(self):
+        """test putting what's stored under more keys
+
+        Expects:
+            - every key given to `add` pointing at the one copy
+            - a tag pointing at the same object, without copying it again
+            - a KeyError tagging something that isn't there
+        """
+
+        self.repo.add(self._file("image.tar", b"image"), "first", "second")
+        self.repo.tag("second", "third")
+
+        self.assertEqual(
+            {Path(self.repo.get(x)) for x in ("first", "second", "third")},
+            {Path(self.repo.get("first"))})
+        self.assertNotIn("image.tar", self.repo)
+        self.assertEqual(len(list((self.dir / "repo" / "objects").iterdir())), 1)
+        with self.assertRaises(KeyError):
+            self.repo.tag("missing", "fourth")
+
+    def test_builds_skipped(self):
+        """test builds use what's in the repo already, for
+            any image with the same packages
+
+        Expects:
+            - the definition and image built once for the same key,
+                named after the key rather than the image
+            - every image tagged with its own name
+            - the image built from the definition in the repo
+            - a different key building them again
+        """
+
+        runs = []
+
+        def _run(args, stdout=None):
+            runs.append(args)
+            if stdout is not None:
+                stdout.write(b"image")
+
+        def_builder = NixLayeredDefinitionBuilder(self.dir / "definitions")
+        img_builder = LayeredImageBuilder(self.dir / "images", run=_run)
+        packages = {Package(package_name="samtools", package_type=PackageType.std)}
+
+        for image_name in ("user-group-first", "user-group-second"):
+            build_definition(image_name, packages, def_builder, self.repo, "key")
+            (self.dir / "definitions" / "beaver-key.nix").unlink(missing_ok=True)
+            image = build_image(image_name, def_builder, img_builder, self.repo, "key")
+
+        self.assertIsInstance(image, LayeredImage)
+        self.assertEqual(Path(image).read_bytes(), b"image")
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(Path(runs[0][1]).name, "beaver-key.nix")
+        for key in ("definition-key", "image-key", "user-group-first", "user-group-second",
+                    "user-group-first.tar", "user-group-second.tar"):
+            self.assertIn(key, self.repo)
+        self.assertEqual(Path(self.repo.get("user-group-second.tar")), Path(image))
+        self.assertFalse((self.dir / "definitions" / "beaver-key.nix").exists())
+
+        build_definition("user-group-third", packages, def_builder, self.repo, "other-key")
+        self.assertTrue((self.dir / "definitions" / "beaver-other-key.nix").exists())
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+
+class TestTempRepository(unittest.TestCase):
+    """testing the repository that keeps nothing"""
+
+    def test_nothing_reused(self):
+        """test nothing is tagged from a repository that keeps nothing
+
+        Expects:
+            - a KeyError tagging anything
+            - the definition built, rather than taken from the repository
+        """
+
+        repo = TempRepository()
+        with self.assertRaises(KeyError):
+            repo.tag("definition-key", "image")
+
+        builder = TempBuilder()
+        with unittest.mock.patch.object(builder, "build", wraps=builder.build) as build:
+            build_definition("image", set(), builder, repo, "key")
+        build.assert_called_once_with(set(), "beaver-key")
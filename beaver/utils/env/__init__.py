@@ -19,11 +19,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from types import SimpleNamespace
-from typing import Dict, Type
+from typing import Any, Dict, Optional, Type
 
 import yaml
 
+from beaver.db.job_events import JobEventBroker
+from beaver.db.usage_buffer import ImageUsageBuffer
 from beaver.utils.idm import IdentityManager
+from beaver.utils.nixpkgs import PackageSearch
 import beaver.utils.idm
 
 
@@ -33,6 +36,11 @@ class Env(SimpleNamespace):
     """
 
     idm: IdentityManager
+    database: Dict[str, Any] = {}
+    usage_buffer: Optional[ImageUsageBuffer] = None
+    builder: Dict[str, Any] = {}
+    job_events: JobEventBroker = JobEventBroker()
+    package_search: Optional[PackageSearch] = None
 
 
 str_to_idm: Dict[str, Type[IdentityManager]] = {
@@ -47,5 +55,31 @@ def load_config_from_file(config_filepath: str):
     with open(config_filepath, encoding="utf-8") as config_file:
         config = yaml.full_load(config_file)
 
-    Env.idm = str_to_idm[config["idm"]["name"]](
-        **{k: v for k, v in config["idm"].items() if k != "name"})
+    idm: IdentityManager = str_to_idm[config["idm"]["name"]](
+        **{k: v for k, v in config["idm"].items() if k not in {"name", "cache"}})
+
+    # optionally put a cache in front of the identity manager
+    # so we're not going back to the directory on every request
+    if config["idm"].get("cache"):
+        idm = beaver.utils.idm.CachingIdentityManager(
+            idm, **config["idm"]["cache"])
+
+    Env.idm = idm
+
+    # where the database is, and how many connections to pool
+    Env.database = config.get("database", {})
+
+    # optionally write image usage in batches in the background
+    if config.get("image_usage", {}).get("buffer"):
+        Env.usage_buffer = ImageUsageBuffer(**config["image_usage"]["buffer"])
+
+    # how job progress is passed on to whoever's watching
+    if config.get("job_events"):
+        Env.job_events = JobEventBroker(**config["job_events"])
+
+    # where nixpkgs is imported to, for searching it
+    if config.get("package_search"):
+        Env.package_search = PackageSearch(**config["package_search"])
+
+    # how the builders claim and hold on to jobs
+    Env.builder = config.get("builder", {})
@@ -18,6 +18,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from .cache import CachingIdentityManager
 from .core import IdentityManager
 from .ldap import SangerLDAPIdentityManager
 from .local import LocalJSONIdentityManager
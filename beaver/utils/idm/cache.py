@@ -0,0 +1,176 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from .core import IdentityManager
+
+
+class CachingIdentityManager(IdentityManager):  # pylint: disable=too-many-instance-attributes
+    """wraps another `IdentityManager`, keeping group memberships
+        in a bounded LRU cache so repeated lookups for the same
+        user don't go back to the directory
+
+        entries expire after `ttl` seconds. users the backend knows
+        nothing about (an empty set of groups) are cached too, but
+        only for `negative_ttl` seconds, so a new user shows up quickly
+    """
+
+    def __init__(
+        self,
+        backend: IdentityManager,
+        max_size: int = 1024,
+        ttl: float = 300,
+        negative_ttl: float = 60,
+        clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+
+        # user_id -> (expiry time, groups)
+        self._entries: OrderedDict[str, Tuple[float, FrozenSet[str]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._counters: Dict[str, int] = {
+            "hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+    def _lookup(self, user_id: str) -> Optional[FrozenSet[str]]:
+        """return the cached groups for `user_id` if we've got
+            a live entry, updating the counters on the way
+        """
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expiry, groups = entry
+                if expiry > self._clock():
+                    self._entries.move_to_end(user_id)
+                    self._counters["hits" if groups else "negative_hits"] += 1
+                    return groups
+                del self._entries[user_id]
+
+            self._counters["misses"] += 1
+            return None
+
+    def _store(self, user_id: str, groups: Set[str]) -> None:
+        """put the result of a backend lookup in the cache,
+            evicting the least recently used entries if we're full
+        """
+
+        _ttl = self.ttl if groups else self.negative_ttl
+        with self._lock:
+            self._entries[user_id] = (self._clock() + _ttl, frozenset(groups))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def get_groups_for_user(self, user_id: str) -> Set[str]:
+        cached = self._lookup(user_id)
+        if cached is not None:
+            return set(cached)
+
+        groups = self.backend.get_groups_for_user(user_id)
+        self._store(user_id, groups)
+        return set(groups)
+
+    async def get_groups_for_user_async(self, user_id: str) -> Set[str]:
+        cached = self._lookup(user_id)
+        if cached is not None:
+            return set(cached)
+
+        groups = await self.backend.get_groups_for_user_async(user_id)
+        self._store(user_id, groups)
+        return set(groups)
+
+    def _lookup_many(
+        self,
+        user_ids: Iterable[str]
+    ) -> Tuple[Dict[str, Set[str]], List[str]]:
+        """split `user_ids` into the ones we have cached
+            groups for, and the ones we need to look up
+        """
+
+        found: Dict[str, Set[str]] = {}
+        missing: List[str] = []
+        for user_id in set(user_ids):
+            cached = self._lookup(user_id)
+            if cached is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = set(cached)
+        return found, missing
+
+    def get_groups_for_users(self, user_ids: Iterable[str]) -> Dict[str, Set[str]]:
+        found, missing = self._lookup_many(user_ids)
+        if missing:
+            for user_id, groups in self.backend.get_groups_for_users(missing).items():
+                self._store(user_id, groups)
+                found[user_id] = set(groups)
+        return found
+
+    async def get_groups_for_users_async(
+        self,
+        user_ids: Iterable[str]
+    ) -> Dict[str, Set[str]]:
+        found, missing = self._lookup_many(user_ids)
+        if missing:
+            for user_id, groups in (
+                await self.backend.get_groups_for_users_async(missing)
+            ).items():
+                self._store(user_id, groups)
+                found[user_id] = set(groups)
+        return found
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        """drop the cached groups for `user_id`, or
+            everything if no user is given
+        """
+
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        """return the cache counters, useful for tuning
+            the size and TTLs
+        """
+
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                **self._counters
+            }
@@ -19,7 +19,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import abc
-from typing import Set
+import asyncio
+from typing import Dict, Iterable, Set
 
 
 class IdentityManager(abc.ABC):
@@ -33,3 +34,28 @@ class IdentityManager(abc.ABC):
     @abc.abstractmethod
     def get_groups_for_user(self, user_id: str) -> Set[str]:
         """get groups user `user_id` is a part of"""
+
+    async def get_groups_for_user_async(self, user_id: str) -> Set[str]:
+        """get groups user `user_id` is a part of, without blocking
+            the event loop
+
+            by default, this runs `get_groups_for_user` in a worker thread
+        """
+        return await asyncio.to_thread(self.get_groups_for_user, user_id)
+
+    def get_groups_for_users(self, user_ids: Iterable[str]) -> Dict[str, Set[str]]:
+        """get the groups for each of `user_ids` at once
+
+            by default, this looks each user up in turn, backends
+            that can answer for many users in one go should override it
+        """
+        return {user_id: self.get_groups_for_user(user_id) for user_id in set(user_ids)}
+
+    async def get_groups_for_users_async(
+        self,
+        user_ids: Iterable[str]
+    ) -> Dict[str, Set[str]]:
+        """get the groups for each of `user_ids` at once, without
+            blocking the event loop
+        """
+        return await asyncio.to_thread(self.get_groups_for_users, list(user_ids))
@@ -18,36 +18,141 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import Set
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Set, Tuple
 
 import ldap
+from ldap.filter import escape_filter_chars
 from ldap.ldapobject import LDAPObject
 
 from .core import IdentityManager
+from .pool import ConnectionPool
 
 SCOPE_SUBTREE = 2
+PEOPLE_BASE = "ou=people,dc=sanger,dc=ac,dc=uk"
+
+# how many users to OR together in one bulk search filter
+BULK_FILTER_SIZE = 100
+
+# errors that mean the connection itself is no good,
+# so it's worth trying again with a fresh one
+_CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)
 
 
 class SangerLDAPIdentityManager(IdentityManager):
     """interfaces with the Sanger LDAP servers whilst providing
         an `IdentityManager` interface
+
+        connections are bound once and kept in a pool of
+        `pool_size` connections, rather than made per lookup
     """
 
-    def __init__(self, ldap_host: str, ldap_port: int) -> None:
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        ldap_host: str,
+        ldap_port: int,
+        *,
+        pool_size: int = 4,
+        pool_timeout: float = 5,
+        health_check_interval: float = 60,
+        network_timeout: float = 10
+    ) -> None:
         self.ldap_host = ldap_host
         self.ldap_port = ldap_port
+        self.network_timeout = network_timeout
+
+        self._pool: ConnectionPool[LDAPObject] = ConnectionPool(
+            self._new_ldap_conn,
+            size=pool_size,
+            timeout=pool_timeout,
+            health_check=self._ldap_conn_healthy,
+            health_check_interval=health_check_interval,
+            close=lambda conn: conn.unbind_s()
+        )
+
+        # async lookups get their own threads, one per pooled
+        # connection, so a slow directory server can only tie up
+        # these and not the event loop's default executor
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="ldap")
 
-    @property
-    def _ldap_conn(self) -> LDAPObject:
+    def _new_ldap_conn(self) -> LDAPObject:
         conn: LDAPObject = ldap.initialize(
             f"ldap://{self.ldap_host}:{self.ldap_port}")
-        conn.bind("", "")
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.network_timeout)
+        conn.simple_bind_s("", "")
         return conn
 
+    @staticmethod
+    def _ldap_conn_healthy(conn: LDAPObject) -> bool:
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def _search_once(self, search_filter: str, attributes: List[str]) -> List[Tuple[str, Any]]:
+        with self._pool.connection() as conn:
+            return conn.search_s(
+                "dc=sanger,dc=ac,dc=uk", SCOPE_SUBTREE, search_filter, attributes)
+
+    def _search(self, search_filter: str, attributes: List[str]) -> List[Tuple[str, Any]]:
+        """run a subtree search on a pooled connection, retrying
+            once on a fresh connection if the pooled one has died
+        """
+
+        try:
+            return self._search_once(search_filter, attributes)
+        except _CONNECTION_ERRORS:
+            # if the server has gone away, the rest of
+            # the idle connections will have gone with it
+            self._pool.close()
+            return self._search_once(search_filter, attributes)
+
     def get_groups_for_user(self, user_id: str) -> Set[str]:
-        return set(x["cn"][0].decode("UTF-8") for _, x in self._ldap_conn.search_s(
-            "dc=sanger,dc=ac,dc=uk",
-            SCOPE_SUBTREE,
-            f"(&(objectClass=groupOfNames)(member=uid={user_id},ou=people,dc=sanger,dc=ac,dc=uk))",
+        return set(x["cn"][0].decode("UTF-8") for _, x in self._search(
+            f"(&(objectClass=groupOfNames)"
+            f"(member=uid={escape_filter_chars(user_id)},{PEOPLE_BASE}))",
             ["cn"]
         ))
+
+    def get_groups_for_users(self, user_ids: Iterable[str]) -> Dict[str, Set[str]]:
+        """get the groups for many users, ORing up to `BULK_FILTER_SIZE`
+            users into each search rather than searching per user
+        """
+
+        _users = sorted(set(user_ids))
+        groups: Dict[str, Set[str]] = {user_id: set() for user_id in _users}
+
+        # member DNs come back as the directory has them, so
+        # match them case insensitively
+        dn_to_user = {f"uid={user_id},{PEOPLE_BASE}".lower(): user_id for user_id in _users}
+
+        for i in range(0, len(_users), BULK_FILTER_SIZE):
+            _members = "".join(
+                f"(member=uid={escape_filter_chars(user_id)},{PEOPLE_BASE})"
+                for user_id in _users[i:i + BULK_FILTER_SIZE])
+
+            for _, group in self._search(
+                f"(&(objectClass=groupOfNames)(|{_members}))",
+                ["cn", "member"]
+            ):
+                group_name = group["cn"][0].decode("UTF-8")
+                for member in group.get("member", []):
+                    user_id = dn_to_user.get(member.decode("UTF-8").lower())
+                    if user_id is not None:
+                        groups[user_id].add(group_name)
+
+        return groups
+
+    async def get_groups_for_user_async(self, user_id: str) -> Set[str]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.get_groups_for_user, user_id)
+
+    async def get_groups_for_users_async(
+        self,
+        user_ids: Iterable[str]
+    ) -> Dict[str, Set[str]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.get_groups_for_users, list(user_ids))
@@ -18,53 +18,147 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
+from contextlib import contextmanager
 import os
 from pathlib import Path
-from typing import Set, Dict, List
+import tempfile
+import threading
+from typing import Iterable, Iterator, Optional, Set, Dict, List, Tuple
 
 import json
 
 from .core import IdentityManager
 
 
-class LocalJSONIdentityManager(IdentityManager):
+class LocalJSONIdentityManager(IdentityManager):  # pylint: disable=too-many-instance-attributes
     """implements an IdentityManager using a local JSON file
 
         useful for use in tests instead of an LDAP server
+
+        the file is kept in memory along with an index of the
+        groups each user is in, and is only read again when its
+        modification time or size changes
     """
 
     def __init__(self, file_path: Path, temp: bool = True) -> None:
         self.file_path = file_path
         self.temp = temp
 
+        self._data: Dict[str, List[str]] = {}
+        self._index: Dict[str, Set[str]] = {}
+        self._signature: Optional[Tuple[int, int]] = None
+        self._lock = threading.RLock()
+
+        # how many `batch` blocks we're inside, and
+        # whether they've got changes waiting to be written
+        self._batch_depth = 0
+        self._dirty = False
+
+    def _file_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self) -> None:
+        """load the file and rebuild the index, but only
+            if the file has changed since we last saw it
+        """
+
+        with self._lock:
+            if self._batch_depth:
+                # we've got our own changes in memory
+                # that haven't been written yet
+                return
+
+            signature = self._file_signature()
+            if signature == self._signature:
+                return
+
+            _data: Dict[str, List[str]] = {}
+            if signature is not None:
+                with open(self.file_path, encoding="UTF-8") as idm_file:
+                    _data = json.load(idm_file)
+
+            _index: Dict[str, Set[str]] = {}
+            for group_name, members in _data.items():
+                for member in members:
+                    _index.setdefault(member, set()).add(group_name)
+
+            self._data = _data
+            self._index = _index
+            self._signature = signature
+
+    def _write(self) -> None:
+        """write the data back to the file, atomically replacing it"""
+
+        _dir = os.path.dirname(os.path.abspath(self.file_path))
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="UTF-8", dir=_dir, suffix=".tmp", delete=False
+        ) as idm_file:
+            json.dump(self._data, idm_file)
+
+        os.replace(idm_file.name, self.file_path)
+        self._signature = self._file_signature()
+        self._dirty = False
+
     def get_groups_for_user(self, user_id: str) -> Set[str]:
-        with open(self.file_path, encoding="UTF-8") as idm_file:
-            _data = json.load(idm_file)
+        self._refresh()
+        with self._lock:
+            return set(self._index.get(user_id, ()))
+
+    async def get_groups_for_user_async(self, user_id: str) -> Set[str]:
+        # the index is in memory, so we only need to leave
+        # the event loop if the file needs reading again
+        if self._file_signature() != self._signature:
+            await asyncio.to_thread(self._refresh)
+        with self._lock:
+            return set(self._index.get(user_id, ()))
+
+    def get_groups_for_users(self, user_ids: Iterable[str]) -> Dict[str, Set[str]]:
+        self._refresh()
+        with self._lock:
+            return {user_id: set(self._index.get(user_id, ())) for user_id in user_ids}
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """group changes made inside the `with` block
+            into a single write of the file at the end
+        """
 
-        groups: Set[str] = set()
-        for group_name, members in _data.items():
-            if user_id in members:
-                groups.add(group_name)
-        return groups
+        with self._lock:
+            self._refresh()
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._dirty:
+                    self._write()
 
     def add_user_to_group(self, user_id: str, group_name: str) -> None:
         """add the user specified by `user_id` to the group
             specified by `group_name`
         """
 
-        try:
-            with open(self.file_path, encoding="UTF-8") as idm_file:
-                _data = json.load(idm_file)
-        except FileNotFoundError:
-            _data: Dict[str, List[str]] = {}
+        self.add_users_to_groups([(user_id, group_name)])
+
+    def add_users_to_groups(self, memberships: Iterable[Tuple[str, str]]) -> None:
+        """add each (`user_id`, `group_name`) pair in `memberships`,
+            writing the file once at the end
+        """
 
-        if group_name in _data:
-            _data[group_name].append(user_id)
-        else:
-            _data[group_name] = [user_id]
+        with self.batch():
+            for user_id, group_name in memberships:
+                user_groups = self._index.setdefault(user_id, set())
+                if group_name in user_groups:
+                    continue
 
-        with open(self.file_path, "w", encoding="UTF-8") as idm_file:
-            json.dump(_data, idm_file)
+                user_groups.add(group_name)
+                self._data.setdefault(group_name, []).append(user_id)
+                self._dirty = True
 
     def __del__(self):
         if self.temp:
@@ -0,0 +1,155 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from contextlib import contextmanager
+import queue
+import threading
+import time
+from typing import Callable, Dict, Generic, Iterator, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class ConnectionPool(Generic[T]):  # pylint: disable=too-many-instance-attributes
+    """a thread-safe pool of long-lived connections
+
+        connections are made lazily by `factory`, up to `size` of
+        them. a connection that has been sat idle for longer than
+        `health_check_interval` seconds is checked with `health_check`
+        before being handed out, and replaced if it isn't healthy.
+        if anything goes wrong whilst a connection is borrowed, it is
+        closed rather than going back in the pool, so the next user
+        gets a fresh one
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        factory: Callable[[], T],
+        *,
+        size: int = 4,
+        timeout: float = 5,
+        health_check: Optional[Callable[[T], bool]] = None,
+        health_check_interval: float = 60,
+        close: Optional[Callable[[T], None]] = None,
+        clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+
+        self._factory = factory
+        self._health_check = health_check
+        self._close = close
+        self._clock = clock
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        # most recently used first, so quiet periods
+        # let the older connections go stale together
+        self._idle: queue.LifoQueue[Tuple[T, float]] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "created": 0,
+            "reused": 0,
+            "discarded": 0,
+            "in_use": 0
+        }
+
+    def _count(self, counter: str, change: int = 1) -> None:
+        with self._lock:
+            self._counters[counter] += change
+
+    def _discard(self, conn: T) -> None:
+        """close a connection we're not going to use again"""
+        self._count("discarded")
+        if self._close is not None:
+            try:
+                self._close(conn)
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    def _checkout(self) -> T:
+        """get a healthy idle connection, or make a new one"""
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            if (self._health_check is not None
+                    and self._clock() - last_used > self.health_check_interval
+                    and not self._health_check(conn)):
+                self._discard(conn)
+                continue
+
+            self._count("reused")
+            return conn
+
+        conn = self._factory()
+        self._count("created")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[T]:
+        """borrow a connection from the pool for the
+            duration of the `with` block
+
+        Raises:
+            TimeoutError: if every connection is in use and
+                none comes free within `timeout` seconds
+        """
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(
+                f"no connection available after {self.timeout} seconds")
+
+        try:
+            conn = self._checkout()
+            self._count("in_use")
+            try:
+                yield conn
+            except BaseException:
+                self._discard(conn)
+                raise
+            else:
+                self._idle.put((conn, self._clock()))
+            finally:
+                self._count("in_use", -1)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """close all the idle connections"""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def stats(self) -> Dict[str, int]:
+        """return the pool counters"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": self._idle.qsize(),
+                **self._counters
+            }
@@ -0,0 +1,333 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# how many keys starting with the query we look at, which
+# only runs out for queries of a letter or two
+MAX_PREFIX_KEYS = 2000
+
+# how much of the query's trigrams a name needs, to be
+# close enough to a typo of it
+MIN_SIMILARITY = 0.5
+
+# how many of the query's rarest trigrams are counted
+# when looking for close matches
+FUZZY_TRIGRAMS = 8
+
+
+class NixpkgsAttribute(NamedTuple):
+    """a package in nixpkgs"""
+    attribute: str
+    name: str
+    version: str
+    description: str
+
+
+class SearchResult(NamedTuple):
+    """a package that matches a search, and how well"""
+    package: NixpkgsAttribute
+    score: float
+    known: bool
+    commonly_used: bool
+
+
+def _open(path: Path):
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def read_packages_json(path: Path) -> List[NixpkgsAttribute]:
+    """read a dump of nixpkgs - from `nix-env -qaP --json`,
+        `nix search --json`, or a channel's `packages.json`
+        (which has them under "packages"), optionally gzipped
+    """
+
+    with _open(path) as dump:
+        data: Dict[str, Any] = json.load(dump)
+    if isinstance(data.get("packages"), dict):
+        data = data["packages"]
+
+    attributes: Dict[str, NixpkgsAttribute] = {}
+    for attribute, info in data.items():
+        # `nix search` gives the attributes as legacyPackages.<system>.<attribute>
+        if attribute.startswith("legacyPackages."):
+            attribute = attribute.split(".", 2)[-1]
+
+        meta = info.get("meta") or {}
+        attributes[attribute] = NixpkgsAttribute(
+            attribute=attribute,
+            name=str(info.get("pname") or info.get("name") or attribute),
+            version=str(info.get("version") or ""),
+            description=str(meta.get("description") or info.get("description") or "")
+        )
+
+    return sorted(attributes.values())
+
+
+def write_index(attributes: Iterable[NixpkgsAttribute], path: Path) -> int:
+    """write the attributes where the web app can load them,
+        replacing what's there all at once
+
+    Returns: int - how many attributes were written
+
+    """
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = [list(x) for x in attributes]
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, delete=False, encoding="utf-8"
+    ) as index_file:
+        json.dump(rows, index_file, separators=(",", ":"))
+    os.replace(index_file.name, path)
+    return len(rows)
+
+
+def read_index(path: Path) -> List[NixpkgsAttribute]:
+    """read the attributes written by `write_index`"""
+    with open(path, encoding="utf-8") as index_file:
+        return [NixpkgsAttribute(*x) for x in json.load(index_file)]
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PackageSearchIndex:
+    """an in memory index of nixpkgs, for searching as you type
+
+    the lowercased attribute paths and names (and the last part
+    of each attribute path) are kept sorted, so everything starting
+    with the query is found by bisecting. each trigram of them has
+    a list of the packages it appears in, which are intersected to
+    find the packages containing the query, or counted to find ones
+    that are close to it if there aren't enough
+
+    exact matches rank highest, then prefixes, then substrings, then
+    close matches. packages we know about get a boost, and commonly
+    used ones more, and shorter attributes win ties
+    """
+
+    def __init__(self, attributes: Iterable[NixpkgsAttribute]) -> None:
+        self.packages: List[NixpkgsAttribute] = list(attributes)
+
+        keys: Set[Tuple[str, int]] = set()
+        postings: Dict[str, List[int]] = {}
+        for i, package in enumerate(self.packages):
+            names = {package.attribute.lower(), package.name.lower(),
+                     package.attribute.rsplit(".", 1)[-1].lower()}
+            keys.update((x, i) for x in names)
+            for gram in set().union(*map(_trigrams, names)):
+                postings.setdefault(gram, []).append(i)
+
+        sorted_keys = sorted(keys)
+        self._keys = [x for x, _ in sorted_keys]
+        self._key_packages = array("I", [x for _, x in sorted_keys])
+        self._postings = {k: array("I", v) for k, v in postings.items()}
+        self._lowered = [(x.attribute.lower(), x.name.lower()) for x in self.packages]
+
+    def __len__(self) -> int:
+        return len(self.packages)
+
+    def _prefixed(self, query: str, scores: Dict[int, float]) -> None:
+        start = bisect_left(self._keys, query)
+        for i in range(start, min(start + MAX_PREFIX_KEYS, len(self._keys))):
+            key = self._keys[i]
+            if not key.startswith(query):
+                break
+            package = self._key_packages[i]
+            scores[package] = max(scores.get(package, 0), 100 if key == query else 60)
+
+    def _containing(self, grams: List[array], query: str, scores: Dict[int, float]) -> None:
+        candidates = set(grams[0])
+        for posting in grams[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return
+
+        for package in candidates:
+            if package not in scores and any(query in x for x in self._lowered[package]):
+                scores[package] = 40
+
+    def _close(self, grams: List[array], scores: Dict[int, float]) -> None:
+        overlaps: Counter = Counter()
+        for posting in grams[:FUZZY_TRIGRAMS]:
+            overlaps.update(posting)
+
+        counted = min(len(grams), FUZZY_TRIGRAMS)
+        for package, overlap in overlaps.items():
+            similarity = overlap / counted
+            if similarity >= MIN_SIMILARITY and package not in scores:
+                scores[package] = 30 * similarity
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        boosts: Optional[Dict[str, bool]] = None
+    ) -> List[SearchResult]:
+        """find the packages best matching `query`
+
+        Args:
+            - query: str - what's been typed so far
+            - limit: int - how many results to give
+            - boosts: Optional[Dict[str, bool]] - the names of packages
+                we already know about, and whether they're commonly used
+
+        Returns: List[SearchResult] - the best matches, best first
+
+        """
+
+        query = query.strip().lower()
+        if not query:
+            return []
+        boosts = boosts or {}
+
+        scores: Dict[int, float] = {}
+        self._prefixed(query, scores)
+
+        query_grams = _trigrams(query)
+        if query_grams:
+            # rarest first, so the intersection shrinks quickly
+            grams = sorted((self._postings.get(x, array("I")) for x in query_grams), key=len)
+            if len(grams[0]) > 0:
+                self._containing(grams, query, scores)
+            if len(scores) < limit:
+                self._close([x for x in grams if len(x) > 0], scores)
+
+        def _boosted(package: int) -> SearchResult:
+            attribute = self.packages[package]
+            known = attribute.name in boosts or attribute.attribute in boosts
+            commonly_used = bool(boosts.get(attribute.name) or boosts.get(attribute.attribute))
+            return SearchResult(attribute, scores[package] + (15 if known else 0)
+                                + (25 if commonly_used else 0), known, commonly_used)
+
+        results = [_boosted(x) for x in scores]
+        results.sort(key=lambda x: (-x.score, len(x.package.attribute), x.package.attribute))
+        return results[:limit]
+
+
+class PackageSearch:  # pylint: disable=too-many-instance-attributes
+    """loads the index `import-nixpkgs` writes to `index`, the first
+        time it's searched and whenever it's replaced (checked at
+        most every `check_interval` seconds), and holds on to the
+        packages we know about for `boost_ttl` seconds
+
+    a replaced index is loaded in the background, and the old
+    one searched until it's ready
+    """
+
+    def __init__(self, index: Path, check_interval: float = 5, boost_ttl: float = 60) -> None:
+        self.index_path = Path(index)
+        self.check_interval = check_interval
+        self.boost_ttl = boost_ttl
+
+        self._lock = threading.Lock()
+        # held whilst an index is loaded, so only one is at a time
+        self._load_lock = threading.Lock()
+        self._index: Optional[PackageSearchIndex] = None
+        self._index_mtime: Optional[float] = None
+        self._checked_at: Optional[float] = None
+        self._reloader: Optional[threading.Thread] = None
+        self._boosts: Optional[Tuple[float, Dict[str, bool]]] = None
+
+    def _load(self, mtime: float) -> PackageSearchIndex:
+        with self._load_lock:
+            with self._lock:
+                if self._index is not None and self._index_mtime == mtime:
+                    return self._index
+            index = PackageSearchIndex(read_index(self.index_path))
+            with self._lock:
+                self._index = index
+                self._index_mtime = mtime
+            return index
+
+    def _reload(self, mtime: float) -> None:
+        try:
+            self._load(mtime)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("couldn't load the package search index")
+        finally:
+            with self._lock:
+                self._reloader = None
+
+    def index(self) -> PackageSearchIndex:
+        """the index, loading it if it's new
+
+        this blocks, to read and index nixpkgs, only the first time
+
+        Raises:
+            FileNotFoundError: if nixpkgs hasn't been imported
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            index, index_mtime = self._index, self._index_mtime
+            if index is not None and (self._reloader is not None or (
+                    self._checked_at is not None and now < self._checked_at + self.check_interval)):
+                return index
+
+        mtime = self.index_path.stat().st_mtime
+        with self._lock:
+            self._checked_at = now
+        if mtime == index_mtime and index is not None:
+            return index
+
+        if index is None:
+            # there's nothing to search in the meantime
+            return self._load(mtime)
+
+        with self._lock:
+            if self._reloader is None:
+                self._reloader = threading.Thread(
+                    target=self._reload, args=(mtime,), name="package-search", daemon=True)
+                self._reloader.start()
+        return index
+
+    def boosts(self, load: Callable[[], Dict[str, bool]]) -> Dict[str, bool]:
+        """the packages we know about, from `load` if
+            we haven't got them or they're stale
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if self._boosts is not None and self._boosts[0] > now:
+                return self._boosts[1]
+
+        boosts = load()
+        with self._lock:
+            self._boosts = (now + self.boost_ttl, boosts)
+        return boosts
@@ -0,0 +1,109 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+from pathlib import Path
+import re
+from typing import Iterable, Iterator, List, Optional
+
+from beaver.models.packages import PackageRequest, PackageRequestFile, PackageType
+
+# a requirement's name, any extras, and what's left
+_REQUIREMENT = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)$")
+# a version pinned exactly, which is the only kind we keep
+_PINNED = re.compile(r"^===?\s*([A-Za-z0-9][A-Za-z0-9.+!_-]*)$")
+
+
+def parse_requirement(line: str) -> Optional[PackageRequest]:
+    """turn a line of a `requirements.txt` into a request for a
+        Python package, versioned if it's pinned with `==`
+
+    Returns: Optional[PackageRequest] - nothing for blank lines,
+        comments and pip options
+
+    Raises:
+        ValueError: if the line isn't a requirement we can import,
+            such as a bare URL or path
+
+    """
+
+    line = re.sub(r"(^|\s)#.*$", "", line).strip()
+    if not line or line.startswith("-"):
+        return None
+
+    match = _REQUIREMENT.match(line)
+    if match is None:
+        raise ValueError(f"not a package name: {line}")
+    name, _, rest = match.groups()
+    specifier = rest.split(";", 1)[0].strip()
+    if specifier.startswith("@"):
+        specifier = ""
+    elif specifier and not specifier.startswith(("=", "<", ">", "~", "!")):
+        raise ValueError(f"not a package name: {line}")
+
+    pinned = _PINNED.match(specifier)
+    return PackageRequest(
+        name=re.sub(r"[-_.]+", "-", name).lower(),
+        version=pinned.group(1) if pinned else None,
+        type=PackageType.py
+    )
+
+
+def read_requirements(lines: Iterable[str]) -> Iterator[PackageRequest]:
+    """read the Python packages in a `requirements.txt`, as a
+        Package Request File would have them
+
+    Raises:
+        ValueError: if a line isn't a requirement we can import
+    """
+
+    continued = ""
+    for number, line in enumerate(lines, start=1):
+        line = continued + line.rstrip("\r\n")
+        if line.endswith("\\"):
+            continued = line[:-1]
+            continue
+        continued = ""
+
+        try:
+            request = parse_requirement(line)
+        except ValueError as err:
+            raise ValueError(f"line {number}: {err}") from err
+        if request is not None:
+            yield request
+
+    if continued:
+        request = parse_requirement(continued)
+        if request is not None:
+            yield request
+
+
+def read_package_request_file(path: Path) -> List[PackageRequest]:
+    """read the packages in a Package Request File, or
+        a `requirements.txt` if it ends `.txt`
+
+    Raises:
+        ValueError: if the file isn't valid
+    """
+
+    with open(path, encoding="utf-8") as request_file:
+        if path.suffix == ".txt":
+            return list(read_requirements(request_file))
+        return PackageRequestFile.parse_obj(json.load(request_file)).packages
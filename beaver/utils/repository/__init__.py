@@ -1,5 +1,7 @@
 from pathlib import Path
 
 
-class RepositorableObject(Path):
+# `Path` itself can't be subclassed, as it picks
+# `PosixPath` or `WindowsPath` when it's created
+class RepositorableObject(type(Path())):  # type: ignore
     ...
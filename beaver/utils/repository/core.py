@@ -1,5 +1,4 @@
 import abc
-
 from beaver.utils.repository import RepositorableObject
 
 
@@ -9,5 +8,21 @@ class Repository(abc.ABC):
         ...
 
     @abc.abstractmethod
-    def add(self, _: RepositorableObject) -> None:
+    def add(self, obj: RepositorableObject, *keys: str) -> None:
         ...
+
+    def tag(self, key: str, *keys: str) -> None:
+        """put whatever's under `key` under `keys` as well -
+            repositories that keep what they're given should
+            do this without storing it again
+
+        Raises:
+            KeyError: if there's nothing under `key`
+        """
+        self.add(self.get(key), *keys)
+
+    def __contains__(self, _: str) -> bool:
+        """whether there's something under the key - repositories
+            that keep what they're given should say so
+        """
+        return False
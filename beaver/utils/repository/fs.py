@@ -0,0 +1,208 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+
+from beaver.utils.repository import RepositorableObject
+from beaver.utils.repository.core import Repository
+
+_CHUNK_SIZE = 1 << 20
+
+
+def content_hash(path: Path) -> str:
+    """the SHA-256 of the file at `path`, read in chunks
+        as images can be large
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileSystemRepository(Repository):
+    """a repository on the local filesystem, storing what it's
+        given under the hash of its contents
+
+    objects live in `objects/<hash>/<name>`, so identical files are
+    only stored once and keep their names, and `refs/<key>` points a
+    key at one. everything is written to `tmp` first and moved into
+    place, so other builders never see half a file.
+
+    whenever the objects go over `max_size` bytes, the least recently
+    used are removed. refs to them are then treated as missing.
+
+    the definition and image stages pass what they make through the
+    repository, so if they run on different hosts `root` must be on
+    storage they all share (e.g. NFS or Lustre), or the image stage
+    won't find the definitions
+    """
+
+    def __init__(self, root: Path, max_size: Optional[int] = None) -> None:
+        self.root = Path(root)
+        self.max_size = max_size
+
+        self._objects = self.root / "objects"
+        self._refs = self.root / "refs"
+        self._tmp = self.root / "tmp"
+        for directory in (self._objects, self._refs, self._tmp):
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def _ref(self, key: str) -> Path:
+        if not key or "/" in key or key.startswith("."):
+            raise ValueError(f"invalid repository key: {key!r}")
+        return self._refs / key
+
+    def _resolve(self, key: str) -> Optional[Path]:
+        """the object `key` points at, if it's still there"""
+
+        try:
+            target = self._ref(key).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return None
+
+        path = self._objects / target
+        return path if path.is_file() else None
+
+    def __contains__(self, key: str) -> bool:
+        return self._resolve(key) is not None
+
+    def get(self, key: str) -> RepositorableObject:
+        path = self._resolve(key)
+        if path is None:
+            raise KeyError(key)
+
+        # mark it as used, for eviction
+        try:
+            os.utime(path.parent)
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+        return RepositorableObject(path)
+
+    def _write_ref(self, key: str, target: str) -> None:
+        """point `key` at `target` (`<hash>/<name>`), all at once"""
+
+        ref = self._ref(key)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self._tmp, delete=False, encoding="utf-8"
+        ) as ref_file:
+            ref_file.write(f"{target}\n")
+        os.replace(ref_file.name, ref)
+
+    def add(self, obj: RepositorableObject, *keys: str) -> None:
+        """store `obj`, hashing and copying it once, under each
+            of `keys` (or its name, if there aren't any)
+        """
+
+        source = Path(obj)
+        keys = keys or (source.name,)
+        for key in keys:
+            self._ref(key)
+        digest = content_hash(source)
+        directory = self._objects / digest
+
+        if not (directory / source.name).is_file():
+            staging = Path(tempfile.mkdtemp(dir=self._tmp))
+            shutil.copyfile(source, staging / source.name)
+            if directory.is_dir():
+                # another name for the same contents
+                os.replace(staging / source.name, directory / source.name)
+                staging.rmdir()
+            else:
+                try:
+                    os.replace(staging, directory)
+                except OSError:
+                    # someone else stored it first
+                    shutil.rmtree(staging, ignore_errors=True)
+        os.utime(directory)
+
+        for key in keys:
+            self._write_ref(key, f"{digest}/{source.name}")
+
+        self.evict()
+
+    def tag(self, key: str, *keys: str) -> None:
+        path = self._resolve(key)
+        if path is None:
+            raise KeyError(key)
+
+        try:
+            os.utime(path.parent)
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+        for new_key in keys:
+            self._write_ref(new_key, f"{path.parent.name}/{path.name}")
+
+    def _usage(self) -> Iterator[Tuple[float, int, Path]]:
+        for directory in self._objects.iterdir():
+            try:
+                size = sum(path.stat().st_size for path in directory.iterdir())
+                yield directory.stat().st_mtime, size, directory
+            except FileNotFoundError:
+                continue
+
+    def size(self) -> int:
+        """how many bytes the objects take up"""
+        return sum(size for _, size, _ in self._usage())
+
+    def evict(self, max_size: Optional[int] = None) -> List[str]:
+        """remove the least recently used objects until they fit in
+            `max_size` bytes (by default, the repository's `max_size`)
+
+        Returns: List[str] - the hashes of the objects removed
+
+        """
+
+        max_size = self.max_size if max_size is None else max_size
+        if max_size is None:
+            return []
+
+        usage = sorted(self._usage())
+        total = sum(size for _, size, _ in usage)
+        evicted: List[str] = []
+        for _, size, directory in usage:
+            if total <= max_size:
+                break
+
+            # move it out of the way first, so it disappears all at once
+            doomed = Path(tempfile.mkdtemp(dir=self._tmp)) / directory.name
+            try:
+                os.replace(directory, doomed)
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(doomed.parent, ignore_errors=True)
+
+            total -= size
+            evicted.append(directory.name)
+
+        if evicted:
+            for ref in self._refs.iterdir():
+                if self._resolve(ref.name) is None:
+                    ref.unlink(missing_ok=True)
+
+        return evicted
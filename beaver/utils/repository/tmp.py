@@ -3,8 +3,16 @@ from beaver.utils.repository.core import Repository
 
 
 class TempRepository(Repository):
-    def add(self, _: RepositorableObject) -> None:
+    def add(self, obj: RepositorableObject, *keys: str) -> None:
         ...
 
     def get(self, _: str) -> RepositorableObject:
         return RepositorableObject()
+
+    def tag(self, key: str, *keys: str) -> None:
+        """nothing's kept, so there's never anything to tag
+
+        Raises:
+            KeyError: always
+        """
+        raise KeyError(key)
@@ -0,0 +1,122 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Benchmark for listing the images visible to a user (GET /images/{user})
+
+Compares the number of database round trips, and the time taken, for
+the old per-group lookups against the single joined query, including
+serialising the images like the API does.
+
+Usage: python benchmarks/bench_image_listing.py [number of groups]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+from sqlalchemy import event
+
+import beaver.db.db
+from beaver.db.groups import Group
+from beaver.db.images import (Image, get_images_for_group_name, get_images_for_user,
+                              get_images_visible_to_user)
+import beaver.db.packages  # pylint: disable=unused-import # needed for the image_contents table
+from beaver.db.users import User
+import beaver.models.images
+from beaver.models.pagination import MAX_PAGE_SIZE, PageRequest
+
+IMAGES_PER_OWNER = 5
+
+
+def _set_up(db_path: str, num_groups: int) -> List[str]:
+    """make a database with a user in `num_groups` groups,
+        each of which (and the user) owning some images
+    """
+
+    beaver.db.db.create_connectors(f"sqlite:///{db_path}")
+    beaver.db.db.create_db()
+
+    database = next(beaver.db.db.get_db())
+    user = User(user_name="benchUser")
+    database.add(user)
+    groups = [Group(group_name=f"benchGroup{i}") for i in range(num_groups)]
+    database.add_all(groups)
+    database.flush()
+
+    for owner_group in groups:
+        for i in range(IMAGES_PER_OWNER):
+            database.add(Image(
+                image_name=f"{owner_group.group_name}-image{i}",
+                user_id=user.user_id,
+                group_id=owner_group.group_id
+            ))
+
+    database.commit()
+    database.close()
+    return [f"benchGroup{i}" for i in range(num_groups)]
+
+
+def _before(database, groups: List[str]) -> List[Image]:
+    images = get_images_for_user(database, "benchUser")
+    for group in groups:
+        images += get_images_for_group_name(database, group)
+    return images
+
+
+def _after(database, groups: List[str]) -> List[Image]:
+    return get_images_visible_to_user(
+        database, "benchUser", groups, PageRequest(limit=MAX_PAGE_SIZE)).items
+
+
+def _measure(name: str, listing: Callable, groups: List[str]) -> None:
+    statements = 0
+
+    def _count(*_) -> None:
+        nonlocal statements
+        statements += 1
+
+    event.listen(beaver.db.db.engine, "before_cursor_execute", _count)
+    database = next(beaver.db.db.get_db())
+    start = time.perf_counter()
+    images = [beaver.models.images.Image.from_orm(x)
+              for x in listing(database, groups)]
+    elapsed = time.perf_counter() - start
+    database.close()
+    event.remove(beaver.db.db.engine, "before_cursor_execute", _count)
+
+    print(f"{name:>8}: {statements:5d} round trips, {len(images):5d} images, "
+          f"{elapsed * 1000:8.2f} ms")
+
+
+def main() -> None:
+    """run the benchmark"""
+    num_groups = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        groups = _set_up(os.path.join(tmp_dir, "bench.db"), num_groups)
+        print(f"user in {num_groups} groups, {IMAGES_PER_OWNER} images each")
+        _measure("before", _before, groups)
+        _measure("after", _after, groups)
+        beaver.db.db.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
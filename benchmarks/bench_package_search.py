@@ -0,0 +1,86 @@
+"""
+HGI Beaver - Software Provisioning
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Benchmark for searching nixpkgs (GET /packages/search)
+
+Times building the search index over a nixpkgs sized set of attributes,
+and searching it for exact names, prefixes, substrings and typos,
+against a linear scan of every attribute like a naive search would do.
+
+Usage: python benchmarks/bench_package_search.py [number of attributes]
+"""
+
+import random
+import string
+import sys
+import time
+from typing import Callable, List
+
+from beaver.utils.nixpkgs import NixpkgsAttribute, PackageSearchIndex
+
+QUERIES = ["samtools", "sam", "tools", "samtols", "python3Packages.numpy", "zzzz"]
+REPEATS = 20
+
+
+def _attributes(count: int) -> List[NixpkgsAttribute]:
+    """make `count` made up attributes, a few of them real, some
+        nested in package sets like nixpkgs has
+    """
+
+    rng = random.Random(0)
+    attributes = [NixpkgsAttribute(x, x, "1.0", "") for x in (
+        "samtools", "bcftools", "python3Packages.numpy", "python3Packages.pysam")]
+    while len(attributes) < count:
+        name = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 14)))
+        if rng.random() < 0.3:
+            name = f"{rng.choice(['python3Packages', 'perlPackages', 'haskellPackages'])}.{name}"
+        attributes.append(NixpkgsAttribute(name, name.rsplit(".", 1)[-1], "1.0", ""))
+    return attributes
+
+
+def _scan(attributes: List[NixpkgsAttribute], query: str) -> List[NixpkgsAttribute]:
+    query = query.lower()
+    return [x for x in attributes if query in x.attribute.lower() or query in x.name.lower()]
+
+
+def _measure(name: str, search: Callable) -> None:
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            results = search(query)
+        elapsed = (time.perf_counter() - start) / REPEATS
+        print(f"{name:>6} {query!r:>24}: {len(results):6d} results, {elapsed * 1000:8.2f} ms")
+
+
+def main() -> None:
+    """run the benchmark"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    attributes = _attributes(count)
+
+    start = time.perf_counter()
+    index = PackageSearchIndex(attributes)
+    print(f"indexed {len(index)} attributes in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    _measure("scan", lambda query: _scan(attributes, query))
+    _measure("index", index.search)
+
+
+if __name__ == "__main__":
+    main()
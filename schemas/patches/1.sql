@@ -0,0 +1,49 @@
+create table image_usage_hourly
+(
+	bucket datetime not null,
+	image_id int not null,
+	user_id int not null,
+	group_id int not null,
+	usage_count int default 0 not null,
+	constraint image_usage_hourly_pk
+		primary key (bucket, image_id, user_id, group_id)
+);
+
+create index image_usage_hourly_image_id_bucket
+	on image_usage_hourly (image_id, bucket);
+
+create index image_usage_hourly_user_id_bucket
+	on image_usage_hourly (user_id, bucket);
+
+create index image_usage_hourly_group_id_bucket
+	on image_usage_hourly (group_id, bucket);
+
+create table image_usage_daily
+(
+	bucket datetime not null,
+	image_id int not null,
+	user_id int not null,
+	group_id int not null,
+	usage_count int default 0 not null,
+	constraint image_usage_daily_pk
+		primary key (bucket, image_id, user_id, group_id)
+);
+
+create index image_usage_daily_image_id_bucket
+	on image_usage_daily (image_id, bucket);
+
+create index image_usage_daily_user_id_bucket
+	on image_usage_daily (user_id, bucket);
+
+create index image_usage_daily_group_id_bucket
+	on image_usage_daily (group_id, bucket);
+
+insert into image_usage_hourly (bucket, image_id, user_id, group_id, usage_count)
+	select date_format(datetime, '%Y-%m-%d %H:00:00'), image_id, user_id, group_id, count(*)
+	from image_usage
+	group by 1, image_id, user_id, group_id;
+
+insert into image_usage_daily (bucket, image_id, user_id, group_id, usage_count)
+	select date(datetime), image_id, user_id, group_id, count(*)
+	from image_usage
+	group by 1, image_id, user_id, group_id;
@@ -0,0 +1,47 @@
+create index users_user_name
+	on users (user_name);
+
+create index groups_group_name
+	on `groups` (group_name);
+
+create index images_image_name
+	on images (image_name);
+
+create index images_user_id
+	on images (user_id);
+
+create index images_group_id
+	on images (group_id);
+
+create index image_usage_user_id_datetime
+	on image_usage (user_id, datetime);
+
+create index image_usage_group_id_datetime
+	on image_usage (group_id, datetime);
+
+create index image_usage_image_id_datetime
+	on image_usage (image_id, datetime);
+
+create index image_contents_image_id
+	on image_contents (image_id);
+
+create index image_contents_package_id_image_id
+	on image_contents (package_id, image_id);
+
+create index jobs_status_endtime
+	on jobs (status, endtime);
+
+create index jobs_image_id
+	on jobs (image_id);
+
+create index packages_package_name
+	on packages (package_name);
+
+create index github_packages_package_id
+	on github_packages (package_id);
+
+create index package_dependencies_package_id
+	on package_dependencies (package_id);
+
+create index package_dependencies_dependency_id
+	on package_dependencies (dependency_id);
@@ -0,0 +1,17 @@
+alter table jobs
+	add queuetime timestamp default CURRENT_TIMESTAMP not null;
+
+alter table jobs
+	add lease_owner varchar(100) null;
+
+alter table jobs
+	add lease_expires timestamp null;
+
+alter table jobs
+	add attempts int default 0 not null;
+
+create index jobs_status_queuetime
+	on jobs (status, queuetime);
+
+create index jobs_status_lease_expires
+	on jobs (status, lease_expires);
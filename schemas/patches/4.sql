@@ -0,0 +1,15 @@
+alter table images
+	add content_hash char(64) null;
+
+create index images_content_hash
+	on images (content_hash);
+
+alter table jobs
+	add build_of varchar(60) null;
+
+alter table jobs
+	add constraint jobs_jobs_job_id_fk
+		foreign key (build_of) references jobs (job_id);
+
+create index jobs_build_of
+	on jobs (build_of);
@@ -0,0 +1,4 @@
+drop index images_image_name on images;
+
+create unique index images_image_name
+	on images (image_name);